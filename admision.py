@@ -0,0 +1,175 @@
+"""Control de admisión de llamadas a Gemini compartido por todas las sesiones.
+
+- Un cubo de tokens por modelo limita el ritmo de peticiones a la cuota de la
+  clave: las ráfagas (toda una clase empezando a la vez) esperan en lugar de
+  provocar 429 para todos.
+- Las llamadas interactivas (el turno que el jugador está esperando) tienen
+  prioridad sobre el trabajo de fondo (reposición, precalentado, ramas
+  especulativas): el fondo no consume tokens mientras haya interactivas
+  esperando, ni por debajo de una reserva del cubo.
+- Vuelo único: peticiones idénticas en curso al mismo tiempo comparten una
+  sola llamada y su resultado (o su excepción), sin que lo interactivo quede
+  esperando a una llamada de fondo.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import Future, wait
+
+INTERACTIVA = 0
+FONDO = 1
+
+POR_MINUTO = 120          # Peticiones por minuto y modelo
+RAFAGA = 20               # Capacidad del cubo: peticiones seguidas sin esperar
+RESERVA_INTERACTIVA = 0.25  # Fracción del cubo que el trabajo de fondo no puede gastar
+
+
+class CuotaAgotada(TimeoutError):
+    """No hubo token disponible dentro del tiempo de espera de la llamada."""
+
+
+def validar_limite(por_minuto, rafaga, reserva_interactiva=RESERVA_INTERACTIVA):
+    """Lanza ValueError si el límite no describe un cubo utilizable (por_minuto 0: sin cubo)."""
+    if por_minuto < 0:
+        raise ValueError(f"Peticiones por minuto negativas: {por_minuto}")
+    if por_minuto and rafaga < 1:
+        raise ValueError(f"La ráfaga debe admitir al menos una petición: {rafaga}")
+    if not 0 <= reserva_interactiva < 1:
+        raise ValueError(f"La reserva interactiva debe estar en [0, 1): {reserva_interactiva}")
+
+
+class CuboTokens:
+    """Cubo de tokens con dos prioridades, seguro para varios hilos."""
+
+    def __init__(self, por_minuto=POR_MINUTO, rafaga=RAFAGA, reserva_interactiva=RESERVA_INTERACTIVA):
+        validar_limite(por_minuto, rafaga, reserva_interactiva)
+        if not por_minuto:
+            raise ValueError("Un cubo necesita un límite por minuto positivo")
+        self.por_segundo = por_minuto / 60
+        self.capacidad = rafaga
+        # Nunca por encima de la capacidad: el cubo no se llena más y el fondo esperaría para siempre
+        self.minimo_fondo = min(self.capacidad, 1 + rafaga * reserva_interactiva)
+        self._tokens = float(rafaga)
+        self._ultimo = time.monotonic()
+        self._esperando = [0, 0] # Hilos esperando, por prioridad
+        self._cond = threading.Condition()
+        self.metricas = collections.Counter()
+
+    def _rellenar(self, ahora):
+        self._tokens = min(self.capacidad, self._tokens + (ahora - self._ultimo) * self.por_segundo)
+        self._ultimo = ahora
+
+    def adquirir(self, prioridad=INTERACTIVA, timeout=None):
+        """Consume un token, esperando si hace falta. Devuelve los segundos esperados.
+
+        Lanza `CuotaAgotada` si pasan `timeout` segundos sin token.
+        """
+        inicio = time.monotonic()
+        minimo = 1 if prioridad == INTERACTIVA else self.minimo_fondo
+        with self._cond:
+            self._esperando[prioridad] += 1
+            try:
+                while True:
+                    ahora = time.monotonic()
+                    self._rellenar(ahora)
+                    libre = prioridad == INTERACTIVA or not self._esperando[INTERACTIVA]
+                    if libre and self._tokens >= minimo:
+                        self._tokens -= 1
+                        espera = ahora - inicio
+                        self.metricas["admitidas"] += 1
+                        if espera > 0:
+                            self.metricas["esperas"] += 1
+                            self.metricas["segundos_espera"] += espera
+                        return espera
+                    pausa = max(minimo - self._tokens, 0.01) / self.por_segundo
+                    if timeout is not None:
+                        restante = inicio + timeout - ahora
+                        if restante <= 0:
+                            self.metricas["rechazadas"] += 1
+                            raise CuotaAgotada(f"Sin cuota de peticiones tras {timeout} s")
+                        pausa = min(pausa, restante)
+                    self._cond.wait(pausa)
+            finally:
+                self._esperando[prioridad] -= 1
+                self._cond.notify_all() # Un fondo bloqueado por esta interactiva puede seguir
+
+
+class VueloUnico:
+    """Agrupa llamadas idénticas simultáneas en una sola.
+
+    Una llamada interactiva no espera a una de fondo idéntica (que puede estar
+    parada en la cola del cubo): hace la suya. Las demás esperan a la que está
+    en curso como mucho `timeout` y, pasado ese tiempo, también hacen la suya,
+    con su propia admisión.
+    """
+
+    def __init__(self):
+        self._en_vuelo = {}
+        self._lock = threading.Lock()
+        self.metricas = collections.Counter()
+
+    def ejecutar(self, clave, funcion, prioridad=INTERACTIVA, timeout=None):
+        """Resultado de `funcion()`; si ya hay una con la misma clave en curso, espera y comparte la suya."""
+        with self._lock:
+            futuro, prioridad_lider = self._en_vuelo.get(clave, (None, None))
+            lider = futuro is None
+            if lider:
+                futuro = Future()
+                self._en_vuelo[clave] = futuro, prioridad
+            elif prioridad < prioridad_lider:
+                futuro = None
+            self.metricas["lider" if lider else "agrupadas" if futuro else "sin_agrupar"] += 1
+        if futuro is None:
+            return funcion()
+        if not lider:
+            if wait([futuro], timeout).done:
+                return futuro.result()
+            self.metricas["espera_vencida"] += 1
+            return funcion()
+        try:
+            resultado = funcion()
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            with self._lock:
+                del self._en_vuelo[clave]
+
+
+class ControlAdmision:
+    """Cubos por modelo (creados al primer uso) más el vuelo único, para todo el proceso.
+
+    `limites` asigna (por_minuto, rafaga) a modelos concretos; el resto usa
+    `por_defecto`. Un límite por minuto de 0 desactiva el cubo de ese modelo.
+    Los límites se validan al crearlo (ValueError), no en la primera llamada.
+    """
+
+    def __init__(self, por_defecto=(POR_MINUTO, RAFAGA), limites=None):
+        self.por_defecto = tuple(por_defecto)
+        self.limites = {modelo: tuple(limite) for modelo, limite in (limites or {}).items()}
+        for limite in (self.por_defecto, *self.limites.values()):
+            validar_limite(*limite)
+        self.vuelo = VueloUnico()
+        self._cubos = {}
+        self._lock = threading.Lock()
+
+    def cubo(self, modelo):
+        with self._lock:
+            if modelo not in self._cubos:
+                por_minuto, rafaga = self.limites.get(modelo, self.por_defecto)
+                self._cubos[modelo] = CuboTokens(por_minuto, rafaga) if por_minuto else None
+            return self._cubos[modelo]
+
+    def adquirir(self, modelo, prioridad=INTERACTIVA, timeout=None):
+        if cubo := self.cubo(modelo):
+            return cubo.adquirir(prioridad, timeout)
+        return 0.0
+
+    def metricas(self):
+        with self._lock:
+            cubos = dict(self._cubos)
+        return {"vuelo_unico": dict(self.vuelo.metricas),
+                **{modelo: dict(cubo.metricas) for modelo, cubo in cubos.items() if cubo}}
@@ -1,101 +1,512 @@
 import streamlit as st
+from streamlit.runtime import Runtime
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 import requests # Use requests library
 import json
-import time
 import random
 import os # Potentially useful, though Streamlit secrets are preferred
+import collections
+import contextlib
+import functools
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import admision
+import biblioteca_escenarios
+import cache_respuestas
+import enrutado
+import gemini_client
+import json_incremental
+import memoria
+import modelo_impacto
+import motor
+import paquete_escenarios
+import plazos
+import prompts
+import proveedores
+import resultados
+import sesiones
+import similitud
+import telemetria
+import trabajos
 
 # --- Configuration ---
 # Use the model from the curl example or choose another appropriate one
 # Common options: gemini-1.5-flash-latest, gemini-1.5-pro-latest, gemini-pro
-MODEL_NAME = "gemini-1.5-flash-latest"
-API_ENDPOINT_BASE = "https://generativelanguage.googleapis.com/v1beta/models"
-DEFAULT_TIMEOUT = 120 # Seconds for API requests
+MODEL_NAME = gemini_client.MODELO_POR_DEFECTO
+API_ENDPOINT_BASE = gemini_client.API_ENDPOINT_BASE
+DEFAULT_TIMEOUT = motor.DEFAULT_TIMEOUT
+EVALUATION_TIMEOUT = motor.EVALUATION_TIMEOUT
+# Las reglas de la partida (bancarrota, límite de preguntas, puntaje) viven en motor.py
+NIVELES_DIFICULTAD = motor.NIVELES_DIFICULTAD
+# Biblioteca de escenarios compartida entre sesiones (y réplicas que compartan el disco)
+ESCENARIOS_DB = os.environ.get("CRISIS_ESCENARIOS_DB", "escenarios.sqlite3")
+# Caché de respuestas de Gemini (memoria + disco). Las llamadas muestreadas solo se
+# cachean si se activa explícitamente (p. ej. en aulas donde todos empiezan igual).
+CACHE_LLM_DB = os.environ.get("CRISIS_CACHE_LLM_DB", "cache_llm.sqlite3")
+CACHE_LLM_MUESTREADAS = os.environ.get("CRISIS_CACHE_MUESTREADAS", "0") == "1"
+# Cuota de peticiones por modelo compartida por todas las sesiones (0 la desactiva; ráfaga >= 1).
+# CRISIS_LIMITES_MODELO='{"gemini-1.5-pro-latest": [30, 5]}' fija (por minuto, ráfaga) por modelo.
+LIMITE_POR_MINUTO = int(os.environ.get("CRISIS_LIMITE_POR_MINUTO", admision.POR_MINUTO))
+LIMITE_RAFAGA = int(os.environ.get("CRISIS_LIMITE_RAFAGA", admision.RAFAGA))
+LIMITES_MODELO = json.loads(os.environ.get("CRISIS_LIMITES_MODELO", "{}"))
+# Métricas de las llamadas en formato Prometheus en http://127.0.0.1:<puerto>/metrics (0 lo desactiva)
+METRICAS_PUERTO = int(os.environ.get("CRISIS_METRICAS_PUERTO", "9464"))
+# Impacto estimado localmente al confirmar (los indicadores no esperan a Gemini), calibrado con
+# las evaluaciones guardadas. Al llegar el análisis, "gemini" aplica su impacto si difiere; "local" lo mantiene.
+IMPACTO_DB = os.environ.get("CRISIS_IMPACTO_DB", "impacto.sqlite3")
+IMPACTO_LOCAL = os.environ.get("CRISIS_IMPACTO_LOCAL", "1") == "1"
+RECONCILIAR_IMPACTO = os.environ.get("CRISIS_RECONCILIAR_IMPACTO", "gemini")
+# Paquete precompilado con compilar_paquete.py: sus escenarios y los turnos de su árbol se sirven sin llamar a la API
+PAQUETE = os.environ.get("CRISIS_PAQUETE")
+# Almacén de las partidas (reanudar tras recargar, réplicas sin sesiones fijas): fichero SQLite o
+# redis://host:puerto/db; vacío lo desactiva. Las partidas inactivas más de CRISIS_SESIONES_TTL s se olvidan.
+SESIONES = os.environ.get("CRISIS_SESIONES", "sesiones.sqlite3")
+SESIONES_TTL = int(os.environ.get("CRISIS_SESIONES_TTL", sesiones.TTL))
+# Modelo por tipo de llamada y nivel, con alternativo si el principal va lento o falla (ver enrutado.py).
+# CRISIS_RUTAS_MODELOS='{"pregunta": {"*": ["gemini-1.5-flash-latest"]}}' sustituye la ruta de ese tipo;
+# CRISIS_RUTAS_P95='{"turno": 15}' fija el p95 (s) a partir del cual se pasa al alternativo.
+RUTAS_MODELOS = json.loads(os.environ.get("CRISIS_RUTAS_MODELOS", "{}"))
+RUTAS_P95 = json.loads(os.environ.get("CRISIS_RUTAS_P95", "{}"))
+# Firmas de los escenarios ya generados, para descartar los casi repetidos (vacío: solo en memoria)
+SIMILITUD_DB = os.environ.get("CRISIS_SIMILITUD_DB", "similitud.sqlite3")
+# Proveedores además de Gemini, p. ej. un servidor de inferencia local compatible con OpenAI (ver proveedores.py):
+# CRISIS_PROVEEDORES='{"aula": {"tipo": "openai", "endpoint": "http://10.0.0.5:8000/v1", "conexiones": 32}}'.
+# Sus modelos se nombran "aula/<modelo>" en CRISIS_RUTAS_MODELOS (que elige modelo por tipo de llamada) y
+# en CRISIS_LIMITES_MODELO (un servidor propio no suele necesitar cuota: [0, 0] la desactiva).
+PROVEEDORES = json.loads(os.environ.get("CRISIS_PROVEEDORES", "{}"))
+# Memoria de las sesiones (ver memoria.py): las que pasan CRISIS_SESION_INACTIVA s sin ejecutar el script se
+# expulsan, y si el estado de todas juntas supera CRISIS_MEMORIA_SESIONES_MB, también las menos recientes.
+# La partida expulsada se recupera del almacén de sesiones en su siguiente ejecución; sin almacén no se expulsa nada.
+SESION_INACTIVA = int(os.environ.get("CRISIS_SESION_INACTIVA", memoria.INACTIVA_TRAS))
+MEMORIA_SESIONES_MB = int(os.environ.get("CRISIS_MEMORIA_SESIONES_MB", memoria.PRESUPUESTO // 1024**2))
+BARRIDO_SESIONES = int(os.environ.get("CRISIS_BARRIDO_SESIONES", memoria.INTERVALO_BARRIDO)) # s entre búsquedas de inactivas
+# Partidas terminadas y sus agregados para la página de clasificación (ver resultados.py); vacío lo desactiva
+RESULTADOS_DB = os.environ.get("CRISIS_RESULTADOS_DB", resultados.RUTA)
 
 # --- API Key Loading ---
-GEMINI_API_KEY = None
-GEMINI_AVAILABLE = False
-try:
-    GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-    if not GEMINI_API_KEY:
-        raise KeyError("GEMINI_API_KEY secret is empty.")
-    GEMINI_AVAILABLE = True
-    st.sidebar.success(f"✅ Clave API Cargada ({MODEL_NAME})")
-except KeyError:
+def _leer_clave_api():
+    """Secreto de Streamlit o, si no lo hay, la variable de entorno (p. ej. contra servidor_simulado.py)."""
+    try:
+        return st.secrets["GEMINI_API_KEY"]
+    except (KeyError, FileNotFoundError): # Sin la clave o sin fichero de secretos
+        if clave := os.environ.get("GEMINI_API_KEY"):
+            return clave
+        raise KeyError("GEMINI_API_KEY")
+
+@st.cache_resource
+def cargar_clave_api():
+    """(clave o None, error inesperado o None), leídos una vez por proceso y no en cada interacción.
+
+    Tras añadir o cambiar la clave hay que reiniciar la aplicación.
+    """
+    try:
+        clave = _leer_clave_api()
+        if not clave:
+            raise KeyError("GEMINI_API_KEY secret is empty.")
+        return clave, None
+    except KeyError:
+        return None, None
+    except Exception as e:
+        return None, str(e)
+
+GEMINI_API_KEY, ERROR_CLAVE_API = cargar_clave_api()
+GEMINI_AVAILABLE = GEMINI_API_KEY is not None
+if GEMINI_AVAILABLE:
+    st.sidebar.success(f"✅ Clave API Cargada ({MODEL_NAME} y rutas por tipo de llamada)")
+    if API_ENDPOINT_BASE != gemini_client.ENDPOINT_GEMINI:
+        st.sidebar.info(f"🧪 Endpoint alternativo: {API_ENDPOINT_BASE}")
+    if PROVEEDORES:
+        st.sidebar.info(f"🖧 Proveedores adicionales: {', '.join(PROVEEDORES)}")
+elif ERROR_CLAVE_API:
+     st.error(f"⚠️ Error inesperado al cargar la clave API: {ERROR_CLAVE_API}")
+else:
     st.error("""
         ⚠️ **Error: Clave API de Gemini no encontrada.**
         - Asegúrate de que tu clave API está guardada en los secretos de Streamlit como `GEMINI_API_KEY`.
         - La funcionalidad de IA está deshabilitada.
         """)
-except Exception as e:
-     st.error(f"⚠️ Error inesperado al cargar la clave API: {e}")
 
 # --- Helper Function for API Calls ---
 
-def make_gemini_request(prompt, api_key, model=MODEL_NAME, timeout=DEFAULT_TIMEOUT):
-    """Sends a prompt to the Gemini API via HTTP POST and returns the generated text."""
+@st.cache_resource
+def obtener_sesion_http():
+    """Sesión HTTP única por proceso (pool de conexiones compartido entre todas las sesiones)."""
+    return gemini_client.crear_sesion()
+
+@st.cache_resource
+def obtener_proveedores():
+    """Proveedores de modelos por nombre, cada uno con su pool; Gemini comparte la sesión HTTP del proceso."""
+    return {proveedores.GEMINI: proveedores.ProveedorGemini(API_ENDPOINT_BASE, GEMINI_API_KEY, session=obtener_sesion_http()),
+            **{nombre: proveedores.crear(config) for nombre, config in PROVEEDORES.items()}}
+
+def proveedor_de(servicios, model):
+    """(Proveedor, nombre del modelo en su API) para un modelo "proveedor/modelo" o de Gemini."""
+    nombre, modelo = proveedores.separar(model, PROVEEDORES)
+    return servicios.proveedores[nombre], modelo
+
+@st.cache_resource
+def obtener_cache_respuestas():
+    """Caché de respuestas única por proceso, compartida por todas las sesiones."""
+    return cache_respuestas.CacheRespuestas(CACHE_LLM_DB, cachear_muestreadas=CACHE_LLM_MUESTREADAS)
+
+@st.cache_resource
+def obtener_admision():
+    """Cubos de tokens por modelo y vuelo único, compartidos por todas las sesiones."""
+    return admision.ControlAdmision((LIMITE_POR_MINUTO, LIMITE_RAFAGA), LIMITES_MODELO)
+
+@st.cache_resource
+def obtener_enrutador():
+    """Enrutador de modelos del proceso; observa la duración de cada llamada medida en la telemetría."""
+    enrutador = enrutado.Enrutador(RUTAS_MODELOS, RUTAS_P95, por_defecto=MODEL_NAME)
+    telemetria.REGISTRO.observar(enrutador.registrar)
+    return enrutador
+
+class Servicios(NamedTuple):
+    """Recursos del proceso que usan las llamadas al modelo, ya resueltos.
+
+    Los hilos de trabajos, especulación, precalentado y reposición no llaman a
+    los getters con @st.cache_resource (fuera del hilo del script Streamlit
+    avisa de que falta el ScriptRunContext): reciben estos objetos del script.
+    """
+    proveedores: dict
+    admision: admision.ControlAdmision
+    cache: cache_respuestas.CacheRespuestas
+    enrutador: enrutado.Enrutador
+    indice: similitud.IndiceSimilitud
+    pool_llamadas: ThreadPoolExecutor
+    latencias: dict  # (tipo, modelo) -> plazos.HistorialLatencias
+
+def servicios():
+    """Servicios del proceso; solo desde el hilo del script (o de un getter de recursos)."""
+    return Servicios(obtener_proveedores(), obtener_admision(), obtener_cache_respuestas(), obtener_enrutador(),
+                     obtener_indice_similitud(), obtener_pool_llamadas(), obtener_historiales_latencias())
+
+def modelo_para(servicios, esquema, nivel):
+    """Modelo al que va ahora una llamada con `esquema` en ese nivel; apta para hilos."""
+    return servicios.enrutador.elegir(prompts.tipo_de_llamada(esquema), nivel)
+
+@st.cache_resource
+def iniciar_metricas():
+    """Añade la caché y la cuota a la telemetría y arranca el exportador de Prometheus (una vez por proceso)."""
+    telemetria.REGISTRO.agregar_fuente("cache_llm", lambda: obtener_cache_respuestas().metricas())
+    telemetria.REGISTRO.agregar_fuente("admision", lambda: obtener_admision().metricas())
+    telemetria.REGISTRO.agregar_fuente("impacto_local", lambda: obtener_modelo_impacto().metricas())
+    telemetria.REGISTRO.agregar_fuente("trabajos", lambda: obtener_cola_trabajos().metricas())
+    telemetria.REGISTRO.agregar_fuente("enrutado", lambda: obtener_enrutador().metricas())
+    telemetria.REGISTRO.agregar_fuente("similitud", lambda: dict(obtener_indice_similitud().metricas, **obtener_indice_similitud().tamanos()))
+    if SESIONES:
+        telemetria.REGISTRO.agregar_fuente("sesiones", lambda: dict(obtener_almacen_sesiones().metricas))
+    telemetria.REGISTRO.agregar_fuente("memoria", lambda: metricas_memoria())
+    if RESULTADOS_DB:
+        telemetria.REGISTRO.agregar_fuente("resultados", lambda: dict(obtener_resultados().metricas))
+    return telemetria.iniciar_servidor(METRICAS_PUERTO, telemetria.REGISTRO) if METRICAS_PUERTO else None
+
+iniciar_metricas()
+
+def registrar_fallo(esquema, motivo, model=MODEL_NAME):
+    """Cuenta una respuesta inservible ("parseo" o "validacion") para el tipo de llamada de `esquema`."""
+    telemetria.REGISTRO.registrar_fallo(prompts.tipo_de_llamada(esquema), model, motivo)
+
+def _llamar_modelo(servicios, data, timeout, prioridad=admision.INTERACTIVA, agrupar=True, model=MODEL_NAME):
+    """Texto generado por el proveedor del modelo, dentro de la cuota del modelo.
+
+    Con `agrupar`, una petición idéntica a otra en curso (de cualquier sesión)
+    espera a esa y comparte su respuesta en lugar de pagar otra llamada (ver
+    admision.VueloUnico). El trabajo de fondo espera a la cuota o a la otra
+    llamada sin límite; lo interactivo, hasta `timeout`.
+    Solo la llamada real se mide en la telemetría, no las que esperan a otra.
+    """
+    control = servicios.admision
+    espera = timeout if prioridad == admision.INTERACTIVA else None
+    admitir = functools.partial(control.adquirir, model, prioridad, espera)
+    tipo = prompts.tipo_de_llamada(data.get("generationConfig", {}).get("responseSchema"))
+    proveedor, modelo = proveedor_de(servicios, model)
+
+    def llamada():
+        with telemetria.REGISTRO.medir(tipo, model) as medicion:
+            return proveedor.generar(modelo, data, timeout, admitir, medicion)
+    if not agrupar:
+        return llamada()
+    return control.vuelo.ejecutar(cache_respuestas.clave(model, data), llamada, prioridad, espera)
+
+def _clave_cache(servicios, prompt, esquema, model=MODEL_NAME):
+    """(cache, clave, admitida): `admitida` indica si la petición puede servirse desde la caché.
+
+    Las no admitidas (muestreadas) se guardan igualmente: sirven de reserva si vence el plazo.
+    """
+    cache = servicios.cache
+    payload = gemini_client.payload_texto(prompt, esquema)
+    return cache, cache_respuestas.clave(model, payload), cache.admite(payload)
+
+def _texto_valido(texto, validar):
+    """¿El texto es JSON y supera `validar`? Solo esas respuestas se guardan en caché."""
+    try:
+        return validar(prompts.cargar_json(texto)) is not None
+    except json.JSONDecodeError:
+        return False
+
+def make_gemini_request(prompt, api_key, model=MODEL_NAME, timeout=DEFAULT_TIMEOUT, esquema=None):
+    """Sends a prompt to the model's provider (Gemini API by default) and returns the generated text.
+
+    With `esquema`, asks for structured output (application/json matching that responseSchema).
+    """
     if not GEMINI_AVAILABLE or not api_key:
         st.error("Intento de llamada a Gemini API sin clave válida.")
         return None
 
-    url = f"{API_ENDPOINT_BASE}/{model}:generateContent?key={api_key}"
-    headers = {"Content-Type": "application/json"}
-    data = {
-        "contents": [{
-            "parts": [{"text": prompt}]
-        }],
-        # Optional: Add safety settings or generation config if needed
-        # "safetySettings": [...],
-        # "generationConfig": { "temperature": 0.7, "maxOutputTokens": 8192 }
-    }
+    data = gemini_client.payload_texto(prompt, esquema)
+    # Optional: Add safety settings if needed
+    # data["safetySettings"] = [...]
 
     try:
-        response = requests.post(url, headers=headers, json=data, timeout=timeout)
-        response.raise_for_status() # Raises HTTPError for bad responses (4xx or 5xx)
-
-        response_json = response.json()
-
-        # Navigate the response structure to get the text
-        # Check for candidates and parts وجودهم قبل الوصول إليهم
-        if (candidates := response_json.get("candidates")) and \
-           isinstance(candidates, list) and len(candidates) > 0 and \
-           (content := candidates[0].get("content")) and \
-           isinstance(content, dict) and \
-           (parts := content.get("parts")) and \
-           isinstance(parts, list) and len(parts) > 0 and \
-           (text := parts[0].get("text")):
-            return text
-        else:
-            st.error("❌ Respuesta de Gemini recibida, pero la estructura JSON es inesperada o no contiene texto.")
-            st.json(response_json) # Show the unexpected structure
-            return None
+        # Reintenta 429/5xx con backoff; lanza HTTPError si el error persiste
+        return _llamar_modelo(servicios(), data, timeout, model=model)
+    except Exception as e:
+        mostrar_error_gemini(e)
+        return None
 
-    except requests.exceptions.RequestException as e:
+def mostrar_error_gemini(e):
+    """Muestra al usuario el error de una llamada a Gemini según su tipo."""
+    if isinstance(e, admision.CuotaAgotada):
+        st.error("⏳ Hay demasiadas peticiones a Gemini en este momento. Espera unos segundos e inténtalo de nuevo.")
+    elif isinstance(e, json_incremental.JSONMalformado):
+        st.error(f"❌ La respuesta de Gemini no tiene el formato JSON esperado; se abortó la petición: {e}")
+    elif isinstance(e, gemini_client.RespuestaInesperada):
+        st.error("❌ Respuesta de Gemini recibida, pero la estructura JSON es inesperada o no contiene texto.")
+        st.json(e.response_json) # Show the unexpected structure
+    elif isinstance(e, requests.exceptions.HTTPError):
+        st.error(f"❌ Error HTTP {e.response.status_code} de Gemini API: {e.response.text}")
+    elif isinstance(e, json.JSONDecodeError): # Antes que RequestException: requests la subclasifica de ambas
+         st.error(f"❌ Error al decodificar la respuesta JSON principal de Gemini API: {e}")
+         st.text(f"Respuesta recibida (no JSON): {e.doc}")
+    elif isinstance(e, requests.exceptions.RequestException):
         st.error(f"❌ Error de Red/Conexión al llamar a Gemini API: {e}")
+    else:
+        st.error(f"❌ Error inesperado durante la llamada a Gemini API: {e}")
+
+def make_gemini_stream_request(prompt, api_key, al_evento=None, model=MODEL_NAME, timeout=DEFAULT_TIMEOUT, esquema=None):
+    """Como make_gemini_request, pero con streamGenerateContent.
+
+    El JSON se analiza según llega: cada campo completo se pasa a `al_evento`
+    y, si el texto deja de ser el JSON esperado, se aborta la descarga en ese
+    momento. Devuelve el texto completo o None si hubo error (ya mostrado).
+    """
+    if not GEMINI_AVAILABLE or not api_key:
+        st.error("Intento de llamada a Gemini API sin clave válida.")
         return None
-    except requests.exceptions.HTTPError as e:
-        st.error(f"❌ Error HTTP {e.response.status_code} de Gemini API: {e.response.text}")
+
+    parser = json_incremental.ParserJSONIncremental()
+    data = gemini_client.payload_texto(prompt, esquema)
+    admitir = functools.partial(obtener_admision().adquirir, model, admision.INTERACTIVA, timeout)
+    proveedor, modelo = proveedor_de(servicios(), model)
+
+    try:
+        with telemetria.REGISTRO.medir(prompts.tipo_de_llamada(esquema), model) as medicion, \
+             contextlib.closing(proveedor.stream(modelo, data, timeout, admitir, medicion)) as fragmentos:
+            for fragmento in fragmentos:
+                for evento in parser.alimentar(fragmento):
+                    if al_evento: al_evento(evento)
+        parser.resultado() # Lanza JSONMalformado si el stream terminó a medias
+        return parser.texto
+    except Exception as e:
+        if isinstance(e, json_incremental.JSONMalformado):
+            registrar_fallo(esquema, "parseo", model)
+        mostrar_error_gemini(e)
+        if parser.texto: st.text_area("Contenido recibido:", parser.texto, height=150)
         return None
-    except json.JSONDecodeError as e:
-         st.error(f"❌ Error al decodificar la respuesta JSON principal de Gemini API: {e}")
-         st.text(f"Respuesta recibida (no JSON): {response.text}")
-         return None
+
+def vista_progresiva():
+    """Callback para make_gemini_stream_request que pinta cada campo en cuanto llega."""
+    contenedor = st.container()
+    def al_evento(evento):
+        with contenedor:
+            if evento[0] == "campo":
+                _, clave, valor = evento
+                if clave == "analisis": st.info(valor)
+                elif clave == "consecuencias_texto": st.warning(valor)
+                elif clave in ("pregunta", "siguiente_pregunta"): st.markdown(f"**{valor}**")
+            else:
+                _, clave, _, valor = evento
+                if clave in ("opciones", "siguientes_opciones"): st.markdown(f"- {valor}")
+                elif clave is None and isinstance(valor, dict): st.markdown(f"✅ {valor.get('titulo', '')}")
+    return al_evento
+
+# --- Plazos de Latencia y Peticiones Duplicadas ---
+# Presupuesto por tipo de llamada interactiva (segundos). Pasado el p90 observado
+# se lanza un duplicado; si el plazo vence, se usa la caché o una plantilla.
+PRESUPUESTOS_LATENCIA = {"escenarios": 90, "pregunta": 20, "evaluacion": 35, "turno": 40}
+HEDGE_WORKERS = 32 # Hilos para intentos en vuelo (dos por llamada como máximo)
+
+@st.cache_resource
+def obtener_pool_llamadas():
+    return ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="llamadas")
+
+def _tipo_con_plazo(tipo, prioridad):
+    """`tipo` para lo que espera el jugador (INTERACTIVA); el trabajo de fondo no tiene plazo."""
+    return tipo if prioridad == admision.INTERACTIVA else None
+
+@st.cache_resource
+def obtener_historiales_latencias():
+    """Latencias recientes por (tipo de llamada, modelo), compartidas por el proceso."""
+    return collections.defaultdict(plazos.HistorialLatencias)
+
+def _texto_con_plazo(servicios, prompt, tipo, timeout, esquema, validar, reserva, clave,
+                     model=MODEL_NAME, prioridad=admision.INTERACTIVA):
+    """Texto generado con presupuesto de latencia y petición duplicada tras el p90; apta para hilos.
+
+    Devuelve (texto, de_reserva). Al vencer el plazo se usa la última respuesta
+    válida cacheada para este prompt o, si no la hay, el texto de `reserva()`
+    (None si tampoco hay reserva). Los errores de la API se propagan.
+    """
+    presupuesto = PRESUPUESTOS_LATENCIA[tipo]
+    historial = servicios.latencias[(tipo, model)]
+    data = gemini_client.payload_texto(prompt, esquema)
+    numero_intento = itertools.count()
+    # Solo el primer intento se agrupa con peticiones idénticas: el duplicado debe ser una llamada nueva
+    intento = lambda: _llamar_modelo(servicios, data, min(timeout, presupuesto), prioridad,
+                                     agrupar=next(numero_intento) == 0, model=model)
+    es_valido = (lambda texto: bool(texto) and _texto_valido(texto, validar)) if validar else bool
+    try:
+        texto, segundos = plazos.ejecutar_con_cobertura(
+            intento, presupuesto, plazos.retraso_cobertura(historial, presupuesto), servicios.pool_llamadas, es_valido)
+    except plazos.PlazoVencido:
+        historial.registrar(presupuesto) # Cuenta como lenta: eleva el p90 y adelanta duplicados futuros
+        texto = servicios.cache.obtener(clave) if clave else None
+        if texto is None and reserva:
+            texto = json.dumps(reserva(), ensure_ascii=False)
+        return texto, True
+    historial.registrar(segundos)
+    return texto, False
+
+def make_gemini_request_con_plazo(prompt, tipo, timeout, esquema, validar, reserva, clave, model=MODEL_NAME):
+    """make_gemini_request con plazo (ver _texto_con_plazo), avisando al jugador si se usa la reserva."""
+    if not GEMINI_AVAILABLE or not GEMINI_API_KEY:
+        st.error("Intento de llamada a Gemini API sin clave válida.")
+        return None, False
+
+    try:
+        texto, de_reserva = _texto_con_plazo(servicios(), prompt, tipo, timeout, esquema, validar, reserva, clave, model)
     except Exception as e:
-        st.error(f"❌ Error inesperado durante la llamada a Gemini API: {e}")
+        mostrar_error_gemini(e)
+        return None, False
+    if de_reserva and texto is not None:
+        st.warning(f"⏱️ Gemini no respondió en {PRESUPUESTOS_LATENCIA[tipo]} s; se usa una respuesta de reserva.")
+    elif de_reserva:
+        st.error(f"❌ Gemini no respondió en {PRESUPUESTOS_LATENCIA[tipo]} s.")
+    return texto, de_reserva
+
+def solicitar_texto_gemini(prompt, timeout=DEFAULT_TIMEOUT, esquema=None, validar=None, tipo=None, reserva=None, model=None):
+    """make_gemini_request o, en modo streaming, su variante con renderizado progresivo.
+
+    Con `validar`, se consulta primero la caché de respuestas y la respuesta nueva
+    se guarda en ella si supera la validación. Con `tipo` (sin streaming), la
+    llamada tiene plazo: ver make_gemini_request_con_plazo. Sin `model`, lo
+    elige el enrutador para el nivel de la partida.
+    """
+    model = model or modelo_para(servicios(), esquema, st.session_state.get('nivel_dificultad'))
+    cache, clave, admitida = _clave_cache(servicios(), prompt, esquema, model) if validar else (None, None, False)
+    if admitida and (texto := cache.obtener(clave)) is not None:
+        return texto
+    de_reserva = False
+    if st.session_state.get('modo_streaming'):
+        texto = make_gemini_stream_request(prompt, GEMINI_API_KEY, vista_progresiva(), model, timeout, esquema)
+    elif tipo:
+        texto, de_reserva = make_gemini_request_con_plazo(prompt, tipo, timeout, esquema, validar, reserva, clave, model)
+    else:
+        texto = make_gemini_request(prompt, GEMINI_API_KEY, model, timeout, esquema)
+    if clave and texto and not de_reserva and _texto_valido(texto, validar):
+        cache.guardar(clave, texto)
+    return texto
+
+def solicitar_json_validado(prompt, esquema, validar, timeout=DEFAULT_TIMEOUT, tipo=None, reserva=None):
+    """Pide una respuesta estructurada con `esquema` y la valida con `validar`.
+
+    Si la respuesta no es JSON o no supera la validación, se repite la petición
+    una sola vez indicando el fallo. Devuelve None si falló la API (error ya
+    mostrado) o (parsed_response, validada), con `validada` None si la
+    repetición tampoco fue válida.
+    """
+    model = modelo_para(servicios(), esquema, st.session_state.get('nivel_dificultad'))
+    generated_text = solicitar_texto_gemini(prompt, timeout, esquema, validar, tipo, reserva, model)
+    if not generated_text:
+        return None
+    try:
+        parsed_response = prompts.cargar_json(generated_text)
+    except json.JSONDecodeError:
+        parsed_response, problema = None, "no es JSON válido"
+        registrar_fallo(esquema, "parseo", model)
+    else:
+        if (validada := validar(parsed_response)) is not None:
+            return parsed_response, validada
+        problema = "no cumple el esquema pedido"
+        registrar_fallo(esquema, "validacion", model)
+
+    # Un único reintento automático; ahora sí se muestran los errores de formato
+    generated_text = solicitar_texto_gemini(prompts.prompt_correccion(prompt, problema), timeout, esquema, validar, tipo, reserva, model)
+    if not generated_text:
+        return parsed_response, None
+    parsed_response = parse_gemini_json_response(generated_text)
+    if (validada := validar(parsed_response)) is None:
+        registrar_fallo(esquema, "parseo" if parsed_response is None else "validacion", model)
+    return parsed_response, validada
+
+def _llamada_json_sin_ui(servicios, prompt, timeout, esquema=None, validar=None, model=MODEL_NAME,
+                        prioridad=admision.FONDO, tipo=None, reserva=None):
+    """Como solicitar_texto_gemini + parse, pero apta para hilos: sin st.*, None ante cualquier error.
+
+    Con `tipo`, la llamada tiene plazo, como en primer plano (ver _texto_con_plazo).
+    """
+    cache, clave, admitida = _clave_cache(servicios, prompt, esquema, model) if validar else (None, None, False)
+    try:
+        if not admitida or (texto := cache.obtener(clave)) is None:
+            de_reserva = False
+            if tipo:
+                texto, de_reserva = _texto_con_plazo(servicios, prompt, tipo, timeout, esquema, validar, reserva,
+                                                     clave, model, prioridad)
+            else:
+                texto = _llamar_modelo(servicios, gemini_client.payload_texto(prompt, esquema), timeout, prioridad, model=model)
+            if texto is None:
+                return None
+            if clave and not de_reserva and _texto_valido(texto, validar):
+                cache.guardar(clave, texto)
+        return prompts.cargar_json(texto)
+    except json.JSONDecodeError:
+        registrar_fallo(esquema, "parseo", model)
+        return None
+    except Exception:
         return None
 
-# --- Helper Function to Parse Expected JSON Content --- (Unchanged)
+def _solicitud_validada_sin_ui(servicios, prompt, esquema, validar, timeout=DEFAULT_TIMEOUT, reintentar=True, nivel=None,
+                               prioridad=admision.FONDO, tipo=None, reserva=None):
+    """Versión sin interfaz de solicitar_json_validado: el registro validado o None.
+
+    Solo se repite la petición si llegó JSON que no validó (no tras un fallo de la API).
+    El modelo lo elige el enrutador para `nivel` (los hilos no ven la sesión). Lo que
+    espera el jugador va con prioridad INTERACTIVA y con `tipo`, para tener plazo.
+    """
+    model = modelo_para(servicios, esquema, nivel)
+    llamada = functools.partial(_llamada_json_sin_ui, servicios, timeout=timeout, esquema=esquema, validar=validar,
+                                model=model, prioridad=prioridad, tipo=tipo, reserva=reserva)
+    parsed_response = llamada(prompt)
+    if (validada := validar(parsed_response)) is not None or parsed_response is None:
+        return validada
+    registrar_fallo(esquema, "validacion", model)
+    if not reintentar:
+        return None
+    parsed_response = llamada(prompts.prompt_correccion(prompt, "no cumple el esquema pedido"))
+    if (validada := validar(parsed_response)) is None and parsed_response is not None:
+        registrar_fallo(esquema, "validacion", model)
+    return validada
+
+# --- Helper Function to Parse Expected JSON Content ---
 def parse_gemini_json_response(response_text):
     """Intenta parsear JSON de la respuesta de Gemini, limpiando posibles decoradores."""
     if not response_text: return None
     try:
-        # Gemini a veces envuelve el JSON en ```json ... ```
-        text_to_parse = response_text.strip()
-        if text_to_parse.startswith("```json"):
-            text_to_parse = text_to_parse[7:-3].strip() # Quita ```json y ```
-        elif text_to_parse.startswith("```"):
-             text_to_parse = text_to_parse[3:-3].strip() # Quita ```
-        return json.loads(text_to_parse)
+        return prompts.cargar_json(response_text)
     except json.JSONDecodeError as e:
         st.error(f"❌ Error al decodificar el contenido JSON esperado de Gemini: {e}")
         st.text_area("Contenido recibido (no es el JSON esperado):", response_text, height=150)
@@ -106,49 +517,33 @@ def parse_gemini_json_response(response_text):
         return None
 
 # --- Funciones Adaptadas para Usar `requests` ---
+# (Los prompts y la validación viven en prompts.py; aquí se añade la interfaz)
 
 def generar_escenario_gemini(nivel):
     """ Genera 5 escenarios únicos para el nivel dado usando Gemini via HTTP """
-    prompt = f"""
-    Eres un experto en ética empresarial y diseño de simulaciones interactivas.
-    Genera EXACTAMENTE 5 escenarios únicos y distintos de crisis empresariales en español para un nivel de dificultad '{nivel}'.
-    Cada escenario debe incluir:
-    - 'id': Un identificador único y corto (ej: 'p1', 'p2' para principiante; 'i1', 'i2' para intermedio; 'a1', 'a2' para avanzado). Usa el prefijo correcto para el nivel ({nivel[0].lower()}).
-    - 'titulo': Un título corto, atractivo y descriptivo en español (máx 10 palabras).
-    - 'trasfondo': Una descripción detallada (100-150 palabras) de la empresa ficticia, el contexto del mercado, el inicio de la crisis y el rol específico que asume el jugador en la simulación. Debe estar en español.
-    - 'estado_inicial': Un diccionario fijo: {{"financiera": 0, "reputacion": 0, "laboral": 0}}.
-
-    Asegúrate de que los escenarios sean apropiados para la dificultad indicada (Principiante: dilemas directos; Intermedio: ambigüedad, pros/contras; Avanzado: sistémico, multi-agente, largo plazo).
-
-    Presenta la respuesta final EXCLUSIVAMENTE como una lista JSON válida de estos 5 diccionarios. No incluyas ningún otro texto antes o después de la lista JSON.
-    """
+    prompt = prompts.prompt_escenarios(nivel)
     with st.spinner(f"🧠 Generando escenarios ({nivel})..."):
-        generated_text = make_gemini_request(prompt, GEMINI_API_KEY)
-        if not generated_text:
+        respuesta = solicitar_json_validado(prompt, prompts.ESQUEMA_ESCENARIOS,
+                                            lambda parsed: prompts.validar_lote_escenarios(parsed, nivel),
+                                            tipo="escenarios")
+        if not respuesta:
             return [] # Error manejado en make_gemini_request
 
-        parsed_response = parse_gemini_json_response(generated_text)
-
-        # Resto de la validación (igual que antes)
-        if parsed_response and isinstance(parsed_response, list) and len(parsed_response) == 5:
-                validated_scenarios = []
-                for i, sc in enumerate(parsed_response):
-                    if isinstance(sc, dict) and all(k in sc for k in ['id', 'titulo', 'trasfondo', 'estado_inicial']):
-                        # Asegurar IDs únicos si Gemini falla
-                        if 'id' not in sc or not sc['id']:
-                                sc['id'] = f"{nivel[0].lower()}{i+1}_{random.randint(1000,9999)}"
-                        # Asegurar que el ID empiece con la letra correcta
-                        if not sc['id'].startswith(nivel[0].lower()):
-                            sc['id'] = f"{nivel[0].lower()}{sc['id'].lstrip('pia')}" # Intenta corregir prefijo
-
-                        if not isinstance(sc['estado_inicial'], dict) or not all(k in sc['estado_inicial'] for k in ['financiera', 'reputacion', 'laboral']):
-                                sc['estado_inicial'] = {"financiera": 0, "reputacion": 0, "laboral": 0} # Corregir si es necesario
-                        validated_scenarios.append(sc)
-                    else:
-                        st.warning(f"Escenario {i+1} recibido de Gemini no tiene el formato esperado. Omitiendo.")
+        parsed_response, _ = respuesta
+        resultado = prompts.validar_escenarios(parsed_response, nivel)
+
+        if resultado:
+                validated_scenarios, omitidos = resultado
+                for i in omitidos:
+                    st.warning(f"Escenario {i+1} recibido de Gemini no tiene el formato esperado. Omitiendo.")
+                # Los omitidos y los casi repetidos se piden de nuevo, sin repetir el lote entero
+                validated_scenarios = escenarios_sin_repetir(servicios(), nivel, validated_scenarios, admision.INTERACTIVA)
                 if len(validated_scenarios) == 5:
                     st.success(f"✅ ¡5 escenarios ({nivel}) generados!")
                     return validated_scenarios
+                elif validated_scenarios:
+                    st.warning(f"Solo {len(validated_scenarios)} escenarios nuevos: el resto se parecía demasiado a otros ya generados.")
+                    return validated_scenarios
                 else:
                     st.error(f"Error: Se esperaban 5 escenarios válidos, pero se obtuvieron {len(validated_scenarios)}. Verifica el prompt y la respuesta de Gemini.")
                     return []
@@ -162,30 +557,23 @@ def generar_escenario_gemini(nivel):
 
 def generar_pregunta_y_opciones_gemini(contexto, historial, estado, nivel, numero_pregunta):
     """ Genera la siguiente pregunta y opciones usando Gemini via HTTP """
-    historial_str = json.dumps(historial[-2:], ensure_ascii=False) # Últimas 2 decisiones
-
-    prompt = f"""
-    Actúa como el director experto de una simulación interactiva de crisis empresarial en español.
-    Nivel: {nivel}. Pregunta: {numero_pregunta}/10. Estado: Fin={estado['financiera']}, Rep={estado['reputacion']}, Lab={estado['laboral']}.
-    Contexto: {contexto}
-    Historial reciente: {historial_str}
-
-    Genera la SIGUIENTE pregunta crítica (concisa, relevante, dilema claro) y EXACTAMENTE 4 opciones de respuesta (distintas, plausibles, prefijo A/B/C/D).
-
-    Presenta la respuesta final EXCLUSIVAMENTE como un objeto JSON válido con claves 'pregunta' (string) y 'opciones' (lista de 4 strings). No incluyas texto adicional.
-    """
+    prompt = prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta)
     with st.spinner(f"🧠 Generando pregunta {numero_pregunta}..."):
-        generated_text = make_gemini_request(prompt, GEMINI_API_KEY)
-        if not generated_text:
+        respuesta = solicitar_json_validado(prompt, prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta, tipo="pregunta",
+                                            reserva=lambda: prompts.reserva_pregunta(numero_pregunta))
+        if not respuesta:
             return "Pregunta no disponible (Error API)", []
 
-        parsed_response = parse_gemini_json_response(generated_text)
-
-        if parsed_response and isinstance(parsed_response, dict) and \
-           'pregunta' in parsed_response and 'opciones' in parsed_response and \
-           isinstance(parsed_response['opciones'], list) and len(parsed_response['opciones']) == 4:
-            # Validar prefijos A) B) C) D) si es necesario
-            return parsed_response['pregunta'], parsed_response['opciones']
+        parsed_response, validada = respuesta
+        if validada and pregunta_repetida(servicios(), espacio_preguntas(), validada.pregunta, historial):
+            # Casi igual a una ya planteada: se pide otra una vez; si tampoco sirve, se mantiene esta
+            prompt = prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta,
+                                             [decision['pregunta'] for decision in historial])
+            otra = solicitar_json_validado(prompt, prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta, tipo="pregunta")
+            if otra and otra[1] and not pregunta_repetida(servicios(), espacio_preguntas(), otra[1].pregunta, historial):
+                validada = otra[1]
+        if validada:
+            return validada
         else:
             st.error("Error: Formato inesperado para pregunta/opciones.")
             if parsed_response: st.json(parsed_response)
@@ -194,46 +582,525 @@ def generar_pregunta_y_opciones_gemini(contexto, historial, estado, nivel, numer
 
 def evaluar_decision_gemini(contexto, pregunta, opcion_elegida, estado_actual, nivel, numero_pregunta):
     """ Evalúa la decisión, genera análisis/consecuencias y nuevo contexto via HTTP """
-    prompt = f"""
-    Eres un analista experto evaluando una decisión en una simulación en español.
-    Nivel: {nivel}. Pregunta respondida: {numero_pregunta}/10.
-    Contexto ANTES: {contexto}
-    Pregunta: {pregunta}
-    Decisión: {opcion_elegida}
-    Estado ANTES: Fin={estado_actual['financiera']}, Rep={estado_actual['reputacion']}, Lab={estado_actual['laboral']}.
-
-    Realiza estas tareas y presenta el resultado EXCLUSIVAMENTE como un único objeto JSON válido con claves 'analisis', 'consecuencias_texto', 'impacto', 'nuevo_contexto':
-    1.  'analisis': Análisis conciso (2-3 frases) de la decisión (implicaciones éticas/estratégicas).
-    2.  'consecuencias_texto': Descripción breve (1-2 frases) de efectos inmediatos probables.
-    3.  'impacto': Diccionario JSON con impacto numérico MÁS PROBABLE en 'financiera', 'reputacion', 'laboral' (enteros, rango -3 a +3 típico). E.g., {{"financiera": -1, "reputacion": 0, "laboral": -1}}.
-    4.  'nuevo_contexto': Nuevo párrafo de contexto (50-100 palabras) describiendo la situación DESPUÉS de la decisión y consecuencias.
-
-    No incluyas texto adicional fuera del objeto JSON.
-    """
+    prompt = prompts.prompt_evaluacion(contexto, pregunta, opcion_elegida, estado_actual, nivel, numero_pregunta)
     with st.spinner(f"🧠 Analizando decisión {numero_pregunta}..."):
          # Usar un timeout más largo para evaluación si es necesario
-        generated_text = make_gemini_request(prompt, GEMINI_API_KEY, timeout=150)
-        if not generated_text:
-            return "Análisis no disponible (error API).", "Consecuencias no disponibles (error API).", f"{contexto}\n\n(Error al procesar la última decisión).", {"financiera": 0, "reputacion": 0, "laboral": 0}
-
-        parsed_response = parse_gemini_json_response(generated_text)
-
-        if parsed_response and isinstance(parsed_response, dict) and \
-           all(k in parsed_response for k in ['analisis', 'consecuencias_texto', 'impacto', 'nuevo_contexto']) and \
-           isinstance(parsed_response['impacto'], dict) and \
-           all(k in parsed_response['impacto'] for k in ['financiera', 'reputacion', 'laboral']):
-            # Validar tipos de impacto
-            impacto = parsed_response['impacto']
-            impacto_validado = {
-                'financiera': int(impacto.get('financiera', 0)),
-                'reputacion': int(impacto.get('reputacion', 0)),
-                'laboral': int(impacto.get('laboral', 0))
-            }
-            return parsed_response['analisis'], parsed_response['consecuencias_texto'], parsed_response['nuevo_contexto'], impacto_validado
+        respuesta = solicitar_json_validado(prompt, prompts.ESQUEMA_EVALUACION, prompts.validar_evaluacion,
+                                            timeout=EVALUATION_TIMEOUT, tipo="evaluacion",
+                                            reserva=lambda: prompts.reserva_evaluacion(contexto))
+        if not respuesta:
+            return prompts.evaluacion_fallida(contexto, "error API")
+
+        parsed_response, validada = respuesta
+        if validada:
+            return validada
         else:
             st.error("Error: Formato inesperado para la evaluación.")
             if parsed_response: st.json(parsed_response)
-            return "Análisis no disponible (error formato).", "Consecuencias no disponibles (error formato).", f"{contexto}\n\n(Error al procesar la última decisión).", {"financiera": 0, "reputacion": 0, "laboral": 0}
+            return prompts.evaluacion_fallida(contexto, "error formato")
+
+def jugar_turno_gemini(contexto, pregunta, opcion_elegida, estado_actual, historial, nivel, numero_pregunta):
+    """ Evalúa la decisión y genera la siguiente pregunta en una sola llamada.
+
+    Devuelve (analisis, consecuencias_texto, nuevo_contexto, impacto, siguiente), donde
+    `siguiente` es (pregunta, opciones) o None si hay que generarla aparte: en la última
+    pregunta o si la respuesta fusionada no supera la validación (se recurre entonces
+    al camino de dos llamadas).
+    """
+    if numero_pregunta >= motor.MAX_PREGUNTAS:
+        return *evaluar_decision_gemini(contexto, pregunta, opcion_elegida, estado_actual, nivel, numero_pregunta), None
+
+    prompt = prompts.prompt_turno(contexto, pregunta, opcion_elegida, estado_actual, historial, nivel, numero_pregunta)
+    with st.spinner(f"🧠 Analizando decisión {numero_pregunta}..."):
+        # Sin reintento automático: si no valida, el propio camino de dos llamadas es la recuperación
+        model = modelo_para(servicios(), prompts.ESQUEMA_TURNO, nivel)
+        generated_text = solicitar_texto_gemini(prompt, timeout=EVALUATION_TIMEOUT, esquema=prompts.ESQUEMA_TURNO,
+                                                validar=prompts.validar_turno, tipo="turno",
+                                                reserva=lambda: prompts.reserva_turno(contexto, numero_pregunta), model=model)
+        if not generated_text:
+            return *prompts.evaluacion_fallida(contexto, "error API"), None
+        try:
+            turno = prompts.validar_turno(prompts.cargar_json(generated_text))
+            if not turno: registrar_fallo(prompts.ESQUEMA_TURNO, "validacion", model)
+        except json.JSONDecodeError:
+            turno = None
+            registrar_fallo(prompts.ESQUEMA_TURNO, "parseo", model)
+
+    if turno:
+        evaluacion, siguiente = turno
+        return *evaluacion, siguiente
+    # Respuesta fusionada inválida: evaluar por separado (la pregunta se generará después)
+    return *evaluar_decision_gemini(contexto, pregunta, opcion_elegida, estado_actual, nivel, numero_pregunta), None
+
+
+# --- Escenarios y Preguntas sin Repetir ---
+# Los escenarios generados (de todos los niveles) y las preguntas de cada
+# partida pasan por un índice de casi-duplicados (similitud.py): lo que se
+# parece demasiado a algo ya visto se descarta y solo eso se vuelve a pedir.
+UMBRAL_ESCENARIOS = 0.5
+UMBRAL_PREGUNTAS = 0.6
+INTENTOS_SIN_REPETIR = 2  # Peticiones extra para sustituir los escenarios repetidos de un lote
+
+@st.cache_resource
+def obtener_indice_similitud():
+    """Índice único por proceso; los escenarios se guardan en disco, las preguntas solo en memoria."""
+    return similitud.IndiceSimilitud(SIMILITUD_DB or None)
+
+def escenarios_sin_repetir(servicios, nivel, escenarios, prioridad=admision.FONDO):
+    """Los escenarios del lote que no se parecen a ninguno ya generado, pidiendo de nuevo solo los que faltan.
+
+    Apta para hilos. Tras INTENTOS_SIN_REPETIR peticiones devuelve los que haya, aunque sean menos de 5.
+    """
+    indice, aceptados, vistos = servicios.indice, [], []
+    for intento in range(INTENTOS_SIN_REPETIR + 1):
+        for escenario in escenarios or []:
+            vistos.append(escenario['titulo'])
+            if len(aceptados) < biblioteca_escenarios.LOTE and not indice.incluir_si_nuevo(
+                    "escenarios", f"{nivel}:{escenario['titulo']}", f"{escenario['titulo']}. {escenario['trasfondo']}",
+                    UMBRAL_ESCENARIOS, persistir=True):
+                aceptados.append(escenario)
+        if (faltan := biblioteca_escenarios.LOTE - len(aceptados)) == 0 or intento == INTENTOS_SIN_REPETIR:
+            break
+        escenarios = _solicitud_validada_sin_ui(servicios, prompts.prompt_escenarios(nivel, faltan, vistos),
+                                                prompts.esquema_escenarios(faltan),
+                                                lambda parsed: prompts.validar_lote_escenarios(parsed, nivel, faltan),
+                                                nivel=nivel, prioridad=prioridad, tipo=_tipo_con_plazo("escenarios", prioridad))
+    return aceptados
+
+def espacio_preguntas():
+    """Espacio del índice con las preguntas de la partida de esta pestaña."""
+    return f"preguntas:{_id_sesion()}"
+
+def pregunta_repetida(servicios, espacio, texto, historial):
+    """Coincidencia de `texto` con una pregunta ya planteada en la partida, o None; apta para hilos.
+
+    El espacio se completa con el historial en cada consulta, así que sirve también tras reanudar la partida.
+    """
+    indice = servicios.indice
+    for decision in historial:
+        indice.incluir(espacio, decision['numero'], decision['pregunta'])
+    return indice.buscar(espacio, texto, UMBRAL_PREGUNTAS)
+
+
+# --- Biblioteca de Escenarios Compartida ---
+
+def _generar_escenarios_sin_ui(servicios, nivel, prioridad=admision.FONDO):
+    """Hasta 5 escenarios validados y no repetidos, o None: para el hilo de reposición o un trabajo de la sesión."""
+    escenarios = _solicitud_validada_sin_ui(servicios, prompts.prompt_escenarios(nivel), prompts.ESQUEMA_ESCENARIOS,
+                                            lambda parsed: prompts.validar_lote_escenarios(parsed, nivel), nivel=nivel,
+                                            prioridad=prioridad, tipo=_tipo_con_plazo("escenarios", prioridad))
+    return escenarios and escenarios_sin_repetir(servicios, nivel, escenarios, prioridad)
+
+@st.cache_resource
+def obtener_biblioteca():
+    """Biblioteca única por proceso; si hay API, arranca su hilo de reposición."""
+    biblioteca = biblioteca_escenarios.BibliotecaEscenarios(ESCENARIOS_DB)
+    if GEMINI_AVAILABLE:
+        biblioteca.iniciar_reposicion(NIVELES_DIFICULTAD, functools.partial(_generar_escenarios_sin_ui, servicios()))
+    return biblioteca
+
+def _resolver_escenario(escenario_id):
+    """Escenario de un id que el registro ya descartó: del paquete o de la biblioteca."""
+    if paquete := obtener_paquete():
+        for nivel in NIVELES_DIFICULTAD:
+            if escenario := next((e for e in paquete.escenarios(nivel) if e.get('id') == escenario_id), None):
+                return escenario
+    return obtener_biblioteca().obtener(escenario_id)
+
+@st.cache_resource
+def obtener_registro_escenarios():
+    """Escenarios internados del proceso: cada sesión guarda solo sus ids (ver memoria.py)."""
+    return memoria.RegistroEscenarios(_resolver_escenario)
+
+def escenarios_de_sesion(nivel):
+    """Escenarios del nivel que la sesión tiene listados, como registros compartidos del proceso."""
+    registro = obtener_registro_escenarios()
+    escenarios = []
+    for entrada in st.session_state.cache_escenarios.get(nivel, []):
+        # Las partidas guardadas antes de internar los escenarios traen el escenario entero
+        escenario = registro.internar(entrada) if isinstance(entrada, dict) else registro.obtener(entrada)
+        if escenario is not None:
+            escenarios.append(escenario)
+    return escenarios
+
+def cargar_escenarios(nivel):
+    """Escenarios para la sesión: del paquete o la biblioteca al instante o, si no hay, generándolos ahora.
+
+    Devuelve None mientras el lote se genera en segundo plano (la espera ya se muestra).
+    """
+    if (paquete := obtener_paquete()) and (escenarios := paquete.escenarios(nivel)):
+        return escenarios
+    biblioteca = obtener_biblioteca()
+    if escenarios := biblioteca.tomar_lote(nivel):
+        return escenarios
+    if not GEMINI_AVAILABLE:
+        return []
+    # Biblioteca aún vacía para este nivel (primer arranque): generar y compartir el lote
+    if en_segundo_plano():
+        trabajo = enviar_trabajo(("escenarios", nivel), _generar_escenarios_sin_ui, servicios(), nivel, admision.INTERACTIVA)
+        if not trabajo.terminado():
+            esperar_trabajo(trabajo, f"Generando escenarios ({nivel})...")
+            return None
+        escenarios = recoger_trabajo(trabajo)
+    else:
+        escenarios = generar_escenario_gemini(nivel)
+    return biblioteca.agregar(nivel, escenarios, servidos=True) if escenarios else []
+
+
+# --- Precalentado de la Primera Pregunta ---
+# En cuanto se listan los escenarios de un nivel, su pregunta 1 se genera en
+# segundo plano y se anota en la biblioteca, así "Iniciar Simulación" es inmediato.
+PRECALENTADO_WORKERS = 4
+
+@st.cache_resource
+def obtener_precalentador():
+    """Pool y trabajos en curso por id de escenario, compartidos por todo el proceso."""
+    return ThreadPoolExecutor(max_workers=PRECALENTADO_WORKERS, thread_name_prefix="precalentado"), {}, threading.Lock()
+
+def _precalentar_primera_pregunta(servicios, biblioteca, registro, escenario, nivel):
+    prompt = prompts.prompt_pregunta(motor.contexto_inicial(escenario), [], motor.estado_inicial(escenario), nivel, 1)
+    pregunta = _solicitud_validada_sin_ui(servicios, prompt, prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta, nivel=nivel)
+    if pregunta:
+        biblioteca.anotar(escenario['id'], primera_pregunta=pregunta._asdict())
+        registro.internar(dict(escenario, primera_pregunta=pregunta._asdict()))
+    return pregunta
+
+def precalentar_primeras_preguntas(nivel, escenarios):
+    """Encola la pregunta 1 de los escenarios que aún no la tienen (una vez por escenario y proceso)."""
+    if not GEMINI_AVAILABLE:
+        return
+    pool, en_curso, lock = obtener_precalentador()
+    recursos = servicios(), obtener_biblioteca(), obtener_registro_escenarios()
+    with lock:
+        for escenario in escenarios:
+            escenario_id = escenario.get('id')
+            if 'primera_pregunta' in escenario or escenario_id in en_curso:
+                continue
+            futuro = pool.submit(_precalentar_primera_pregunta, *recursos, escenario, nivel)
+            en_curso[escenario_id] = futuro
+            futuro.add_done_callback(lambda _, escenario_id=escenario_id: en_curso.pop(escenario_id, None))
+
+def primera_pregunta_precalentada(escenario):
+    """(pregunta, opciones) ya generadas para el escenario, o None; no espera a las que siguen en curso."""
+    if not (datos := escenario.get('primera_pregunta')):
+        datos = (obtener_biblioteca().obtener(escenario.get('id')) or {}).get('primera_pregunta')
+    return prompts.validar_pregunta(datos)
+
+def precalentado_en_curso(escenario):
+    """Futuro de la pregunta 1 del escenario si se está generando ahora mismo, o None."""
+    _, en_curso, _ = obtener_precalentador()
+    return en_curso.get(escenario.get('id'))
+
+
+# --- Paquete de Escenarios ---
+# Mientras la partida sigue dentro del árbol precompilado, cada turno es una
+# búsqueda por índice en el paquete; al salir de él se vuelve a Gemini.
+
+@st.cache_resource
+def obtener_paquete():
+    """Paquete del proceso (un solo mmap para todas las sesiones), o None si no se configuró."""
+    return paquete_escenarios.PaqueteEscenarios(PAQUETE) if PAQUETE else None
+
+def en_paquete():
+    return st.session_state.get('nodo_paquete') is not None and obtener_paquete() is not None
+
+def turno_de_paquete(opcion):
+    """{"evaluacion", "siguiente"} precompilados de la opción, o None si la rama no está en el paquete.
+
+    Avanza el nodo de la sesión; fuera del árbol queda a None y el resto de la
+    partida se genera en vivo.
+    """
+    ss = st.session_state
+    nodo, ss.nodo_paquete = ss.get('nodo_paquete'), None
+    if nodo is None or (paquete := obtener_paquete()) is None or opcion not in ss.opciones_actuales:
+        return None
+    if (turno := paquete.turno(nodo, ss.opciones_actuales.index(opcion))) is None:
+        return None
+    evaluacion, ss.nodo_paquete = turno
+    return {"evaluacion": evaluacion, "siguiente": paquete.pregunta(ss.nodo_paquete)[1] if ss.nodo_paquete is not None else None}
+
+
+# --- Impacto Local ---
+# Al confirmar, el impacto lo estima el modelo local y los indicadores (y el fin
+# de partida) se actualizan en ese mismo instante; el análisis y el nuevo
+# contexto de Gemini llegan en el siguiente rerun, que concilia ambos impactos.
+
+@st.cache_resource
+def obtener_modelo_impacto():
+    return modelo_impacto.ModeloImpacto(IMPACTO_DB)
+
+def anticipar_impacto(opcion):
+    """Aplica el impacto estimado y deja el turno pendiente del análisis de Gemini."""
+    ss = st.session_state
+    impacto = obtener_modelo_impacto().predecir(opcion, ss.nivel_dificultad)
+    ss.estado_simulacion = motor.aplicar_impacto(ss.estado_simulacion, impacto)
+    ss.turno_pendiente = {"opcion": opcion, "impacto_local": impacto}
+
+def impacto_definitivo(opcion, evaluacion, pendiente):
+    """Impacto que se aplica sobre el estado anterior a la decisión.
+
+    Las evaluaciones reales de Gemini calibran el modelo local. Si había una
+    estimación y Gemini discrepa, se queda la de Gemini (salvo con
+    CRISIS_RECONCILIAR_IMPACTO=local) y se anota el ajuste para el jugador.
+    """
+    local = pendiente['impacto_local'] if pendiente else None
+    if prompts.es_sustituta(evaluacion) or not isinstance(evaluacion.impacto, dict):
+        return local if local is not None else evaluacion.impacto # Mejor la estimación que un impacto neutro
+    obtener_modelo_impacto().registrar(opcion, st.session_state.nivel_dificultad, evaluacion.impacto, local)
+    if local is None or RECONCILIAR_IMPACTO == "local" or local == evaluacion.impacto:
+        return local if local is not None else evaluacion.impacto
+    cambios = [f"{etiqueta} {local[k]:+} → {evaluacion.impacto[k]:+}"
+               for k, etiqueta in zip(prompts.CLAVES_ESTADO, ("Fin", "Rep", "Lab")) if local[k] != evaluacion.impacto[k]]
+    st.session_state.nota_impacto = "El análisis ajustó el impacto estimado: " + ", ".join(cambios)
+    return evaluacion.impacto
+
+
+# --- Modo Especulativo ---
+# Mientras el jugador lee la pregunta se evalúan en segundo plano sus 4 opciones
+# (y, opcionalmente, la pregunta siguiente de cada rama). Al confirmar se usa el
+# resultado de la rama elegida y se descartan las demás.
+SPECULATIVE_WORKERS = 8         # Hilos compartidos por todas las sesiones del proceso
+SPECULATIVE_MAX_LLAMADAS = 40   # Llamadas especulativas máximas por sesión
+
+@st.cache_resource
+def obtener_pool_especulativo():
+    return ThreadPoolExecutor(max_workers=SPECULATIVE_WORKERS, thread_name_prefix="especulacion")
+
+def _rama_especulativa(servicios, contexto, pregunta, opcion, estado, historial, nivel, numero_pregunta, con_siguiente):
+    """Evalúa una opción (con la pregunta siguiente, vía turno fusionado, si se pide) en un hilo de fondo."""
+    if con_siguiente and numero_pregunta < motor.MAX_PREGUNTAS:
+        historial_rama = historial + [{"pregunta": pregunta, "respuesta": opcion, "numero": numero_pregunta}]
+        # Sin reintento automático: el coste de cada rama está acotado a una llamada
+        turno = _solicitud_validada_sin_ui(
+            servicios, prompts.prompt_turno(contexto, pregunta, opcion, estado, historial_rama, nivel, numero_pregunta),
+            prompts.ESQUEMA_TURNO, prompts.validar_turno, EVALUATION_TIMEOUT, reintentar=False, nivel=nivel)
+        if not turno:
+            return None
+        evaluacion, siguiente = turno
+        return {"evaluacion": evaluacion, "siguiente": siguiente}
+
+    evaluacion = _solicitud_validada_sin_ui(
+        servicios, prompts.prompt_evaluacion(contexto, pregunta, opcion, estado, nivel, numero_pregunta),
+        prompts.ESQUEMA_EVALUACION, prompts.validar_evaluacion, EVALUATION_TIMEOUT, reintentar=False, nivel=nivel)
+    return {"evaluacion": evaluacion, "siguiente": None} if evaluacion else None
+
+def lanzar_especulacion():
+    """Lanza las ramas de la pregunta actual (una sola vez por pregunta) respetando el tope por sesión."""
+    ss = st.session_state
+    if not (ss.get('modo_especulativo') and GEMINI_AVAILABLE and ss.opciones_actuales) or en_paquete():
+        return
+    actual = ss.get('especulacion')
+    if actual and actual['numero'] == ss.numero_pregunta and actual['pregunta'] == ss.pregunta_actual:
+        return
+    descartar_especulacion()
+
+    con_siguiente = bool(ss.get('especular_siguiente'))
+    coste = 1 # Una llamada por rama: evaluación sola o turno fusionado
+    pool, recursos = obtener_pool_especulativo(), servicios()
+    futuros = {}
+    for opcion in ss.opciones_actuales:
+        if ss.gasto_especulativo + coste > SPECULATIVE_MAX_LLAMADAS:
+            break
+        ss.gasto_especulativo += coste
+        futuros[opcion] = pool.submit(
+            _rama_especulativa, recursos, ss.contexto_actual, ss.pregunta_actual, opcion,
+            dict(ss.estado_simulacion), list(ss.historial_decisiones), ss.nivel_dificultad,
+            ss.numero_pregunta, con_siguiente)
+    ss.especulacion = {"numero": ss.numero_pregunta, "pregunta": ss.pregunta_actual, "coste": coste, "futuros": futuros}
+
+def _cancelar_ramas(especulacion, futuros):
+    """Cancela ramas aún en cola y devuelve su coste a la cuota de la sesión."""
+    for futuro in futuros:
+        if futuro.cancel():
+            st.session_state.gasto_especulativo -= especulacion['coste']
+
+def descartar_especulacion():
+    if especulacion := st.session_state.pop('especulacion', None):
+        _cancelar_ramas(especulacion, especulacion['futuros'].values())
+
+def futuro_especulativo(opcion):
+    """Futuro de la rama especulativa de la opción elegida, o None.
+
+    Las demás ramas se cancelan si no han empezado; las que ya están en vuelo
+    terminan en segundo plano y su resultado se descarta.
+    """
+    especulacion = st.session_state.pop('especulacion', None)
+    if not especulacion:
+        return None
+    futuro = especulacion['futuros'].pop(opcion, None)
+    _cancelar_ramas(especulacion, especulacion['futuros'].values())
+    if (futuro is None or especulacion['numero'] != st.session_state.numero_pregunta
+            or especulacion['pregunta'] != st.session_state.pregunta_actual):
+        return None
+    return futuro
+
+def tomar_especulacion(opcion):
+    """Resultado especulativo de la opción elegida (esperándolo si sigue en curso), o None."""
+    if (futuro := futuro_especulativo(opcion)) is None:
+        return None
+    with st.spinner(f"🧠 Analizando decisión {st.session_state.numero_pregunta}..."):
+        try:
+            return futuro.result()
+        except Exception:
+            return None
+
+
+# --- Trabajos en Segundo Plano ---
+# Fuera del modo streaming, las llamadas de la interfaz (escenarios, preguntas
+# y turnos) no ocupan el hilo del script: se encolan por sesión y la página
+# sondea hasta que terminan. En streaming el texto se dibuja según llega, así
+# que esas llamadas siguen haciéndose en el hilo del script.
+TRABAJOS_WORKERS = 16     # Hilos compartidos por todas las sesiones del proceso
+SONDEO_TRABAJOS = 0.5     # Segundos entre comprobaciones mientras la página espera
+
+@st.cache_resource
+def obtener_cola_trabajos():
+    return trabajos.ColaTrabajos(TRABAJOS_WORKERS)
+
+def _id_sesion():
+    """Id de la conexión de esta pestaña (no el token de la partida, que dos pestañas pueden compartir)."""
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
+
+def en_segundo_plano():
+    return not st.session_state.get('modo_streaming')
+
+def enviar_trabajo(clave, funcion, *args):
+    """Encola funcion(*args); mientras no se recoja, los envíos con la misma clave devuelven el mismo trabajo."""
+    return obtener_cola_trabajos().enviar(_id_sesion(), clave, funcion, *args)
+
+def recoger_trabajo(trabajo):
+    """Resultado de un trabajo terminado (o None si falló); su clave queda libre para un trabajo nuevo."""
+    obtener_cola_trabajos().descartar(_id_sesion(), trabajo.clave)
+    return trabajo.resultado()
+
+def cancelar_trabajos(clave=None):
+    """Cancela un trabajo de la sesión o, sin clave, todos."""
+    obtener_cola_trabajos().cancelar(_id_sesion(), clave)
+
+@st.fragment(run_every=SONDEO_TRABAJOS)
+def esperar_trabajo(trabajo, mensaje):
+    """Aviso de espera que se refresca solo; cuando el trabajo termina, vuelve a ejecutar la app para recogerlo."""
+    if trabajo.terminado():
+        st.rerun()
+    st.info(f"🧠 {mensaje} ({trabajo.segundos():.0f} s)")
+
+def _pregunta_en_segundo_plano(servicios, espacio, contexto, historial, estado, nivel, numero_pregunta, precalentada=None):
+    """Trabajo de una pregunta: la que ya se está precalentando si sale bien; si no, una nueva.
+
+    El precalentado que aún no empezó se cancela y el que está en vuelo se espera como
+    mucho el plazo de la pregunta: la nueva va con prioridad interactiva, no a la cola
+    del fondo. Una pregunta casi igual a otra de la partida se pide de nuevo una vez. Si
+    la API falla, la partida sigue con la pregunta de reserva, como en primer plano.
+    """
+    if precalentada is not None and not precalentada.cancel():
+        try:
+            if pregunta := precalentada.result(timeout=PRESUPUESTOS_LATENCIA["pregunta"]):
+                return pregunta
+        except Exception:
+            pass
+    jugador = dict(nivel=nivel, prioridad=admision.INTERACTIVA, tipo="pregunta")
+    pregunta = _solicitud_validada_sin_ui(
+        servicios, prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta),
+        prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta,
+        reserva=lambda: prompts.reserva_pregunta(numero_pregunta), **jugador)
+    if pregunta and pregunta_repetida(servicios, espacio, pregunta.pregunta, historial):
+        otra = _solicitud_validada_sin_ui(
+            servicios, prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta,
+                                               [decision['pregunta'] for decision in historial]),
+            prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta, reintentar=False, **jugador)
+        if otra and not pregunta_repetida(servicios, espacio, otra.pregunta, historial):
+            pregunta = otra
+    return pregunta or prompts.validar_pregunta(prompts.reserva_pregunta(numero_pregunta))
+
+def _turno_en_segundo_plano(servicios, especulado, contexto, pregunta, opcion, estado, historial, nivel, numero_pregunta):
+    """Trabajo de un turno: la rama especulativa de la opción si sale bien; si no, lo mismo que jugar_turno_gemini.
+
+    Es decir, el turno fusionado sin reintento y, si no sirve, la evaluación sola con
+    su reintento (la pregunta siguiente la genera luego su propio trabajo). La rama que
+    aún no empezó se cancela y la que está en vuelo se espera como mucho el plazo del
+    turno. None solo si también falla la evaluación.
+    """
+    if especulado is not None and not especulado.cancel():
+        try:
+            if resultado := especulado.result(timeout=PRESUPUESTOS_LATENCIA["turno"]):
+                return resultado
+        except Exception:
+            pass
+    jugador = dict(timeout=EVALUATION_TIMEOUT, nivel=nivel, prioridad=admision.INTERACTIVA)
+    if numero_pregunta < motor.MAX_PREGUNTAS:
+        historial_turno = historial + [{"pregunta": pregunta, "respuesta": opcion, "numero": numero_pregunta}]
+        turno = _solicitud_validada_sin_ui(
+            servicios, prompts.prompt_turno(contexto, pregunta, opcion, estado, historial_turno, nivel, numero_pregunta),
+            prompts.ESQUEMA_TURNO, prompts.validar_turno, reintentar=False, tipo="turno",
+            reserva=lambda: prompts.reserva_turno(contexto, numero_pregunta), **jugador)
+        if turno:
+            evaluacion, siguiente = turno
+            return {"evaluacion": evaluacion, "siguiente": siguiente}
+    evaluacion = _solicitud_validada_sin_ui(
+        servicios, prompts.prompt_evaluacion(contexto, pregunta, opcion, estado, nivel, numero_pregunta),
+        prompts.ESQUEMA_EVALUACION, prompts.validar_evaluacion, tipo="evaluacion",
+        reserva=lambda: prompts.reserva_evaluacion(contexto), **jugador)
+    return {"evaluacion": evaluacion, "siguiente": None} if evaluacion else None
+
+def cargar_pregunta_actual():
+    """Coloca en la partida la pregunta actual; False mientras se genera (con la espera ya mostrada).
+
+    Si no se puede generar, la partida termina (o vuelve al inicio si era la primera).
+    """
+    ss = st.session_state
+    numero = ss.numero_pregunta
+    pregunta = primera_pregunta_precalentada(ss.datos_escenario) if numero == 1 else None
+    if not pregunta and en_segundo_plano():
+        precalentada = precalentado_en_curso(ss.datos_escenario) if numero == 1 else None
+        trabajo = enviar_trabajo(("pregunta", numero), _pregunta_en_segundo_plano, servicios(), espacio_preguntas(),
+                                 ss.contexto_actual, list(ss.historial_decisiones), dict(ss.estado_simulacion),
+                                 ss.nivel_dificultad, numero, precalentada)
+        if not trabajo.terminado():
+            esperar_trabajo(trabajo, f"Generando pregunta {numero}...")
+            return False
+        pregunta = recoger_trabajo(trabajo)
+    elif not pregunta:
+        pregunta = generar_pregunta_y_opciones_gemini(ss.contexto_actual, ss.historial_decisiones, ss.estado_simulacion,
+                                                      ss.nivel_dificultad, numero)
+    if pregunta and pregunta[1]:
+        ss.pregunta_actual, ss.opciones_actuales = pregunta
+        return True
+    if numero == 1:
+        ir_a('inicio', "Fallo crítico al generar la primera pregunta. Regresando al inicio.")
+    ss.juego_terminado = True
+    ss.razon_fin = f"Error al generar la pregunta {numero}."
+    ir_a('resultado', f"No se pudo generar la pregunta {numero}. Finalizando simulación.")
+
+def obtener_turno(pendiente):
+    """{"evaluacion", "siguiente"} de la decisión pendiente; None mientras se genera (con la espera ya mostrada)."""
+    ss = st.session_state
+    opcion, numero = pendiente['opcion'], ss.numero_pregunta
+    if not en_segundo_plano():
+        if especulado := tomar_especulacion(opcion):
+            return especulado
+        # Una sola llamada: evaluación + siguiente pregunta
+        *evaluacion, siguiente = jugar_turno_gemini(ss.contexto_actual, ss.pregunta_actual, opcion, ss.estado_anterior,
+                                                    ss.historial_decisiones, ss.nivel_dificultad, numero)
+        return {"evaluacion": prompts.Evaluacion(*evaluacion), "siguiente": siguiente}
+    clave = ("turno", numero)
+    if (trabajo := obtener_cola_trabajos().buscar(_id_sesion(), clave)) is None:
+        # El historial sin la decisión actual: la rama la añade, como al especular
+        trabajo = enviar_trabajo(clave, _turno_en_segundo_plano, servicios(), futuro_especulativo(opcion),
+                                 ss.contexto_actual, ss.pregunta_actual, opcion, dict(ss.estado_anterior),
+                                 list(ss.historial_decisiones[:-1]), ss.nivel_dificultad, numero)
+    if not trabajo.terminado():
+        esperar_trabajo(trabajo, f"Analizando decisión {numero}...")
+        return None
+    return recoger_trabajo(trabajo) or {"evaluacion": prompts.evaluacion_fallida(ss.contexto_actual, "error API"), "siguiente": None}
+
+def cancelar_decision():
+    """Deshace la decisión pendiente: cancela su trabajo y restaura los indicadores y el historial."""
+    ss = st.session_state
+    cancelar_trabajos(("turno", ss.numero_pregunta))
+    ss.estado_simulacion = ss.estado_anterior.copy()
+    ss.historial_decisiones.pop()
+    ss.turno_pendiente = None
 
 
 # --- Lógica de la Aplicación Streamlit ---
@@ -254,27 +1121,249 @@ def inicializar_estado():
         st.session_state.nivel_dificultad = "Principiante"
     if 'cache_escenarios' not in st.session_state:
         st.session_state.cache_escenarios = {}
+    if 'gasto_especulativo' not in st.session_state:
+        st.session_state.gasto_especulativo = 0
+    if 'turno_pendiente' not in st.session_state:
+        st.session_state.turno_pendiente = None
+        st.session_state.nota_impacto = ""
     # ... resto de inicializar_estado ...
 
+
+# --- Persistencia de la Partida ---
+# El token de la sesión va en la URL; al recargar (o en otra réplica) la partida
+# se lee del almacén. Se guarda al empezar cada ejecución (recoge las que
+# terminaron con st.rerun) y al final del script, solo con los campos cambiados.
+# Una pestaña duplicada trae el token de otra: si esa sigue conectada a este
+# proceso, la nueva continúa con una copia de la partida y su propio token
+# (si está conectada a otra réplica no se detecta y ambas comparten partida).
+
+# Los escenarios internados tampoco cambian: no se serializan si siguen siendo el mismo
+INMUTABLES_SESION = sesiones.INMUTABLES + (memoria.Escenario,)
+
+@st.cache_resource
+def obtener_almacen_sesiones():
+    return sesiones.crear_almacen(SESIONES, SESIONES_TTL)
+
+def _token_en_uso(token):
+    """¿Juega otra pestaña conectada a este proceso la partida de `token`? (Sin servidor, como en AppTest, no.)"""
+    if (gestor := _gestor_sesiones()) is None:
+        return False
+    propia = _id_sesion()
+    for info in gestor.list_active_sessions():
+        estado = info.session.session_state
+        if info.session.id != propia and 'token_sesion' in estado and estado['token_sesion'] == token:
+            return True
+    return False
+
+def restaurar_sesion():
+    """Primera ejecución de la sesión: toma el token de la URL (o crea uno) y recupera su partida."""
+    ss = st.session_state
+    if not SESIONES or 'token_sesion' in ss:
+        return
+    guardado = {}
+    if token := st.query_params.get("sesion"):
+        try:
+            guardado = obtener_almacen_sesiones().leer(token)
+        except Exception as e:
+            st.warning(f"No se pudo recuperar la partida guardada ({e}). Empieza una nueva.")
+    copia = bool(token) and _token_en_uso(token)
+    if not token or copia:
+        token = st.query_params["sesion"] = sesiones.nuevo_token()
+    valores, ss.huellas_sesion = sesiones.restaurar(guardado, INMUTABLES_SESION)
+    if copia:
+        ss.huellas_sesion = {} # La copia se escribe entera con el token nuevo
+        if 'id_partida' in valores:
+            valores['id_partida'] = sesiones.nuevo_token() # Otra partida para la clasificación
+    for campo, valor in valores.items():
+        ss[campo] = valor
+    if ss.get('datos_escenario'):
+        ss.datos_escenario = obtener_registro_escenarios().internar(ss.datos_escenario)
+    ss.token_sesion = token
+
+def guardar_sesion():
+    """Escribe en el almacén los campos de la partida que cambiaron desde la última escritura."""
+    ss = st.session_state
+    if not SESIONES or 'token_sesion' not in ss:
+        return
+    cambios, borrados, huellas = sesiones.diferencias(ss, ss.huellas_sesion, INMUTABLES_SESION)
+    if not (cambios or borrados):
+        return
+    try:
+        obtener_almacen_sesiones().escribir(ss.token_sesion, cambios, borrados)
+    except Exception:
+        return # Almacén no disponible: se reintenta con los mismos cambios en la próxima ejecución
+    ss.huellas_sesion = huellas
+
+
+
+# --- Resultados de las Partidas ---
+# Cada partida que termina por las reglas (no por un error) se añade una vez al
+# almacén de resultados con el impacto de cada pregunta; la página de
+# clasificación lee de él los agregados por escenario y nivel.
+
+@st.cache_resource
+def obtener_resultados():
+    return resultados.AlmacenResultados(RESULTADOS_DB)
+
+def registrar_resultado():
+    """Añade la partida terminada al almacén de resultados; si no está disponible, la partida no cuenta."""
+    ss = st.session_state
+    if not RESULTADOS_DB or not ss.get('id_partida'):
+        return
+    partida = resultados.Partida(
+        ss.id_partida, ss.nivel_dificultad, ss.datos_escenario.get('id'), ss.datos_escenario.get('titulo'), ss.puntaje_final,
+        motor.en_bancarrota(ss.estado_simulacion) and ss.numero_pregunta < motor.MAX_PREGUNTAS, ss.get('impactos_partida', []))
+    try:
+        obtener_resultados().registrar(partida)
+    except Exception:
+        return
+
+
+# --- Memoria de las Sesiones ---
+# Cada ejecución anota al terminar los bytes del estado de su sesión y, de paso,
+# expulsa las sesiones inactivas o las que no caben en el presupuesto: no hace
+# falta un hilo aparte, basta con que alguna sesión siga ejecutándose. El estado
+# de las demás sesiones se busca en el gestor de sesiones del servidor: el
+# st.session_state de cada ejecución es un envoltorio que se crea de nuevo en
+# cada una, el SessionState de debajo es el que vive lo que la sesión.
+
+def _gestor_sesiones():
+    """SessionManager del servidor, o None sin servidor (AppTest instala un Runtime simulado sin él)."""
+    return getattr(Runtime.instance(), "_session_mgr", None) if Runtime.exists() else None
+
+def _estado_de_sesion(id_sesion):
+    """SessionState de una sesión del servidor, o None si ya se cerró (o no hay servidor, como en AppTest)."""
+    if (gestor := _gestor_sesiones()) is None:
+        return None
+    info = gestor.get_session_info(id_sesion)
+    return info.session.session_state if info else None
+
+@st.cache_resource
+def obtener_contabilidad_sesiones():
+    return memoria.ContabilidadSesiones(_estado_de_sesion, SESION_INACTIVA, MEMORIA_SESIONES_MB * 1024**2,
+                                        BARRIDO_SESIONES)
+
+def metricas_memoria():
+    registro = obtener_registro_escenarios()
+    return dict(obtener_contabilidad_sesiones().resumen(), escenarios_en_memoria=len(registro),
+                bytes_escenarios=registro.bytes(), **{f"registro_{k}": v for k, v in registro.metricas.items()})
+
+def empezar_ejecucion():
+    """Marca la sesión como en ejecución: mientras dure no se expulsa (si se está expulsando, espera a que acabe)."""
+    if ctx := get_script_run_ctx():
+        obtener_contabilidad_sesiones().empezar(ctx.session_id)
+
+def terminar_ejecucion():
+    """Anota los bytes del estado de la sesión y expulsa las sesiones que toque."""
+    if (ctx := get_script_run_ctx()) is None:
+        return
+    contabilidad = obtener_contabilidad_sesiones()
+    contabilidad.terminar(ctx.session_id, memoria.tamano(ctx.session_state.filtered_state))
+    if not SESIONES:
+        return # Sin almacén, expulsar perdería las partidas en curso
+    for id_sesion, estado in contabilidad.barrer(excepto=ctx.session_id):
+        liberada = False
+        try:
+            liberada = expulsar_sesion(id_sesion, estado)
+        finally:
+            contabilidad.expulsada(id_sesion, liberada)
+
+CLAVES_EXPULSABLES = sesiones.CAMPOS + ('especulacion', 'token_sesion', 'huellas_sesion', 'aviso')
+
+def expulsar_sesion(id_sesion, estado):
+    """Libera el estado de partida de otra sesión (no sus widgets), con sus trabajos.
+
+    Antes se vuelca al almacén lo que faltara por escribir; si no se puede, la
+    sesión se queda como está y devuelve False. Al volver, la sesión se
+    restaura del almacén como tras recargar la página (ver `vista`).
+    """
+    if 'token_sesion' not in estado:
+        return False
+    cambios, borrados, _ = sesiones.diferencias(estado, estado['huellas_sesion'], INMUTABLES_SESION)
+    if cambios or borrados:
+        try:
+            obtener_almacen_sesiones().escribir(estado['token_sesion'], cambios, borrados)
+        except Exception:
+            return False
+    obtener_cola_trabajos().cancelar(id_sesion)
+    obtener_indice_similitud().olvidar(f"preguntas:{id_sesion}")
+    if 'especulacion' in estado and estado['especulacion']:
+        for futuro in estado['especulacion']['futuros'].values():
+            futuro.cancel()
+    for clave in CLAVES_EXPULSABLES:
+        if clave in estado:
+            del estado[clave]
+    return True
+
+empezar_ejecucion()
+restaurar_sesion()
 inicializar_estado()
+guardar_sesion()
 
 # --- Barra Lateral de Navegación ---
 st.sidebar.title("Navegación")
 st.sidebar.page_link("app.py", label="Inicio / Simulación")
 st.sidebar.page_link("pages/acerca_de.py", label="Acerca de")
 st.sidebar.page_link("pages/contacto.py", label="Contacto")
+st.sidebar.page_link("pages/metricas.py", label="Métricas")
+if RESULTADOS_DB:
+    st.sidebar.page_link("pages/clasificacion.py", label="Clasificación")
+if (metricas_cache := obtener_cache_respuestas().metricas()).get("guardadas") or metricas_cache["tasa_aciertos"]:
+    st.sidebar.caption(f"Caché LLM: {metricas_cache['tasa_aciertos']:.0%} de aciertos "
+                       f"({metricas_cache.get('aciertos_memoria', 0) + metricas_cache.get('aciertos_disco', 0)} respuestas reutilizadas)")
+st.sidebar.toggle("📡 Respuestas en streaming", key="modo_streaming",
+                  help="Muestra el análisis y las opciones a medida que Gemini los genera.")
+st.sidebar.toggle("⚡ Modo especulativo", key="modo_especulativo",
+                  help="Evalúa las opciones mientras lees la pregunta para que confirmar sea instantáneo. Consume más cuota de la API.")
+if st.session_state.get('modo_especulativo'):
+    st.sidebar.checkbox("Pre-generar también la siguiente pregunta", key="especular_siguiente",
+                        help="Cada rama pide evaluación y siguiente pregunta en una sola llamada.")
+    st.sidebar.caption(f"Gasto especulativo: {st.session_state.gasto_especulativo}/{SPECULATIVE_MAX_LLAMADAS} llamadas")
+st.sidebar.toggle("🎯 Indicadores instantáneos", key="impacto_local", value=IMPACTO_LOCAL,
+                  help="Estima el impacto de tu decisión al instante; el análisis de Gemini llega después y puede ajustarlo.")
 # (El estado de la API ya se muestra al inicio)
 
 # --- Lógica de Páginas ---
+# Cada página es un st.fragment: elegir una opción o un escenario vuelve a
+# ejecutar solo esa vista, no la configuración, la barra lateral ni el resto
+# del script. Los cambios de página sí vuelven a ejecutar toda la aplicación.
+
+def vista(funcion):
+    """st.fragment que guarda la partida y anota la memoria de la sesión al terminar (también con st.rerun)."""
+    @functools.wraps(funcion)
+    def ejecutar():
+        empezar_ejecucion()
+        try:
+            if SESIONES and 'token_sesion' not in st.session_state:
+                st.rerun() # Sesión expulsada: solo la ejecución completa la restaura del almacén
+            funcion()
+        finally:
+            guardar_sesion()
+            terminar_ejecucion()
+    return st.fragment(ejecutar)
+
+def reejecutar_vista():
+    """st.rerun de solo la vista actual si ya se ejecuta como fragmento; en una ejecución completa, de la app."""
+    ctx = get_script_run_ctx()
+    st.rerun(scope="fragment" if ctx and ctx.fragment_ids_this_run else "app")
+
+def ir_a(pagina, aviso=None):
+    """Cambia de página sin esperas; el aviso, si lo hay, se muestra en la página de destino."""
+    st.session_state.pagina_actual = pagina
+    if aviso:
+        st.session_state.aviso = aviso
+    st.rerun()
+
 # Página de Inicio
-if st.session_state.pagina_actual == 'inicio':
+@vista
+def pagina_inicio():
     # ... (Código de la página de inicio igual que antes) ...
     st.title("🚀 Simulador de Crisis Empresariales")
     st.markdown("Bienvenido/a. Selecciona un nivel y un escenario para comenzar a tomar decisiones críticas.")
 
     nivel = st.selectbox("Selecciona el Nivel de Dificultad:",
-                         ["Principiante", "Intermedio", "Avanzado"],
-                         index=["Principiante", "Intermedio", "Avanzado"].index(st.session_state.nivel_dificultad),
+                         NIVELES_DIFICULTAD,
+                         index=NIVELES_DIFICULTAD.index(st.session_state.nivel_dificultad),
                          key="nivel_selector")
 
     # Si cambia el nivel, intentar cargar escenarios desde caché o generar nuevos
@@ -282,26 +1371,26 @@ if st.session_state.pagina_actual == 'inicio':
         st.session_state.nivel_dificultad = nivel
         st.session_state.escenario_seleccionado_id = None # Resetear selección
         # Forzar la recarga/regeneración en el siguiente paso
-        st.rerun()
+        reejecutar_vista()
 
     # Cargar/generar escenarios si no están en caché para el nivel actual
-    if nivel not in st.session_state.cache_escenarios or not st.session_state.cache_escenarios[nivel]:
-         if GEMINI_AVAILABLE:
-             st.session_state.cache_escenarios[nivel] = generar_escenario_gemini(nivel) # LLAMA A LA NUEVA FUNCIÓN
-         else:
-             st.session_state.cache_escenarios[nivel] = [] # Vacío si no hay API
+    # (la sesión guarda solo los ids; los escenarios son registros compartidos del proceso)
+    if not (escenarios_disponibles := escenarios_de_sesion(nivel)):
+         # Biblioteca compartida primero; solo se genera si aún no hay escenarios para el nivel
+         if (escenarios := cargar_escenarios(nivel)) is None:
+             return # Generándose en segundo plano; la espera ya se muestra
+         escenarios_disponibles = [obtener_registro_escenarios().internar(e) for e in escenarios]
+         st.session_state.cache_escenarios[nivel] = [e['id'] for e in escenarios_disponibles]
 
          # Si la generación falló o no hay API, mostrar mensaje
          if not st.session_state.cache_escenarios[nivel] and GEMINI_AVAILABLE:
               st.error(f"No se pudieron generar escenarios para el nivel {nivel}. Intenta recargar la página o revisa la conexión/clave API.")
-         elif not GEMINI_AVAILABLE:
+         elif not st.session_state.cache_escenarios[nivel]:
               st.warning(f"API de Gemini no disponible. No se pueden cargar escenarios para el nivel {nivel}.")
 
 
-    # Obtener escenarios disponibles del caché
-    escenarios_disponibles = st.session_state.cache_escenarios.get(nivel, [])
-
     if escenarios_disponibles:
+        precalentar_primeras_preguntas(nivel, escenarios_disponibles)
         opciones_escenario = {esc.get('id', f'missing_id_{i}'): esc.get('titulo', f'Sin Título {i}') for i, esc in enumerate(escenarios_disponibles)}
         # Asegurarse que el ID seleccionado previamente sigue siendo válido
         current_selection_id = st.session_state.get('escenario_seleccionado_id')
@@ -320,11 +1409,15 @@ if st.session_state.pagina_actual == 'inicio':
 
             if st.session_state.datos_escenario:
                 # Resetear estado para nueva simulación
-                st.session_state.estado_simulacion = st.session_state.datos_escenario.get('estado_inicial', {"financiera": 0, "reputacion": 0, "laboral": 0}).copy()
+                cancelar_trabajos()
+                obtener_indice_similitud().olvidar(espacio_preguntas())
+                st.session_state.estado_simulacion = motor.estado_inicial(st.session_state.datos_escenario)
                 st.session_state.estado_anterior = st.session_state.estado_simulacion.copy()
                 st.session_state.numero_pregunta = 0
-                st.session_state.contexto_actual = st.session_state.datos_escenario.get('trasfondo', "Contexto inicial no disponible.")
+                st.session_state.contexto_actual = motor.contexto_inicial(st.session_state.datos_escenario)
                 st.session_state.historial_decisiones = []
+                st.session_state.id_partida = sesiones.nuevo_token()
+                st.session_state.impactos_partida = [] # [(número de pregunta, impacto aplicado)] para los resultados
                 st.session_state.ultimo_analisis = ""
                 st.session_state.ultimas_consecuencias = ""
                 st.session_state.juego_terminado = False
@@ -332,64 +1425,29 @@ if st.session_state.pagina_actual == 'inicio':
                 st.session_state.puntaje_final = 0
                 st.session_state.pregunta_actual = ""
                 st.session_state.opciones_actuales = []
+                st.session_state.turno_pendiente = None
+                st.session_state.nota_impacto = ""
+                st.session_state.nodo_paquete = st.session_state.datos_escenario.get('paquete_nodo')
 
 
-                # Generar la primera pregunta (LLAMA A LA NUEVA FUNCIÓN)
-                pregunta, opciones = generar_pregunta_y_opciones_gemini(
-                    st.session_state.contexto_actual,
-                    st.session_state.historial_decisiones,
-                    st.session_state.estado_simulacion,
-                    st.session_state.nivel_dificultad,
-                    1 # Número de pregunta inicial
-                )
-                if pregunta and opciones:
-                    st.session_state.pregunta_actual = pregunta
-                    st.session_state.opciones_actuales = opciones
-                    st.session_state.numero_pregunta = 1 # Empezamos con la pregunta 1
-                    st.session_state.pagina_actual = 'simulacion'
-                    st.rerun()
-                else:
-                    st.error("No se pudo generar la primera pregunta. Intenta de nuevo.")
+                # La primera pregunta (precalentada o no) se coloca, o se espera, ya en la página de simulación
+                st.session_state.numero_pregunta = 1 # Empezamos con la pregunta 1
+                ir_a('simulacion')
             else:
                 st.error("Error al cargar los datos del escenario seleccionado.")
     else:
         st.warning(f"No hay escenarios disponibles o no se pudieron cargar para el nivel {nivel}.")
 
 # Página de Simulación
-elif st.session_state.pagina_actual == 'simulacion':
+@vista
+def pagina_simulacion():
     # ... (Código de la página de simulación igual que antes,
     #      asegúrate que llame a las NUEVAS funciones _gemini
     #      para generar preguntas y evaluar decisiones) ...
 
     if not st.session_state.datos_escenario:
         # ... (manejo de error) ...
-        st.error("Error: No se ha cargado ningún escenario. Volviendo al inicio.")
-        st.session_state.pagina_actual = 'inicio'
-        time.sleep(2)
-        st.rerun()
-
-
-    # Asegurarse de que haya una pregunta cargada, si no, intentar generar la inicial
-    elif not st.session_state.pregunta_actual and st.session_state.numero_pregunta == 1:
-         # ... (regenerar primera pregunta) ...
-         st.warning("Recargando primera pregunta...")
-         pregunta, opciones = generar_pregunta_y_opciones_gemini( # LLAMA A LA NUEVA FUNCIÓN
-                    st.session_state.contexto_actual,
-                    st.session_state.historial_decisiones,
-                    st.session_state.estado_simulacion,
-                    st.session_state.nivel_dificultad,
-                    1
-                )
-         # ... (resto de la lógica) ...
-         if pregunta and opciones:
-             st.session_state.pregunta_actual = pregunta
-             st.session_state.opciones_actuales = opciones
-             st.rerun()
-         else:
-             st.error("Fallo crítico al generar la primera pregunta. Regresando al inicio.")
-             st.session_state.pagina_actual = 'inicio'
-             time.sleep(2)
-             st.rerun()
+        ir_a('inicio', "Error: No se ha cargado ningún escenario. Volviendo al inicio.")
 
 
     elif st.session_state.numero_pregunta > 0: # Estado normal de simulación
@@ -402,9 +1460,9 @@ elif st.session_state.pagina_actual == 'simulacion':
         col1.metric("💰 Situación Financiera", st.session_state.estado_simulacion.get('financiera',0), delta=f"{delta_fin:+}" if delta_fin else None)
         col2.metric("📈 Reputación", st.session_state.estado_simulacion.get('reputacion',0), delta=f"{delta_rep:+}" if delta_rep else None)
         col3.metric("👥 Clima Laboral", st.session_state.estado_simulacion.get('laboral',0), delta=f"{delta_lab:+}" if delta_lab else None)
-        progress_value = min(st.session_state.numero_pregunta / 10, 1.0)
+        progress_value = min(st.session_state.numero_pregunta / motor.MAX_PREGUNTAS, 1.0)
         st.progress(progress_value)
-        st.markdown(f"Pregunta {st.session_state.numero_pregunta} de 10")
+        st.markdown(f"Pregunta {st.session_state.numero_pregunta} de {motor.MAX_PREGUNTAS}")
         st.markdown("---")
         if st.session_state.ultimo_analisis:
              with st.expander("Análisis de tu Decisión Anterior", expanded=False):
@@ -412,6 +1470,8 @@ elif st.session_state.pagina_actual == 'simulacion':
                  st.info(st.session_state.ultimo_analisis)
                  st.subheader("Consecuencias:")
                  st.warning(st.session_state.ultimas_consecuencias)
+                 if st.session_state.nota_impacto:
+                     st.caption(f"🎯 {st.session_state.nota_impacto}")
         st.subheader("Situación Actual:")
         st.markdown(st.session_state.contexto_actual)
         st.markdown("---")
@@ -419,88 +1479,90 @@ elif st.session_state.pagina_actual == 'simulacion':
         st.markdown(st.session_state.pregunta_actual if st.session_state.pregunta_actual else "Cargando pregunta...")
 
         # ... (Mostrar pregunta y opciones radio) ...
-        if st.session_state.opciones_actuales:
+        pendiente = st.session_state.turno_pendiente
+        if pendiente:
+            # Decisión ya tomada con el impacto estimado: falta el análisis de Gemini
+            user_choice = pendiente['opcion']
+            st.markdown(f"**Tu decisión:** {user_choice}")
+            if pendiente['impacto_local'] is not None:
+                st.caption("🎯 Indicadores actualizados con el impacto estimado; el análisis completo está en camino.")
+            if razon := motor.razon_fin(st.session_state.estado_simulacion, st.session_state.numero_pregunta):
+                st.warning(f"🏁 {razon}")
+        elif st.session_state.opciones_actuales:
             user_choice = st.radio("Selecciona tu decisión:",
                                    st.session_state.opciones_actuales,
                                    index=None,
                                    key=f"q_{st.session_state.numero_pregunta}")
         else:
-             st.warning("Cargando opciones...")
+             # Pregunta aún sin generar (turno sin pregunta fusionada, primera pregunta o partida reanudada)
              user_choice = None
+             if cargar_pregunta_actual():
+                 reejecutar_vista()
+        if not pendiente:
+            lanzar_especulacion()
 
         # ... (Botón Confirmar Decisión y lógica de procesamiento) ...
-        if st.button("Confirmar Decisión", key=f"b_{st.session_state.numero_pregunta}", disabled=(not user_choice)):
-            if user_choice:
-                st.session_state.estado_anterior = st.session_state.estado_simulacion.copy()
-                st.session_state.historial_decisiones.append({"pregunta": st.session_state.pregunta_actual, "respuesta": user_choice, "numero": st.session_state.numero_pregunta})
-
-                # Evaluar decisión (LLAMA A LA NUEVA FUNCIÓN)
-                analisis, cons_texto, nuevo_contexto, impacto = evaluar_decision_gemini(
-                    st.session_state.contexto_actual,
-                    st.session_state.pregunta_actual,
-                    user_choice,
-                    st.session_state.estado_simulacion,
-                    st.session_state.nivel_dificultad,
-                    st.session_state.numero_pregunta
-                )
-
-                # ... (Actualizar estado, contexto, análisis, consecuencias) ...
-                if isinstance(impacto, dict):
-                    st.session_state.estado_simulacion['financiera'] = st.session_state.estado_simulacion.get('financiera',0) + impacto.get('financiera', 0)
-                    st.session_state.estado_simulacion['reputacion'] = st.session_state.estado_simulacion.get('reputacion',0) + impacto.get('reputacion', 0)
-                    st.session_state.estado_simulacion['laboral'] = st.session_state.estado_simulacion.get('laboral',0) + impacto.get('laboral', 0)
+        confirmado = not pendiente and st.button("Confirmar Decisión", key=f"b_{st.session_state.numero_pregunta}", disabled=(not user_choice))
+        del_paquete = None
+        if confirmado and user_choice:
+            st.session_state.estado_anterior = st.session_state.estado_simulacion.copy()
+            st.session_state.historial_decisiones.append({"pregunta": st.session_state.pregunta_actual, "respuesta": user_choice, "numero": st.session_state.numero_pregunta})
+            # Turno precompilado al instante; si no, la decisión queda pendiente hasta que llegue el análisis
+            if (del_paquete := turno_de_paquete(user_choice)) is None:
+                if st.session_state.get('impacto_local'):
+                    anticipar_impacto(user_choice)
                 else:
-                     st.error("Error: El impacto recibido de Gemini no es válido. El estado no cambiará.")
-                st.session_state.contexto_actual = nuevo_contexto if nuevo_contexto else st.session_state.contexto_actual
-                st.session_state.ultimo_analisis = analisis
-                st.session_state.ultimas_consecuencias = cons_texto
-                st.session_state.pregunta_actual = ""
-                st.session_state.opciones_actuales = []
-
-
-                # ... (Verificar condiciones de fin) ...
-                BANCARROTA_THRESHOLD = -10
-                if st.session_state.numero_pregunta >= 10:
-                    st.session_state.juego_terminado = True
-                    st.session_state.razon_fin = "Se completaron las 10 preguntas."
-                elif st.session_state.estado_simulacion.get('financiera', 0) <= BANCARROTA_THRESHOLD:
-                     st.session_state.juego_terminado = True
-                     st.session_state.razon_fin = f"¡Bancarrota! La situación financiera cayó a {st.session_state.estado_simulacion.get('financiera', 0)} (Umbral: {BANCARROTA_THRESHOLD})."
-
-                # ... (Si no termina, generar siguiente pregunta) ...
-                if st.session_state.juego_terminado:
-                    # ... (calcular puntaje, ir a resultados) ...
-                    st.session_state.puntaje_final = (
-                        st.session_state.estado_simulacion.get('financiera', 0) +
-                        st.session_state.estado_simulacion.get('reputacion', 0) +
-                        st.session_state.estado_simulacion.get('laboral', 0)
-                    )
-                    st.session_state.pagina_actual = 'resultado'
-                    st.rerun()
+                    st.session_state.turno_pendiente = {"opcion": user_choice, "impacto_local": None}
+                reejecutar_vista()
+        resultado = del_paquete or (obtener_turno(pendiente) if pendiente else None)
+        if pendiente and not resultado and st.button("Cancelar", key=f"cancelar_{st.session_state.numero_pregunta}"):
+            cancelar_decision()
+            reejecutar_vista()
+        if resultado:
+            analisis, cons_texto, nuevo_contexto, impacto = resultado['evaluacion']
+            siguiente = resultado['siguiente']
+
+            # ... (Actualizar estado, contexto, análisis, consecuencias) ...
+            st.session_state.turno_pendiente = None
+            st.session_state.nota_impacto = ""
+            if not del_paquete: # Los turnos del paquete no recalibran el modelo local en cada partida
+                impacto = impacto_definitivo(user_choice, prompts.Evaluacion(analisis, cons_texto, nuevo_contexto, impacto), pendiente)
+            if (nuevo_estado := motor.aplicar_impacto(st.session_state.estado_anterior, impacto)) is not None:
+                st.session_state.estado_simulacion = nuevo_estado
+                st.session_state.impactos_partida.append(
+                    (st.session_state.numero_pregunta, {k: impacto.get(k, 0) for k in prompts.CLAVES_ESTADO}))
+            else:
+                 st.error("Error: El impacto recibido de Gemini no es válido. El estado no cambiará.")
+            st.session_state.contexto_actual = nuevo_contexto if nuevo_contexto else st.session_state.contexto_actual
+            st.session_state.ultimo_analisis = analisis
+            st.session_state.ultimas_consecuencias = cons_texto
+            st.session_state.pregunta_actual = ""
+            st.session_state.opciones_actuales = []
+
+
+            # ... (Verificar condiciones de fin) ...
+            if razon := motor.razon_fin(st.session_state.estado_simulacion, st.session_state.numero_pregunta):
+                st.session_state.juego_terminado = True
+                st.session_state.razon_fin = razon
+
+            # ... (Si no termina, generar siguiente pregunta) ...
+            if st.session_state.juego_terminado:
+                # ... (calcular puntaje, ir a resultados) ...
+                st.session_state.puntaje_final = motor.puntaje(st.session_state.estado_simulacion)
+                registrar_resultado()
+                ir_a('resultado')
 
-                else:
-                    st.session_state.numero_pregunta += 1
-                    pregunta, opciones = generar_pregunta_y_opciones_gemini( # LLAMA A LA NUEVA FUNCIÓN
-                        st.session_state.contexto_actual,
-                        st.session_state.historial_decisiones,
-                        st.session_state.estado_simulacion,
-                        st.session_state.nivel_dificultad,
-                        st.session_state.numero_pregunta
-                    )
-                    # ... (manejar si falla la generación) ...
-                    if pregunta and opciones:
-                        st.session_state.pregunta_actual = pregunta
-                        st.session_state.opciones_actuales = opciones
-                    else:
-                         st.error(f"No se pudo generar la pregunta {st.session_state.numero_pregunta}. Finalizando simulación.")
-                         st.session_state.juego_terminado = True
-                         st.session_state.razon_fin = f"Error al generar la pregunta {st.session_state.numero_pregunta}."
-                         st.session_state.pagina_actual = 'resultado'
-
-                    st.rerun()
+            else:
+                st.session_state.numero_pregunta += 1
+                if siguiente and not del_paquete and pregunta_repetida(servicios(), espacio_preguntas(), siguiente[0], st.session_state.historial_decisiones):
+                    siguiente = None # Casi repetida: se genera otra, como si no hubiera llegado con el turno
+                if siguiente: # Si no llegó con el turno, la pregunta se genera en la próxima ejecución
+                    st.session_state.pregunta_actual, st.session_state.opciones_actuales = siguiente
+                reejecutar_vista()
 
 # Página de Resultados
-elif st.session_state.pagina_actual == 'resultado':
+@vista
+def pagina_resultado():
     # ... (Código de la página de resultados igual que antes) ...
     st.title("🏁 Resultados de la Simulación")
     # ... (mostrar título, razón fin, métricas finales, puntaje, historial, botón volver) ...
@@ -515,11 +1577,7 @@ elif st.session_state.pagina_actual == 'resultado':
     st.markdown("---")
     st.subheader("Puntaje Total:")
     if 'puntaje_final' not in st.session_state or st.session_state.puntaje_final == 0:
-         st.session_state.puntaje_final = (
-                        st.session_state.estado_simulacion.get('financiera', 0) +
-                        st.session_state.estado_simulacion.get('reputacion', 0) +
-                        st.session_state.estado_simulacion.get('laboral', 0)
-                    )
+         st.session_state.puntaje_final = motor.puntaje(st.session_state.estado_simulacion)
     st.metric("🏆 Puntaje Final", st.session_state.puntaje_final)
     if st.session_state.puntaje_final > 5:
         st.success("¡Excelente gestión de la crisis!")
@@ -527,6 +1585,15 @@ elif st.session_state.pagina_actual == 'resultado':
         st.error("La gestión de la crisis tuvo resultados muy negativos.")
     else:
         st.info("La gestión de la crisis tuvo un resultado mixto o neutral.")
+    if RESULTADOS_DB and st.session_state.get('id_partida'):
+        with st.form("alias_clasificacion"):
+            alias = st.text_input("Tu nombre en la clasificación (opcional)", max_chars=30)
+            if st.form_submit_button("Guardar nombre"):
+                try:
+                    obtener_resultados().renombrar(st.session_state.id_partida, alias.strip())
+                    st.success("Nombre guardado. Consulta la página de Clasificación.")
+                except Exception as e:
+                    st.warning(f"No se pudo guardar el nombre ({e}).")
     with st.expander("Ver Historial de Decisiones"):
         for i, decision in enumerate(st.session_state.historial_decisiones):
             st.markdown(f"**P{decision.get('numero', i+1)}:** {decision.get('pregunta','-')}")
@@ -535,15 +1602,27 @@ elif st.session_state.pagina_actual == 'resultado':
     st.markdown("---")
     if st.button("Volver al Inicio", key="back_to_start"):
         # ... (resetear estado) ...
+        descartar_especulacion()
+        cancelar_trabajos()
         st.session_state.pagina_actual = 'inicio'
         st.session_state.escenario_seleccionado_id = None
         st.session_state.datos_escenario = None
         keys_to_reset = ['estado_simulacion', 'estado_anterior', 'numero_pregunta',
                          'contexto_actual', 'pregunta_actual', 'opciones_actuales',
                          'historial_decisiones', 'ultimo_analisis', 'ultimas_consecuencias',
-                         'juego_terminado', 'razon_fin', 'puntaje_final']
+                         'juego_terminado', 'razon_fin', 'puntaje_final', 'turno_pendiente', 'nota_impacto',
+                         'nodo_paquete', 'id_partida', 'impactos_partida']
         for key in keys_to_reset:
             if key in st.session_state:
                 del st.session_state[key]
         inicializar_estado()
         st.rerun()
+
+
+PAGINAS = {'inicio': pagina_inicio, 'simulacion': pagina_simulacion, 'resultado': pagina_resultado}
+if aviso := st.session_state.pop('aviso', None):
+    st.error(aviso)
+if pagina := PAGINAS.get(st.session_state.pagina_actual):
+    pagina()
+
+guardar_sesion()
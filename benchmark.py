@@ -0,0 +1,204 @@
+"""Benchmark reproducible del camino de peticiones, sin clave ni cuota.
+
+Arranca servidor_simulado.py (o usa --endpoint) y mide:
+1. latencia por tipo de llamada (p50/p95/p99) y tiempo de turno de extremo a
+   extremo, jugando partidas completas con el motor sin interfaz;
+2. tiempo de cada rerun de app.py con varias sesiones simultáneas, mediante
+   el arnés de pruebas de Streamlit (AppTest): carga, inicio y turno completo.
+   Como el navegador, cada fase vuelve a ejecutar la app mientras espera un
+   trabajo en segundo plano, así que mide hasta que el resultado se ve.
+   AppTest no admite varias sesiones a la vez en un proceso, así que cada
+   sesión corre en su propio proceso: compiten por el servidor, la CPU y los
+   almacenes SQLite, pero no comparten los recursos de @st.cache_resource.
+
+Ejemplo:
+    python benchmark.py --partidas 20 --sesiones 4 --latencia lognormal:0.3,0.4 --tasa-malformado 0.05 --semilla 1
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import gemini_client
+import motor
+import servidor_simulado
+import simulador
+
+RUTA_APP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+TIMEOUT_RERUN = 300
+SONDEO = 0.05             # Segundos entre reruns mientras la app espera un trabajo en segundo plano
+
+
+class _BackendMedido(motor.BackendGemini):
+    """BackendGemini que además guarda todas sus llamadas para agruparlas por tipo."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.llamadas = []
+        self._lock = threading.Lock()
+
+    def _llamar(self, tipo, prompt, esquema, validar, timeout, registro):
+        propias = []
+        resultado = super()._llamar(tipo, prompt, esquema, validar, timeout, propias)
+        with self._lock:
+            self.llamadas.extend(propias)
+        if registro is not None:
+            registro.extend(propias)
+        return resultado
+
+
+def medir_motor(endpoint, partidas, hilos, semilla):
+    """Latencia por tipo de llamada y por turno jugando `partidas` partidas en `hilos` hilos."""
+    backend = _BackendMedido(gemini_client.crear_sesion(pool_maxsize=hilos), "benchmark", endpoint=endpoint)
+    nivel = motor.NIVELES_DIFICULTAD[0]
+    escenarios = None
+    for _ in range(simulador.INTENTOS_ESCENARIOS):
+        escenarios = escenarios or backend.escenarios(nivel)
+    if not escenarios:
+        raise SystemExit("El servidor no devolvió escenarios válidos.")
+    rng = random.Random(semilla)
+    semillas = [rng.getrandbits(32) for _ in range(partidas)]
+    with ThreadPoolExecutor(max_workers=hilos) as pool:
+        resultados = list(pool.map(
+            lambda i: motor.jugar_partida(escenarios[i % len(escenarios)], nivel, backend, motor.politica_aleatoria,
+                                          random.Random(semillas[i])),
+            range(partidas)))
+
+    por_tipo = collections.defaultdict(list)
+    for llamada in backend.llamadas:
+        por_tipo[llamada.tipo].append(llamada)
+    turnos = [t for p in resultados for t in p["turnos"] if t["numero"] > 0]
+    return {
+        "llamadas": {tipo: dict(simulador.percentiles([l.segundos for l in llamadas], (50, 95, 99)),
+                                n=len(llamadas), invalidas=sum(not l.valida for l in llamadas))
+                     for tipo, llamadas in sorted(por_tipo.items())},
+        "turno_extremo_a_extremo": dict(simulador.percentiles([t["segundos"] for t in turnos], (50, 95, 99)), n=len(turnos)),
+        "partida": dict(simulador.percentiles([p["segundos"] for p in resultados], (50, 95, 99)), n=len(resultados)),
+    }
+
+
+def _esperando(at):
+    """¿Muestra la app una espera (escenarios, pregunta o turno en segundo plano) en lugar de su contenido?"""
+    ss = at.session_state
+    if ss["pagina_actual"] == "inicio":
+        return not any(boton.key == "start_button" for boton in at.button)
+    if ss["pagina_actual"] == "simulacion":
+        return bool(ss["turno_pendiente"]) or not ss["opciones_actuales"]
+    return False
+
+
+def _sesion_app(streaming):
+    """Una sesión de app.py de principio a fin: (página final, duraciones de los reruns por fase)."""
+    from streamlit.testing.v1 import AppTest
+
+    tiempos = collections.defaultdict(list)
+
+    def rerun(fase, accion):
+        inicio = time.monotonic()
+        accion()
+        # Lo que hace el fragmento de espera de la app: volver a ejecutarla hasta que el trabajo termine
+        while _esperando(at) and time.monotonic() - inicio < TIMEOUT_RERUN:
+            time.sleep(SONDEO)
+            at.run()
+        tiempos[fase].append(time.monotonic() - inicio)
+
+    at = AppTest.from_file(RUTA_APP, default_timeout=TIMEOUT_RERUN)
+    rerun("carga", at.run)
+    if streaming:
+        rerun("ajustes", at.toggle(key="modo_streaming").set_value(True).run)
+    rerun("inicio", at.button(key="start_button").click().run)
+    for numero in range(1, motor.MAX_PREGUNTAS + 1):
+        if at.session_state["pagina_actual"] != "simulacion":
+            break
+        radio = at.radio(key=f"q_{numero}")
+        rerun("seleccion", radio.set_value(radio.options[0]).run)
+        rerun("turno", at.button(key=f"b_{numero}").click().run)
+    return at.session_state["pagina_actual"], dict(tiempos)
+
+
+def medir_app(endpoint, sesiones, streaming):
+    """Duración de los reruns de app.py con `sesiones` sesiones simultáneas (un proceso por sesión)."""
+    # Los procesos nuevos heredan el entorno: endpoint, clave y almacenes en un directorio temporal
+    directorio = tempfile.mkdtemp(prefix="benchmark-")
+    os.environ.update(CRISIS_GEMINI_ENDPOINT=endpoint, GEMINI_API_KEY="benchmark",
+                      CRISIS_ESCENARIOS_DB=os.path.join(directorio, "escenarios.sqlite3"),
+                      CRISIS_CACHE_LLM_DB=os.path.join(directorio, "cache_llm.sqlite3"),
+                      CRISIS_IMPACTO_DB=os.path.join(directorio, "impacto.sqlite3"),
+                      CRISIS_SESIONES=os.path.join(directorio, "sesiones.sqlite3"),
+                      CRISIS_SIMILITUD_DB=os.path.join(directorio, "similitud.sqlite3"),
+                      CRISIS_RESULTADOS_DB=os.path.join(directorio, "resultados.sqlite3"))
+    with ProcessPoolExecutor(max_workers=sesiones, mp_context=multiprocessing.get_context("spawn")) as pool:
+        sesiones_app = list(pool.map(_sesion_app, [streaming] * sesiones))
+    finales = [final for final, _ in sesiones_app]
+    tiempos = collections.defaultdict(list)
+    for _, por_fase in sesiones_app:
+        for fase, valores in por_fase.items():
+            tiempos[fase].extend(valores)
+    return {
+        "sesiones": sesiones, "completadas": finales.count("resultado"),
+        "reruns": {fase: dict(simulador.percentiles(valores, (50, 95, 99)), n=len(valores))
+                   for fase, valores in tiempos.items()},
+    }
+
+
+def _imprimir(resultado):
+    print(f"{'medida':<32}{'n':>6}{'p50':>9}{'p95':>9}{'p99':>9}", file=sys.stderr)
+    filas = [(f"llamada {tipo}", datos) for tipo, datos in resultado["motor"]["llamadas"].items()]
+    filas += [("turno (extremo a extremo)", resultado["motor"]["turno_extremo_a_extremo"]),
+              ("partida completa", resultado["motor"]["partida"])]
+    if "app" in resultado:
+        filas += [(f"rerun app.py: {fase}", datos) for fase, datos in resultado["app"]["reruns"].items()]
+    for nombre, datos in filas:
+        print(f"{nombre:<32}{datos.get('n', 0):>6}" + "".join(f"{datos.get(q, 0):>9.3f}" for q in ("p50", "p95", "p99")),
+              file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark de latencia contra el servidor simulado de Gemini.")
+    parser.add_argument("--partidas", type=int, default=20, help="Partidas del motor sin interfaz")
+    parser.add_argument("--hilos", type=int, default=8)
+    parser.add_argument("--sesiones", type=int, default=4, help="Sesiones simultáneas de app.py (0 para omitir)")
+    parser.add_argument("--streaming", action="store_true", help="Activar el modo streaming en las sesiones de app.py")
+    parser.add_argument("--latencia", default="lognormal:0.3,0.4")
+    parser.add_argument("--latencia-tipo", action="append", metavar="TIPO=DIST")
+    parser.add_argument("--tasa-error", type=float, default=0.0)
+    parser.add_argument("--tasa-malformado", type=float, default=0.0)
+    parser.add_argument("--grabaciones")
+    parser.add_argument("--semilla", type=int, default=1)
+    parser.add_argument("--endpoint", help="Medir contra este servidor en lugar de arrancar uno simulado")
+    parser.add_argument("--salida", help="Guardar el resultado como JSON")
+    args = parser.parse_args(argv)
+
+    servidor = None
+    endpoint = args.endpoint
+    if not endpoint:
+        servidor = servidor_simulado.ServidorSimulado(
+            0, args.latencia, servidor_simulado.latencias_por_tipo(args.latencia_tipo), args.tasa_error,
+            args.tasa_malformado, args.grabaciones, semilla=args.semilla)
+        endpoint = servidor.iniciar()
+    try:
+        resultado = {"configuracion": {k: v for k, v in vars(args).items() if k != "salida"},
+                     "motor": medir_motor(endpoint, args.partidas, args.hilos, args.semilla)}
+        if args.sesiones:
+            resultado["app"] = medir_app(endpoint, args.sesiones, args.streaming)
+        if servidor:
+            resultado["servidor"] = dict(servidor.contadores)
+    finally:
+        if servidor:
+            servidor.detener()
+
+    _imprimir(resultado)
+    if args.salida:
+        with open(args.salida, "w", encoding="utf-8") as f:
+            json.dump(resultado, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""Biblioteca persistente de escenarios compartida por todo el proceso.
+
+Los escenarios generados se guardan en un fichero SQLite, por nivel. Las
+sesiones nuevas reciben un lote de 5 al instante (los menos servidos primero)
+y un hilo de fondo repone cada nivel cuando le quedan pocos sin usar, de modo
+que la carga de la página de inicio no espera a Gemini. Las entradas más
+antiguas que el TTL se eliminan.
+"""
+import contextlib
+import json
+import sqlite3
+import threading
+import time
+
+LOTE = 5                          # Escenarios que se muestran por nivel
+TTL_SEGUNDOS = 7 * 24 * 3600      # Antigüedad máxima de un escenario
+MARCA_MINIMA = 10                 # Reponer si quedan menos escenarios sin usar que esto
+INTERVALO_REPOSICION = 60         # Segundos entre revisiones del hilo de fondo
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS escenarios (
+    rowid INTEGER PRIMARY KEY,
+    nivel TEXT NOT NULL,
+    datos TEXT NOT NULL,
+    creado REAL NOT NULL,
+    servido INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_escenarios_nivel ON escenarios (nivel, servido, creado);
+"""
+
+
+def _fila(escenario_id):
+    """Fila SQLite de un id asignado por `agregar` (prefijo del nivel + rowid)."""
+    try:
+        return int(escenario_id[1:])
+    except (TypeError, ValueError):
+        return None
+
+
+class BibliotecaEscenarios:
+    """Almacén SQLite de escenarios por nivel, seguro para varios hilos y procesos."""
+
+    def __init__(self, ruta, ttl=TTL_SEGUNDOS, marca_minima=MARCA_MINIMA):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.marca_minima = marca_minima
+        self._lock = threading.Lock()
+        self._despertar = threading.Event()
+        self._hilo = None
+        with self._conectar() as conn:
+            conn.execute("PRAGMA journal_mode=WAL") # Lectores y un escritor concurrentes entre réplicas
+            conn.executescript(_ESQUEMA)
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        """Conexión de corta vida: confirma la transacción al salir y siempre se cierra."""
+        conn = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _limite_frescura(self):
+        return time.time() - self.ttl
+
+    def agregar(self, nivel, escenarios, servidos=False):
+        """Guarda escenarios y los devuelve con un id único en la biblioteca (prefijo del nivel + fila)."""
+        guardados = []
+        with self._lock, self._conectar() as conn:
+            for escenario in escenarios:
+                cursor = conn.execute(
+                    "INSERT INTO escenarios (nivel, datos, creado, servido) VALUES (?, '', ?, ?)",
+                    (nivel, time.time(), 1 if servidos else 0))
+                escenario = dict(escenario, id=f"{nivel[0].lower()}{cursor.lastrowid}")
+                conn.execute("UPDATE escenarios SET datos = ? WHERE rowid = ?",
+                             (json.dumps(escenario, ensure_ascii=False), cursor.lastrowid))
+                guardados.append(escenario)
+        return guardados
+
+    def tomar_lote(self, nivel, cantidad=LOTE):
+        """Devuelve `cantidad` escenarios frescos del nivel (los menos servidos), o [] si no hay suficientes."""
+        with self._lock, self._conectar() as conn:
+            filas = conn.execute(
+                "SELECT rowid, datos FROM escenarios WHERE nivel = ? AND creado >= ? "
+                "ORDER BY servido ASC, RANDOM() LIMIT ?",
+                (nivel, self._limite_frescura(), cantidad)).fetchall()
+            if len(filas) < cantidad:
+                return []
+            conn.executemany("UPDATE escenarios SET servido = servido + 1 WHERE rowid = ?",
+                             [(rowid,) for rowid, _ in filas])
+        self._despertar.set() # Puede que el nivel haya bajado de la marca mínima
+        return [json.loads(datos) for _, datos in filas]
+
+    def obtener(self, escenario_id):
+        """Escenario con ese id (con sus anotaciones), o None."""
+        if (rowid := _fila(escenario_id)) is None:
+            return None
+        with self._conectar() as conn:
+            fila = conn.execute("SELECT datos FROM escenarios WHERE rowid = ?", (rowid,)).fetchone()
+        return json.loads(fila[0]) if fila else None
+
+    def anotar(self, escenario_id, **campos):
+        """Añade campos precalculados (p. ej. la primera pregunta) al registro del escenario."""
+        if (rowid := _fila(escenario_id)) is None:
+            return
+        with self._lock, self._conectar() as conn:
+            fila = conn.execute("SELECT datos FROM escenarios WHERE rowid = ?", (rowid,)).fetchone()
+            if fila:
+                datos = dict(json.loads(fila[0]), **campos)
+                conn.execute("UPDATE escenarios SET datos = ? WHERE rowid = ?",
+                             (json.dumps(datos, ensure_ascii=False), rowid))
+
+    def contar_sin_usar(self, nivel):
+        with self._conectar() as conn:
+            return conn.execute(
+                "SELECT COUNT(*) FROM escenarios WHERE nivel = ? AND servido = 0 AND creado >= ?",
+                (nivel, self._limite_frescura())).fetchone()[0]
+
+    def purgar_caducados(self):
+        with self._lock, self._conectar() as conn:
+            return conn.execute("DELETE FROM escenarios WHERE creado < ?", (self._limite_frescura(),)).rowcount
+
+    def reponer(self, niveles, generador):
+        """Genera lotes hasta que cada nivel tenga al menos `marca_minima` escenarios sin usar.
+
+        `generador(nivel)` devuelve una lista de escenarios validados o una lista
+        vacía/None si falla; ante un fallo se pasa al siguiente nivel.
+        """
+        self.purgar_caducados()
+        for nivel in niveles:
+            while self.contar_sin_usar(nivel) < self.marca_minima:
+                escenarios = generador(nivel)
+                if not escenarios:
+                    break
+                self.agregar(nivel, escenarios)
+
+    def iniciar_reposicion(self, niveles, generador, intervalo=INTERVALO_REPOSICION):
+        """Arranca (una vez) el hilo de fondo que repone la biblioteca periódicamente."""
+        if self._hilo is not None:
+            return
+
+        def bucle():
+            while True:
+                try:
+                    self.reponer(niveles, generador)
+                except Exception:
+                    pass # Un fallo de la API o de disco no debe matar el hilo; se reintenta luego
+                self._despertar.wait(intervalo)
+                self._despertar.clear()
+
+        self._hilo = threading.Thread(target=bucle, name="reposicion-escenarios", daemon=True)
+        self._hilo.start()
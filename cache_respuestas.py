@@ -0,0 +1,159 @@
+"""Caché direccionada por contenido para las respuestas de Gemini.
+
+La clave es un hash de (modelo, cuerpo de la petición): el prompt y la
+configuración de generación. Dos peticiones idénticas comparten respuesta
+aunque vengan de sesiones distintas. Hay dos niveles:
+- memoria: LRU acotado, compartido por todas las sesiones del proceso;
+- disco: SQLite con tope de tamaño; al superarlo se borran las entradas
+  usadas hace más tiempo.
+
+Solo las llamadas deterministas (temperature 0 o topK 1) se sirven desde la
+caché por defecto; las muestreadas requieren activarlo explícitamente. Todas
+se guardan, para tener una respuesta de reserva si vence un plazo. Las
+peticiones que comparten todos los jugadores (la pregunta 1 de cada
+escenario) se piden con temperature 0: ver prompts.PromptDeterminista.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+MAX_ENTRADAS_MEMORIA = 512
+MAX_BYTES_DISCO = 50 * 1024 * 1024
+RECUENTO_DISCO = 256     # Escrituras entre recuentos del tamaño en disco (otros procesos también escriben)
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS respuestas (
+    clave TEXT PRIMARY KEY,
+    texto TEXT NOT NULL,
+    tamano INTEGER NOT NULL,
+    usado REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_respuestas_usado ON respuestas (usado);
+"""
+
+
+def clave(modelo, payload):
+    """Hash estable de la petición (el orden de las claves del JSON no influye)."""
+    contenido = json.dumps({"modelo": modelo, "payload": payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+
+def es_determinista(payload):
+    config = payload.get("generationConfig") or {}
+    return config.get("temperature") == 0 or config.get("topK") == 1
+
+
+class CacheRespuestas:
+    def __init__(self, ruta_disco=None, max_entradas=MAX_ENTRADAS_MEMORIA, max_bytes_disco=MAX_BYTES_DISCO,
+                 cachear_muestreadas=False):
+        self.ruta_disco = ruta_disco
+        self.max_entradas = max_entradas
+        self.max_bytes_disco = max_bytes_disco
+        self.cachear_muestreadas = cachear_muestreadas
+        self._memoria = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._metricas = collections.Counter()
+        self._bytes_disco = 0
+        self._escrituras = 0
+        if ruta_disco:
+            with self._conectar() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_ESQUEMA)
+                self._bytes_disco = self._contar_bytes(conn)
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta_disco, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def admite(self, payload):
+        """¿Puede esta petición servirse desde la caché?"""
+        return self.cachear_muestreadas or es_determinista(payload)
+
+    def obtener(self, clave):
+        """Texto cacheado o None. Un acierto en disco se promociona a memoria."""
+        with self._lock:
+            if clave in self._memoria:
+                self._memoria.move_to_end(clave)
+                self._metricas["aciertos_memoria"] += 1
+                return self._memoria[clave]
+        texto = None
+        if self.ruta_disco:
+            with self._conectar() as conn:
+                fila = conn.execute("SELECT texto FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+                if fila:
+                    conn.execute("UPDATE respuestas SET usado = ? WHERE clave = ?", (time.time(), clave))
+                    texto = fila[0]
+        with self._lock:
+            if texto is None:
+                self._metricas["fallos"] += 1
+                return None
+            self._metricas["aciertos_disco"] += 1
+            self._guardar_en_memoria(clave, texto)
+        return texto
+
+    def guardar(self, clave, texto):
+        with self._lock:
+            self._guardar_en_memoria(clave, texto)
+            self._metricas["guardadas"] += 1
+        if self.ruta_disco:
+            tamano = len(texto.encode("utf-8"))
+            with self._conectar() as conn:
+                anterior = conn.execute("SELECT tamano FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+                conn.execute("INSERT OR REPLACE INTO respuestas (clave, texto, tamano, usado) VALUES (?, ?, ?, ?)",
+                             (clave, texto, tamano, time.time()))
+                self._desalojar_disco(conn, tamano - (anterior[0] if anterior else 0))
+
+    def _guardar_en_memoria(self, clave, texto):
+        self._memoria[clave] = texto
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self.max_entradas:
+            self._memoria.popitem(last=False)
+            self._metricas["desalojadas_memoria"] += 1
+
+    @staticmethod
+    def _contar_bytes(conn):
+        return conn.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+
+    def _desalojar_disco(self, conn, incremento):
+        """Borra las entradas menos usadas recientemente hasta quedar bajo el tope de bytes.
+
+        El tamaño se lleva como un total que suma `incremento` en cada escritura;
+        solo se recuenta la tabla cada RECUENTO_DISCO escrituras y antes de borrar.
+        """
+        with self._lock:
+            self._escrituras += 1
+            self._bytes_disco += incremento
+            total = self._bytes_disco
+            recontar = self._escrituras % RECUENTO_DISCO == 0
+        if recontar or total > self.max_bytes_disco:
+            total = self._contar_bytes(conn)
+        borradas = 0
+        if total > self.max_bytes_disco:
+            for clave, tamano in conn.execute("SELECT clave, tamano FROM respuestas ORDER BY usado ASC").fetchall():
+                conn.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+                borradas += 1
+                total -= tamano
+                if total <= self.max_bytes_disco:
+                    break
+        with self._lock:
+            self._bytes_disco = total
+            self._metricas["desalojadas_disco"] += borradas
+
+    def metricas(self):
+        """Contadores de aciertos/fallos más la tasa de aciertos y el tamaño en memoria."""
+        with self._lock:
+            datos = dict(self._metricas)
+            datos["entradas_memoria"] = len(self._memoria)
+            datos["bytes_disco"] = self._bytes_disco
+        consultas = datos.get("aciertos_memoria", 0) + datos.get("aciertos_disco", 0) + datos.get("fallos", 0)
+        datos["tasa_aciertos"] = (consultas - datos.get("fallos", 0)) / consultas if consultas else 0.0
+        return datos
@@ -0,0 +1,153 @@
+"""Compila paquetes de escenarios para jugar sin conexión (ver paquete_escenarios.py).
+
+Genera escenarios por nivel y, para cada uno, expande en anchura el árbol de
+decisiones (las 4 opciones de cada pregunta) con los mismos prompts que usa la
+aplicación, hasta la profundidad indicada. Poda las ramas que terminan la
+partida y las que superan el tope de nodos, y fusiona los estados parecidos:
+dos nodos del mismo escenario con el mismo número de pregunta, los mismos
+indicadores y un contexto casi igual (similitud de Jaccard entre las raíces de
+sus palabras) comparten subárbol.
+
+Ejemplos:
+    python compilar_paquete.py --salida aula.crispak --backend simulado
+    GEMINI_API_KEY=... python compilar_paquete.py --salida examen.crispak --niveles Principiante --profundidad 4
+    python compilar_paquete.py --salida aula.crispak --backend openai --endpoint http://10.0.0.5:8000/v1 --modelo llama-3.1-8b --hilos 32
+"""
+import argparse
+import collections
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import gemini_client
+import modelo_impacto
+import motor
+import paquete_escenarios
+import simulador
+
+PROFUNDIDAD = 3           # Decisiones precompiladas por escenario
+MAX_NODOS = 400           # Tope de nodos por escenario (el árbol completo crece como 4^profundidad)
+UMBRAL_FUSION = 0.8       # Similitud de contexto a partir de la cual dos estados se fusionan
+
+
+class Rama(NamedTuple):
+    """Nodo pendiente de expandir, con lo necesario para pedir sus turnos."""
+    nodo: int
+    numero: int
+    pregunta: object      # prompts.Pregunta
+    contexto: str
+    estado: dict
+    historial: list
+
+
+def similitud(a, b):
+    """Índice de Jaccard entre dos conjuntos de raíces."""
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def compilar_escenario(backend, escritor, escenario, nivel, pool, config, estadisticas):
+    """Expande el árbol de un escenario; devuelve su nodo raíz o None si falla la primera pregunta."""
+    estado, contexto = motor.estado_inicial(escenario), motor.contexto_inicial(escenario)
+    if not (primera := backend.pregunta(contexto, [], estado, nivel, 1)):
+        estadisticas["escenarios_fallidos"] += 1
+        return None
+    raiz = escritor.nodo(1, primera)
+    frontera, nodos = [Rama(raiz, 1, primera, contexto, estado, [])], 1
+    fusionables = collections.defaultdict(list) # (numero, estado) -> [(nodo, raíces del contexto)]
+
+    for _ in range(config["profundidad"]):
+        tareas = []
+        for rama in frontera:
+            for indice, opcion in enumerate(rama.pregunta.opciones):
+                historial = rama.historial + [{"pregunta": rama.pregunta.pregunta, "respuesta": opcion, "numero": rama.numero}]
+                tareas.append((rama, indice, opcion, historial))
+        resultados = pool.map(lambda t: backend.turno(t[0].contexto, t[0].pregunta.pregunta, t[2], t[0].estado,
+                                                      t[3], nivel, t[0].numero), tareas)
+        frontera = []
+        for (rama, indice, opcion, historial), (evaluacion, siguiente) in zip(tareas, resultados):
+            estadisticas["turnos"] += 1
+            if evaluacion is None:
+                estadisticas["turnos_fallidos"] += 1 # Sin arista: la aplicación lo generará en vivo
+                continue
+            hijo = paquete_escenarios.SIN_ARISTA
+            estado = motor.aplicar_impacto(rama.estado, evaluacion.impacto)
+            if siguiente and not motor.razon_fin(estado, rama.numero):
+                clave = (rama.numero + 1, tuple(estado.values()))
+                raices = set(modelo_impacto.raices(evaluacion.nuevo_contexto))
+                hijo = next((n for n, otras in fusionables[clave] if similitud(raices, otras) >= config["umbral_fusion"]),
+                            paquete_escenarios.SIN_ARISTA)
+                if hijo != paquete_escenarios.SIN_ARISTA:
+                    estadisticas["fusionados"] += 1
+                elif nodos < config["max_nodos"]:
+                    hijo, nodos = escritor.nodo(rama.numero + 1, siguiente), nodos + 1
+                    fusionables[clave].append((hijo, raices))
+                    frontera.append(Rama(hijo, rama.numero + 1, siguiente,
+                                         evaluacion.nuevo_contexto or rama.contexto, estado, historial))
+                else:
+                    estadisticas["podados"] += 1
+            escritor.arista(rama.nodo, indice, evaluacion, hijo)
+    estadisticas["nodos"] += nodos
+    return raiz
+
+
+def compilar(config):
+    """Genera y escribe el paquete; devuelve las estadísticas de la compilación."""
+    backend = simulador.crear_backend(config)
+    escritor = paquete_escenarios.EscritorPaquete()
+    estadisticas = collections.Counter()
+    meta = {"escenarios": {}, "profundidad": config["profundidad"], "creado": time.time(),
+            "backend": config["backend"], "modelo": config["modelo"] if config["backend"] != "simulado" else None}
+    inicio = time.monotonic()
+    with ThreadPoolExecutor(max_workers=config["hilos"]) as pool:
+        for nivel in config["niveles"]:
+            escenarios = []
+            for _ in range(simulador.INTENTOS_ESCENARIOS):
+                if escenarios := backend.escenarios(nivel):
+                    break
+            if not escenarios:
+                raise SystemExit(f"No se pudieron generar escenarios para el nivel {nivel}.")
+            meta["escenarios"][nivel] = []
+            for escenario in escenarios[:config["escenarios"]]:
+                if (raiz := compilar_escenario(backend, escritor, escenario, nivel, pool, config, estadisticas)) is not None:
+                    # Prefijo propio: los ids no deben coincidir con los de la biblioteca de escenarios
+                    meta["escenarios"][nivel].append(dict(escenario, id=f"paq-{escenario.get('id')}", nodo=raiz))
+                    estadisticas["escenarios"] += 1
+    estadisticas["bytes"] = escritor.escribir(config["salida"], meta)
+    estadisticas["segundos"] = round(time.monotonic() - inicio, 2)
+    return estadisticas
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompila escenarios y sus árboles de decisiones en un paquete para jugar sin conexión.")
+    parser.add_argument("--salida", required=True, help="Fichero del paquete (p. ej. aula.crispak)")
+    parser.add_argument("--backend", choices=["simulado", "gemini", "openai"], default="gemini")
+    parser.add_argument("--niveles", default=",".join(motor.NIVELES_DIFICULTAD), help="Niveles separados por comas")
+    parser.add_argument("--escenarios", type=int, default=5, help="Escenarios por nivel")
+    parser.add_argument("--profundidad", type=int, default=PROFUNDIDAD, help="Decisiones precompiladas por escenario")
+    parser.add_argument("--max-nodos", type=int, default=MAX_NODOS, help="Tope de nodos por escenario")
+    parser.add_argument("--umbral-fusion", type=float, default=UMBRAL_FUSION,
+                        help="Similitud de contexto (0-1) para fusionar estados; por encima de 1 no se fusiona nada")
+    parser.add_argument("--hilos", type=int, default=8, help="Llamadas simultáneas al expandir cada nivel del árbol")
+    parser.add_argument("--latencia", type=float, default=0.0, help="Latencia fija por llamada del backend simulado (s)")
+    parser.add_argument("--modelo", default=gemini_client.MODELO_POR_DEFECTO)
+    parser.add_argument("--endpoint", default=gemini_client.API_ENDPOINT_BASE,
+                        help="Base de la API; con --backend openai, p. ej. http://10.0.0.5:8000/v1")
+    args = parser.parse_args(argv)
+
+    config = dict(vars(args), niveles=[n.strip() for n in args.niveles.split(",") if n.strip()],
+                  api_key=os.environ.get("OPENAI_API_KEY" if args.backend == "openai" else "GEMINI_API_KEY"))
+    if args.backend == "gemini" and not config["api_key"]:
+        parser.error("El backend gemini necesita la variable de entorno GEMINI_API_KEY.")
+    if args.backend == "openai" and args.endpoint == gemini_client.API_ENDPOINT_BASE:
+        parser.error("El backend openai necesita --endpoint (la base de la API compatible con OpenAI).")
+
+    e = compilar(config)
+    print(f"{args.salida}: {e['escenarios']} escenarios, {e['nodos']} nodos, {e['turnos']} turnos "
+          f"({e['turnos_fallidos']} fallidos), {e['fusionados']} fusionados, {e['podados']} podados; "
+          f"{e['bytes']} bytes en {e['segundos']} s", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
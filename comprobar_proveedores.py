@@ -0,0 +1,100 @@
+"""Comprueba proveedores.ProveedorOpenAI contra el `/v1/chat/completions` de servidor_simulado.py.
+
+Sin servidor de inferencia ni clave: arranca el servidor simulado en un hilo
+y hace pasar por el adaptador lo que le pide la aplicación:
+
+1. una petición de texto libre;
+2. una petición con responseSchema (sale como `response_format` json_schema),
+   cuya respuesta debe validar con prompts.validar_pregunta, con y sin streaming;
+3. errores transitorios: con todas las respuestas en error se lanza HTTPError
+   tras agotar los reintentos; si el servidor se recupera a mitad, el
+   reintento devuelve la respuesta y la medición lo anota.
+
+Ejemplo:
+    python comprobar_proveedores.py
+"""
+import argparse
+import sys
+import threading
+import time
+
+import requests
+
+import gemini_client
+import motor
+import prompts
+import proveedores
+import servidor_simulado
+import telemetria
+
+MODELO = "simulado"
+TIMEOUT = 30
+
+
+def _prompt_pregunta():
+    escenario = {"titulo": "Fuga de datos", "trasfondo": "Se han filtrado datos de clientes.", "id": "comprobacion"}
+    return prompts.prompt_pregunta(motor.contexto_inicial(escenario), [], motor.estado_inicial(escenario), "Principiante", 1)
+
+
+def comprobar(servidor, proveedor):
+    errores = []
+
+    texto = proveedor.generar(MODELO, gemini_client.payload_texto("Resume la situación en una frase."), TIMEOUT)
+    if not isinstance(texto, str) or not texto:
+        errores.append(f"Texto libre vacío: {texto!r}")
+
+    payload = gemini_client.payload_texto(_prompt_pregunta(), prompts.ESQUEMA_PREGUNTA)
+    if "response_format" not in proveedor.cuerpo(MODELO, payload):
+        errores.append("El esquema no se envía como response_format")
+    medicion = telemetria.Medicion()
+    if prompts.validar_pregunta(prompts.cargar_json(proveedor.generar(MODELO, payload, TIMEOUT, medicion=medicion))) is None:
+        errores.append("La respuesta con esquema no valida como pregunta")
+    if not medicion.tokens_entrada:
+        errores.append("El uso de tokens no llega a la medición")
+    fragmentos = list(proveedor.stream(MODELO, payload, TIMEOUT))
+    if prompts.validar_pregunta(prompts.cargar_json("".join(fragmentos))) is None:
+        errores.append(f"La respuesta en streaming no valida como pregunta ({len(fragmentos)} fragmentos)")
+
+    servidor.tasa_error = 1.0
+    antes = servidor.contadores["errores"]
+    try:
+        proveedor.generar(MODELO, payload, TIMEOUT)
+        errores.append("Con todas las respuestas en error no se lanzó HTTPError")
+    except requests.exceptions.HTTPError:
+        if (intentos := servidor.contadores["errores"] - antes) != gemini_client.MAX_RETRIES + 1:
+            errores.append(f"{intentos} intentos fallidos; se esperaban {gemini_client.MAX_RETRIES + 1}")
+
+    # El servidor se recupera tras el primer error: el reintento debe devolver la respuesta
+    antes = servidor.contadores["errores"]
+    medicion, resultado = telemetria.Medicion(), []
+    hilo = threading.Thread(target=lambda: resultado.append(proveedor.generar(MODELO, payload, TIMEOUT, medicion=medicion)))
+    hilo.start()
+    while servidor.contadores["errores"] == antes and hilo.is_alive():
+        time.sleep(0.01)
+    servidor.tasa_error = 0.0
+    hilo.join(TIMEOUT)
+    if not resultado or prompts.validar_pregunta(prompts.cargar_json(resultado[0])) is None:
+        errores.append("Tras un error transitorio el reintento no devolvió una pregunta válida")
+    if medicion.reintentos < 1:
+        errores.append("El reintento no se anotó en la medición")
+    return errores
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Comprueba el adaptador OpenAI contra el servidor simulado.")
+    parser.parse_args(argv)
+
+    servidor = servidor_simulado.ServidorSimulado(0)
+    endpoint = servidor.iniciar().removesuffix("/v1beta/models") + "/v1"
+    try:
+        errores = comprobar(servidor, proveedores.ProveedorOpenAI(endpoint))
+    finally:
+        servidor.detener()
+    for error in errores:
+        print(error, file=sys.stderr)
+    print("Correcto" if not errores else f"{len(errores)} errores")
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
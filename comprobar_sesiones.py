@@ -0,0 +1,140 @@
+"""Comprueba la expulsión de sesiones contra un `streamlit run` real, sin clave ni cuota.
+
+AppTest mantiene el mismo st.session_state durante toda la prueba; el
+servidor real crea uno nuevo en cada ejecución del script, así que la
+contabilidad de memoria.py solo se puede comprobar de verdad aquí. Arranca
+servidor_simulado.py y la aplicación con un tiempo de inactividad de 1 s y
+habla con ella por su websocket, como un navegador:
+
+1. la sesión A carga la página de inicio y se queda quieta;
+2. la sesión B se ejecuta y, al terminar, expulsa a A;
+3. A vuelve a ejecutar solo el fragmento de su página (lo que hace un clic):
+   no debe haber excepciones y la partida se lee del almacén de sesiones;
+4. una pestaña C abre la URL de A (una pestaña duplicada) mientras A sigue
+   conectada: debe seguir con un token propio, no con la partida de A.
+
+Ejemplo:
+    python comprobar_sesiones.py --puerto 8599
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+import websockets
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+
+import servidor_simulado
+import telemetria
+
+DIRECTORIO = os.path.dirname(os.path.abspath(__file__))
+TIMEOUT = 60
+
+
+class Navegador:
+    """Una pestaña: ejecuta el script (o un fragmento) y recuerda la URL y los fragmentos que dibuja."""
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.consulta = ""
+        self.fragmento = None
+
+    async def ejecutar(self, fragmento=False):
+        """Excepciones que muestra la ejecución (vacía si fue bien)."""
+        mensaje = BackMsg()
+        mensaje.rerun_script.query_string = self.consulta
+        if fragmento:
+            mensaje.rerun_script.fragment_id = self.fragmento
+        await self.ws.send(mensaje.SerializeToString())
+        excepciones, fin = [], time.monotonic() + TIMEOUT
+        while time.monotonic() < fin:
+            recibido = ForwardMsg()
+            recibido.ParseFromString(await asyncio.wait_for(self.ws.recv(), TIMEOUT))
+            tipo = recibido.WhichOneof("type")
+            if tipo == "page_info_changed":
+                self.consulta = recibido.page_info_changed.query_string # El token de la partida
+            elif tipo == "delta":
+                self.fragmento = recibido.delta.fragment_id or self.fragmento
+                if recibido.delta.new_element.WhichOneof("type") == "exception":
+                    excepciones.append(recibido.delta.new_element.exception.message)
+            elif tipo == "script_finished" and recibido.script_finished != ForwardMsg.FINISHED_EARLY_FOR_RERUN:
+                return excepciones
+        return excepciones + ["Sin respuesta de la aplicación"]
+
+
+def _metricas(puerto):
+    """{(fuente, métrica): valor} de las fuentes exportadas por la aplicación."""
+    texto = urllib.request.urlopen(f"http://127.0.0.1:{puerto}/metrics", timeout=10).read().decode()
+    valores = {}
+    for linea in texto.splitlines():
+        if linea.startswith(f"{telemetria.PREFIJO}_fuente{{"):
+            etiquetas, valor = linea.rsplit(" ", 1)
+            fuente, metrica = (parte.split("=")[1].strip('"') for parte in etiquetas[etiquetas.index("{") + 1:-1].split(","))
+            valores[(fuente, metrica)] = float(valor)
+    return valores
+
+
+async def comprobar(puerto, puerto_metricas):
+    for _ in range(TIMEOUT * 2):
+        try:
+            urllib.request.urlopen(f"http://127.0.0.1:{puerto}/_stcore/health", timeout=1)
+            break
+        except OSError:
+            await asyncio.sleep(0.5)
+    url = f"ws://127.0.0.1:{puerto}/_stcore/stream"
+    errores = []
+    async with websockets.connect(url, max_size=None) as ws_a, websockets.connect(url, max_size=None) as ws_b, \
+               websockets.connect(url, max_size=None) as ws_c:
+        a, b, c = Navegador(ws_a), Navegador(ws_b), Navegador(ws_c)
+        errores += await a.ejecutar()
+        await asyncio.sleep(2) # A inactiva más de CRISIS_SESION_INACTIVA
+        errores += await b.ejecutar()
+        antes = _metricas(puerto_metricas)
+        errores += await a.ejecutar(fragmento=True)
+        despues = _metricas(puerto_metricas)
+        c.consulta = a.consulta
+        errores += await c.ejecutar()
+    if not antes.get(("memoria", "expulsadas_inactivas")):
+        errores.append("La sesión inactiva no se expulsó")
+    if despues.get(("sesiones", "lecturas"), 0) <= antes.get(("sesiones", "lecturas"), 0):
+        errores.append("La sesión expulsada no se restauró del almacén")
+    if "sesion=" not in a.consulta or c.consulta == a.consulta:
+        errores.append("La pestaña duplicada comparte el token de la original")
+    return errores
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Comprueba la expulsión de sesiones contra streamlit run.")
+    parser.add_argument("--puerto", type=int, default=8599)
+    parser.add_argument("--puerto-metricas", type=int, default=9499)
+    args = parser.parse_args(argv)
+
+    directorio = tempfile.mkdtemp(prefix="comprobar-sesiones-")
+    servidor = servidor_simulado.ServidorSimulado(0)
+    endpoint = servidor.iniciar()
+    entorno = dict(os.environ, CRISIS_GEMINI_ENDPOINT=endpoint, GEMINI_API_KEY="comprobacion",
+                   CRISIS_SESION_INACTIVA="1", CRISIS_BARRIDO_SESIONES="0", CRISIS_METRICAS_PUERTO=str(args.puerto_metricas),
+                   **{f"CRISIS_{nombre}": os.path.join(directorio, f"{nombre.lower()}.sqlite3")
+                      for nombre in ("ESCENARIOS_DB", "CACHE_LLM_DB", "IMPACTO_DB", "SESIONES", "SIMILITUD_DB", "RESULTADOS_DB")})
+    app = subprocess.Popen([sys.executable, "-m", "streamlit", "run", os.path.join(DIRECTORIO, "app.py"),
+                            "--server.headless", "true", "--server.port", str(args.puerto)],
+                           cwd=directorio, env=entorno, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        errores = asyncio.run(comprobar(args.puerto, args.puerto_metricas))
+    finally:
+        app.terminate()
+        app.wait()
+        servidor.detener()
+    for error in errores:
+        print(error, file=sys.stderr)
+    print("Correcto" if not errores else f"{len(errores)} errores")
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
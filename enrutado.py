@@ -0,0 +1,140 @@
+"""Enrutado de las llamadas a Gemini entre modelos, por tipo de llamada y nivel.
+
+Cada tipo de llamada ("escenarios", "pregunta", "evaluacion", "turno") tiene
+una ruta por nivel de dificultad: un modelo principal y, opcionalmente, uno
+alternativo más rápido. Las preguntas de cuatro opciones van al modelo
+rápido; los escenarios, que se generan en segundo plano, y el análisis del
+nivel Avanzado, al modelo más capaz.
+
+El enrutador observa la latencia y los errores de cada (tipo, modelo) en una
+ventana deslizante. Si el p95 del principal supera el límite del tipo o su
+tasa de error supera el umbral, la ruta se degrada al alternativo. Pasado el
+enfriamiento se manda una llamada de sondeo al principal: si vuelve a tiempo
+y sin error, la ruta se recupera; si no, sigue degradada otro enfriamiento.
+Las elecciones y sus motivos se cuentan para poder auditar el enrutado.
+"""
+import collections
+import threading
+import time
+from typing import NamedTuple, Optional
+
+import gemini_client
+import plazos
+
+RAPIDO = gemini_client.MODELO_POR_DEFECTO
+PROFUNDO = "gemini-1.5-pro-latest"
+CUALQUIER_NIVEL = "*"
+
+# tipo -> {nivel o "*": [principal, alternativo]}; CRISIS_RUTAS_MODELOS las sustituye por tipo
+RUTAS = {
+    "escenarios": {CUALQUIER_NIVEL: [PROFUNDO, RAPIDO]},
+    "pregunta": {CUALQUIER_NIVEL: [RAPIDO]},
+    "evaluacion": {"Avanzado": [PROFUNDO, RAPIDO], CUALQUIER_NIVEL: [RAPIDO]},
+    "turno": {"Avanzado": [PROFUNDO, RAPIDO], CUALQUIER_NIVEL: [RAPIDO]},
+}
+# p95 (segundos) por encima del cual se degrada la ruta; por debajo de los plazos de la aplicación
+LIMITES_P95 = {"escenarios": 60, "pregunta": 8, "evaluacion": 20, "turno": 25}
+UMBRAL_ERROR = 0.2        # Tasa de error en la ventana que degrada la ruta
+VENTANA = 50              # Llamadas recientes observadas por (tipo, modelo)
+MINIMO_MUESTRAS = 10      # Por debajo de esto no se degrada nada
+ENFRIAMIENTO = 60         # Segundos degradada antes de sondear de nuevo el principal
+
+
+class Ruta(NamedTuple):
+    principal: str
+    alternativo: Optional[str] = None
+
+
+class _Observado:
+    """Ventana de latencias y errores de un (tipo, modelo), con el estado de su ruta si es principal."""
+
+    def __init__(self, ventana):
+        self.latencias = plazos.HistorialLatencias(ventana)
+        self.errores = collections.deque(maxlen=ventana)
+        self.degradado_desde = None
+        self.sondeando = False
+
+    def tasa_error(self):
+        return sum(self.errores) / len(self.errores) if self.errores else 0.0
+
+
+class Enrutador:
+    """Elige el modelo de cada llamada y se adapta a lo observado; seguro para varios hilos."""
+
+    def __init__(self, rutas=None, limites_p95=None, umbral_error=UMBRAL_ERROR, ventana=VENTANA,
+                 minimo_muestras=MINIMO_MUESTRAS, enfriamiento=ENFRIAMIENTO, por_defecto=RAPIDO):
+        self.rutas = {tipo: {nivel: Ruta(*modelos) for nivel, modelos in niveles.items()}
+                      for tipo, niveles in {**RUTAS, **(rutas or {})}.items()}
+        self.limites_p95 = {**LIMITES_P95, **(limites_p95 or {})}
+        self.umbral_error = umbral_error
+        self.ventana = ventana
+        self.minimo_muestras = minimo_muestras
+        self.enfriamiento = enfriamiento
+        self.por_defecto = por_defecto
+        self._observados = {} # (tipo, modelo) -> _Observado
+        self._lock = threading.Lock()
+        self._elecciones = collections.Counter() # (tipo, modelo, motivo) -> n
+        self._metricas = collections.Counter()
+
+    def ruta(self, tipo, nivel=None):
+        niveles = self.rutas.get(tipo, {})
+        return niveles.get(nivel) or niveles.get(CUALQUIER_NIVEL) or Ruta(self.por_defecto)
+
+    def _observado(self, tipo, modelo):
+        if (observado := self._observados.get((tipo, modelo))) is None:
+            observado = self._observados[(tipo, modelo)] = _Observado(self.ventana)
+        return observado
+
+    def elegir(self, tipo, nivel=None):
+        """Modelo para una llamada de `tipo` en ese nivel: el principal salvo que su ruta esté degradada."""
+        principal, alternativo = self.ruta(tipo, nivel)
+        with self._lock:
+            observado = self._observado(tipo, principal)
+            if alternativo is None or observado.degradado_desde is None:
+                modelo, motivo = principal, "principal"
+            elif time.monotonic() - observado.degradado_desde >= self.enfriamiento:
+                # Una sola llamada de sondeo por enfriamiento; si no llega a medirse, habrá otra en el siguiente
+                observado.degradado_desde, observado.sondeando = time.monotonic(), True
+                modelo, motivo = principal, "sondeo"
+            else:
+                modelo, motivo = alternativo, "degradado"
+            self._elecciones[(tipo, modelo, motivo)] += 1
+        return modelo
+
+    def registrar(self, tipo, modelo, segundos, error=None):
+        """Observa una llamada real (p. ej. desde telemetria.Registro.observar)."""
+        limite = self.limites_p95.get(tipo)
+        with self._lock:
+            observado = self._observado(tipo, modelo)
+            observado.latencias.registrar(segundos)
+            observado.errores.append(error is not None)
+            if observado.sondeando:
+                observado.sondeando = False
+                if error is None and (limite is None or segundos <= limite):
+                    observado.degradado_desde = None
+                    observado.latencias = plazos.HistorialLatencias(self.ventana) # Lo anterior ya no describe al modelo
+                    observado.latencias.registrar(segundos)
+                    observado.errores.clear()
+                    observado.errores.append(False)
+                    self._metricas["recuperaciones"] += 1
+            elif observado.degradado_desde is None and len(observado.errores) >= self.minimo_muestras:
+                p95 = observado.latencias.percentil(95, self.minimo_muestras)
+                if (limite is not None and p95 > limite) or observado.tasa_error() > self.umbral_error:
+                    observado.degradado_desde = time.monotonic()
+                    self._metricas["degradaciones"] += 1
+
+    def degradadas(self):
+        """[(tipo, modelo principal)] de las rutas que ahora mismo van al alternativo."""
+        with self._lock:
+            return sorted(clave for clave, observado in self._observados.items() if observado.degradado_desde is not None)
+
+    def metricas(self):
+        """Contadores, elecciones por tipo/modelo/motivo y p95 y tasa de error de cada modelo observado."""
+        with self._lock:
+            datos = dict(self._metricas)
+            datos["elecciones"] = {f"{tipo}_{modelo}_{motivo}": n for (tipo, modelo, motivo), n in self._elecciones.items()}
+            datos["p95"] = {f"{tipo}_{modelo}": p95 for (tipo, modelo), o in self._observados.items()
+                            if (p95 := o.latencias.percentil(95, 1)) is not None}
+            datos["tasa_error"] = {f"{tipo}_{modelo}": o.tasa_error() for (tipo, modelo), o in self._observados.items()}
+            datos["degradadas"] = sum(o.degradado_desde is not None for o in self._observados.values())
+        return datos
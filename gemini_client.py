@@ -0,0 +1,203 @@
+"""Cliente HTTP compartido para la API de Gemini.
+
+Una sola `requests.Session` por proceso mantiene vivas las conexiones TLS entre
+llamadas, limita las conexiones simultáneas por host y reintenta los fallos
+transitorios (429, 5xx, errores de conexión) con backoff exponencial con jitter,
+respetando la cabecera Retry-After cuando el servidor la envía.
+"""
+import email.utils
+import json
+import os
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+MODELO_POR_DEFECTO = "gemini-1.5-flash-latest"
+ENDPOINT_GEMINI = "https://generativelanguage.googleapis.com/v1beta/models"
+# Apuntar a otro servidor compatible (p. ej. servidor_simulado.py) para medir sin clave ni cuota
+API_ENDPOINT_BASE = os.environ.get("CRISIS_GEMINI_ENDPOINT", ENDPOINT_GEMINI)
+
+# --- Configuración del pool y de los reintentos ---
+POOL_CONNECTIONS = 4      # Hosts distintos con pool propio
+POOL_MAXSIZE = 10         # Conexiones simultáneas máximas por host (las demás esperan)
+MAX_RETRIES = 3           # Reintentos tras el primer intento
+BACKOFF_BASE = 1.0        # Segundos; la espera máxima crece como base * 2^intento
+BACKOFF_MAX = 20.0        # Tope de la espera calculada por backoff
+RETRY_AFTER_MAX = 30.0    # Si el servidor pide esperar más que esto, no se reintenta
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+
+
+def crear_sesion(pool_maxsize=POOL_MAXSIZE):
+    """Crea una sesión con pool de conexiones persistentes y acotado por host."""
+    session = requests.Session()
+    # pool_block=True hace que, al agotarse el pool, las peticiones esperen una
+    # conexión libre en lugar de abrir conexiones extra: limita la concurrencia por host.
+    adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize,
+                          pool_block=True, max_retries=0)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers.update({"Content-Type": "application/json"})
+    return session
+
+
+def _segundos_retry_after(valor):
+    """Interpreta Retry-After (segundos o fecha HTTP). Devuelve None si no es válido."""
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        fecha = email.utils.parsedate_to_datetime(valor)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, fecha.timestamp() - time.time())
+
+
+def calcular_espera(intento, retry_after=None):
+    """Espera antes del reintento `intento` (0 = primer reintento).
+
+    Usa "full jitter": un valor aleatorio entre 0 y base * 2^intento (acotado),
+    para que muchas sesiones reintentando a la vez no lleguen sincronizadas.
+    Si el servidor indicó Retry-After, nunca se espera menos que eso.
+    """
+    espera = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** intento)))
+    segundos = _segundos_retry_after(retry_after)
+    if segundos is not None:
+        espera = max(espera, segundos)
+    return espera
+
+
+def post_json(session, url, payload, timeout, max_retries=MAX_RETRIES, stream=False, admitir=None, medicion=None):
+    """POST con reintentos para fallos transitorios. Devuelve la `Response` final.
+
+    `admitir()`, si se indica, se llama antes de cada intento (incluidos los
+    reintentos) y puede bloquear hasta que haya cuota; ver admision.py.
+    `medicion` (telemetria.Medicion) anota los reintentos, la espera de cuota
+    y, sin streaming, el tiempo hasta las cabeceras de la respuesta.
+
+    Lanza `requests.HTTPError` para respuestas de error no recuperables (o cuando
+    se agotan los reintentos) y `requests.RequestException` para errores de red.
+    Los timeouts de lectura no se reintentan: la generación pudo haberse
+    completado en el servidor y repetirla duplicaría la espera del jugador.
+    """
+    for intento in range(max_retries + 1):
+        ultimo = intento == max_retries
+        if intento and medicion:
+            medicion.reintento()
+        if admitir:
+            espera_cuota = admitir()
+            if medicion and espera_cuota:
+                medicion.espera_cuota += espera_cuota
+        enviado = time.monotonic()
+        try:
+            response = session.post(url, json=payload, timeout=timeout, stream=stream)
+        except requests.exceptions.ConnectionError:
+            if ultimo:
+                raise
+            time.sleep(calcular_espera(intento))
+            continue
+
+        if response.status_code in RETRY_STATUS and not ultimo:
+            espera = calcular_espera(intento, response.headers.get("Retry-After"))
+            if espera <= RETRY_AFTER_MAX:
+                response.close()
+                time.sleep(espera)
+                continue
+
+        response.raise_for_status()
+        if medicion and not stream:
+            medicion.primer_byte(enviado + response.elapsed.total_seconds())
+        return response
+
+
+class RespuestaInesperada(ValueError):
+    """La API respondió 200 pero sin texto en `candidates[0].content.parts[0]`."""
+
+    def __init__(self, response_json):
+        super().__init__("Respuesta de Gemini sin texto generado")
+        self.response_json = response_json
+
+
+def payload_texto(prompt, esquema=None):
+    """Cuerpo de `generateContent` para un prompt de texto.
+
+    Con `esquema`, pide salida estructurada: JSON puro que cumple ese responseSchema.
+    Si el prompt trae un atributo `temperatura` (p. ej. prompts.PromptDeterminista),
+    se pide con esa temperature; si trae `sistema` (prompts.Prompt), va como
+    systemInstruction, por delante del texto.
+    """
+    payload = {"contents": [{"parts": [{"text": str(prompt)}]}]}
+    if sistema := getattr(prompt, "sistema", None):
+        payload["systemInstruction"] = {"parts": [{"text": sistema}]}
+    config = {}
+    if esquema is not None:
+        config.update(responseMimeType="application/json", responseSchema=esquema)
+    if (temperatura := getattr(prompt, "temperatura", None)) is not None:
+        config["temperature"] = temperatura
+    if config:
+        payload["generationConfig"] = config
+    return payload
+
+
+def _texto_o_none(response_json):
+    if (candidates := response_json.get("candidates")) and \
+       isinstance(candidates, list) and len(candidates) > 0 and \
+       (content := candidates[0].get("content")) and \
+       isinstance(content, dict) and \
+       (parts := content.get("parts")) and \
+       isinstance(parts, list) and len(parts) > 0 and \
+       (text := parts[0].get("text")):
+        return text
+    return None
+
+
+def extraer_texto(response_json):
+    """Devuelve el texto generado o lanza `RespuestaInesperada`."""
+    if (text := _texto_o_none(response_json)) is None:
+        raise RespuestaInesperada(response_json)
+    return text
+
+
+def generar_texto(session, url, payload, timeout, admitir=None, medicion=None):
+    """Llamada completa sin interfaz: POST con reintentos y extracción del texto.
+
+    Pensada para hilos de fondo, donde no se puede usar `st.error`; los errores
+    se propagan como excepciones de `requests`, `json` o `RespuestaInesperada`.
+    """
+    return generar_respuesta(session, url, payload, timeout, admitir, medicion)[0]
+
+
+def generar_respuesta(session, url, payload, timeout, admitir=None, medicion=None):
+    """Como generar_texto, pero devuelve (texto, usageMetadata) para contabilizar tokens."""
+    response_json = post_json(session, url, payload, timeout, admitir=admitir, medicion=medicion).json()
+    uso = response_json.get("usageMetadata") or {}
+    if medicion:
+        medicion.uso(uso)
+    return extraer_texto(response_json), uso
+
+
+def stream_texto(session, url, payload, timeout, admitir=None, medicion=None):
+    """Genera los fragmentos de texto de `streamGenerateContent?alt=sse` según llegan.
+
+    Solo se reintenta antes de recibir la respuesta; una vez empezado el stream,
+    los errores se propagan. Cerrar el generador aborta la descarga.
+    """
+    response = post_json(session, url, payload, timeout, stream=True, admitir=admitir, medicion=medicion)
+    response.encoding = "utf-8" # SSE siempre es UTF-8; sin esto iter_lines devolvería bytes
+    try:
+        for linea in response.iter_lines(decode_unicode=True):
+            if not linea or not linea.startswith("data:"):
+                continue
+            evento = json.loads(linea[5:])
+            if medicion and (uso := evento.get("usageMetadata")):
+                medicion.uso(uso) # Acumulado: el último evento trae el total
+            if texto := _texto_o_none(evento):
+                if medicion:
+                    medicion.primer_byte()
+                yield texto
+    finally:
+        response.close()
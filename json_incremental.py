@@ -0,0 +1,133 @@
+"""Parser JSON incremental para respuestas en streaming.
+
+Recibe el texto por fragmentos y avisa en cuanto se completa cada miembro del
+objeto (o elemento de la lista) de primer nivel, y cada elemento de las listas
+que cuelgan de él, sin esperar al final de la respuesta. Así se puede pintar
+el 'analisis' o cada opción según llegan, y abortar la petición en cuanto el
+texto deja de parecer el JSON esperado.
+
+Eventos devueltos por `alimentar`:
+- ("campo", clave, valor): miembro completo del objeto de primer nivel.
+- ("elemento", clave, indice, valor): elemento completo de una lista; `clave`
+  es None si la lista es el propio valor de primer nivel.
+"""
+import json
+
+_CIERRES = {'{': '}', '[': ']'}
+
+
+class JSONMalformado(ValueError):
+    """El texto recibido no puede ser el JSON esperado."""
+
+
+class ParserJSONIncremental:
+    def __init__(self):
+        self.texto = ""        # Todo lo recibido, tal cual (incluidas las vallas ```json)
+        self.completo = False
+        self._inicio = None    # Índice del primer '{' o '[' en self.texto
+        self._i = 0            # Siguiente carácter por examinar
+        self._pila = []        # Contenedores abiertos: [apertura, inicio_miembro, clave, indice]
+        self._en_cadena = False
+        self._escape = False
+        self._valor = None
+
+    def alimentar(self, fragmento):
+        """Añade texto y devuelve la lista de eventos que completa. Lanza `JSONMalformado`."""
+        self.texto += fragmento
+        if self._inicio is None and not self._buscar_inicio():
+            return []
+        eventos = []
+        texto = self.texto
+        while self._i < len(texto) and not self.completo:
+            c = texto[self._i]
+            if self._en_cadena:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._en_cadena = False
+            elif c == '"':
+                self._en_cadena = True
+            elif c in _CIERRES:
+                clave = None
+                if len(self._pila) == 1 and self._pila[0][0] == '{' and c == '[':
+                    # Lista colgando de un miembro del objeto: recordar su clave
+                    clave = self._clave_de(texto[self._pila[0][1]:self._i])
+                self._pila.append([c, self._i + 1, clave, 0])
+            elif c in '}]':
+                if not self._pila or _CIERRES[self._pila[-1][0]] != c:
+                    raise JSONMalformado(f"'{c}' inesperado en la posición {self._i}")
+                self._cerrar_miembro(eventos, texto)
+                self._pila.pop()
+                if not self._pila:
+                    self._terminar(texto)
+            elif c == ',':
+                if not self._pila:
+                    raise JSONMalformado(f"',' fuera de un contenedor en la posición {self._i}")
+                self._cerrar_miembro(eventos, texto)
+                self._pila[-1][1] = self._i + 1
+            self._i += 1
+        return eventos
+
+    def resultado(self):
+        """Valor completo ya parseado. Lanza `JSONMalformado` si el JSON no terminó."""
+        if not self.completo:
+            raise JSONMalformado("La respuesta terminó antes de cerrar el JSON")
+        return self._valor
+
+    def _buscar_inicio(self):
+        """Salta espacios y una valla ```json inicial; exige que el JSON empiece por '{' o '['."""
+        resto = self.texto.lstrip()
+        desplazamiento = len(self.texto) - len(resto)
+        if resto.startswith("```") or "```".startswith(resto):
+            fin_linea = resto.find("\n")
+            if fin_linea < 0:
+                return False # La línea de la valla aún no ha llegado completa
+            siguiente = resto[fin_linea + 1:]
+            desplazamiento += fin_linea + 1 + len(siguiente) - len(siguiente.lstrip())
+            resto = siguiente.lstrip()
+        if not resto:
+            return False
+        if resto[0] not in _CIERRES:
+            raise JSONMalformado(f"La respuesta no empieza por un JSON: {resto[:40]!r}")
+        self._inicio = desplazamiento
+        self._i = desplazamiento + 1
+        self._pila = [[resto[0], self._i, None, 0]]
+        return True
+
+    def _cerrar_miembro(self, eventos, texto):
+        """Emite el miembro/elemento que termina en self._i si está en un nivel vigilado."""
+        marco = self._pila[-1]
+        trozo = texto[marco[1]:self._i].strip()
+        if not trozo:
+            return
+        profundidad = len(self._pila)
+        if profundidad == 1:
+            if marco[0] == '{':
+                (clave, valor), = self._cargar("{" + trozo + "}").items()
+                eventos.append(("campo", clave, valor))
+            else:
+                eventos.append(("elemento", None, marco[3], self._cargar(trozo)))
+                marco[3] += 1
+        elif profundidad == 2 and marco[0] == '[' and self._pila[0][0] == '{':
+            eventos.append(("elemento", marco[2], marco[3], self._cargar(trozo)))
+            marco[3] += 1
+
+    def _clave_de(self, trozo):
+        """Extrae la clave de un fragmento '"clave":' previo a un valor."""
+        trozo = trozo.strip()
+        if not trozo.endswith(":"):
+            raise JSONMalformado(f"Se esperaba 'clave:' antes de la lista, se recibió {trozo[:40]!r}")
+        return self._cargar(trozo[:-1])
+
+    def _terminar(self, texto):
+        self._valor = self._cargar(texto[self._inicio:self._i + 1])
+        self.completo = True
+
+    @staticmethod
+    def _cargar(trozo):
+        try:
+            return json.loads(trozo)
+        except json.JSONDecodeError as e:
+            raise JSONMalformado(f"Fragmento JSON inválido: {e}") from e
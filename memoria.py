@@ -0,0 +1,208 @@
+"""Memoria de las sesiones: escenarios compartidos, contabilidad por sesión y expulsión.
+
+- Los escenarios son registros inmutables (`Escenario`, un dict de solo
+  lectura) internados por id en un `RegistroEscenarios` del proceso: todas las
+  sesiones que muestran el mismo escenario comparten el mismo objeto, y en su
+  estado solo guardan los ids. El registro tiene un máximo de entradas; lo que
+  se descarta se recupera de donde vino (biblioteca o paquete) al pedirlo.
+- `tamano(valor)` estima los bytes de un valor recorriendo lo que contiene;
+  los `Escenario` compartidos no se cuentan en ninguna sesión.
+- `ContabilidadSesiones` anota los bytes y la última actividad de cada sesión
+  y decide cuáles expulsar: las inactivas más de `inactiva_tras` segundos y,
+  si el total supera el presupuesto, las menos recientes hasta volver a estar
+  por debajo. Qué se libera al expulsar lo decide la aplicación (ver app.py);
+  mientras tanto la sesión no puede volver a ejecutarse.
+"""
+import collections
+import sys
+import threading
+import time
+
+MAX_ESCENARIOS = 500          # Escenarios internados en memoria (los menos usados se descartan)
+INACTIVA_TRAS = 1800          # Segundos sin ejecutar el script tras los que se expulsa una sesión
+PRESUPUESTO = 256 * 1024**2   # Bytes máximos del estado de todas las sesiones juntas
+INTERVALO_BARRIDO = 30        # Segundos mínimos entre búsquedas de sesiones inactivas
+
+
+class Escenario(dict):
+    """Escenario internado: un dict de solo lectura (también sus dicts anidados) compartido por todas las sesiones.
+
+    Se serializa a JSON como cualquier dict; para modificarlo, `dict(escenario, campo=...)`.
+    """
+
+    def _solo_lectura(self, *args, **kwargs):
+        raise TypeError("Los escenarios internados son de solo lectura; usa dict(escenario, ...) para modificarlos")
+
+    __setitem__ = __delitem__ = __ior__ = _solo_lectura
+    clear = pop = popitem = setdefault = update = _solo_lectura
+
+
+def tamano(valor, vistos=None):
+    """Bytes aproximados de `valor` y de lo que contiene (sys.getsizeof recursivo, cada objeto una vez).
+
+    Los `Escenario` internados son compartidos: no cuentan.
+    """
+    vistos = set() if vistos is None else vistos
+    if id(valor) in vistos or isinstance(valor, Escenario):
+        return 0
+    vistos.add(id(valor))
+    total = sys.getsizeof(valor)
+    if isinstance(valor, dict):
+        total += sum(tamano(clave, vistos) + tamano(v, vistos) for clave, v in valor.items())
+    elif isinstance(valor, (list, tuple, set, frozenset)):
+        total += sum(tamano(v, vistos) for v in valor)
+    return total
+
+
+def _congelar(valor):
+    if isinstance(valor, dict) and not isinstance(valor, Escenario):
+        return Escenario({clave: _congelar(v) for clave, v in valor.items()})
+    if isinstance(valor, list):
+        return [_congelar(v) for v in valor]
+    return valor
+
+
+class RegistroEscenarios:
+    """Escenarios internados por id (LRU acotado); seguro para varios hilos.
+
+    `resolver(id)` devuelve el escenario de un id que no está en memoria (o None).
+    """
+
+    def __init__(self, resolver=None, maximo=MAX_ESCENARIOS):
+        self.resolver = resolver
+        self.maximo = maximo
+        self._registros = collections.OrderedDict() # id -> Escenario
+        self._lock = threading.Lock()
+        self.metricas = collections.Counter()
+
+    def internar(self, escenario):
+        """El Escenario compartido para ese contenido: el ya internado si es igual, o uno nuevo que lo sustituye."""
+        if (escenario_id := escenario.get('id')) is None:
+            return _congelar(escenario)
+        with self._lock:
+            actual = self._registros.get(escenario_id)
+            if actual is None or actual != escenario: # Distinto: trae anotaciones nuevas (p. ej. la primera pregunta)
+                actual = self._registros[escenario_id] = _congelar(escenario)
+                self.metricas["internados"] += 1
+            self._registros.move_to_end(escenario_id)
+            while len(self._registros) > self.maximo:
+                self._registros.popitem(last=False)
+                self.metricas["descartados"] += 1
+        return actual
+
+    def obtener(self, escenario_id):
+        """El Escenario con ese id, recuperándolo con `resolver` si ya no está en memoria; o None."""
+        with self._lock:
+            if (actual := self._registros.get(escenario_id)) is not None:
+                self._registros.move_to_end(escenario_id)
+                self.metricas["aciertos"] += 1
+                return actual
+        self.metricas["recuperados"] += 1
+        escenario = self.resolver(escenario_id) if self.resolver else None
+        return self.internar(escenario) if escenario else None
+
+    def bytes(self):
+        with self._lock:
+            registros = list(self._registros.values())
+        vistos = set()
+        return sum(tamano(dict(escenario), vistos) for escenario in registros)
+
+    def __len__(self):
+        return len(self._registros)
+
+
+class _Sesion:
+    def __init__(self):
+        self.bytes = 0
+        self.actividad = time.monotonic()
+        self.en_curso = True
+        self.expulsando = False
+
+
+class ContabilidadSesiones:
+    """Bytes y actividad de las sesiones del proceso; elige las que hay que expulsar. Seguro para varios hilos.
+
+    No guarda el estado de ninguna sesión: `localizar(id)` lo busca al
+    expulsar (None si la sesión ya se cerró), así no alarga la vida de las que
+    el servidor ya descartó. Una sesión elegida para expulsar queda bloqueada
+    hasta `expulsada`: si vuelve a ejecutarse mientras tanto, `empezar` espera.
+    """
+
+    def __init__(self, localizar, inactiva_tras=INACTIVA_TRAS, presupuesto=PRESUPUESTO, intervalo=INTERVALO_BARRIDO):
+        self.localizar = localizar
+        self.inactiva_tras = inactiva_tras
+        self.presupuesto = presupuesto
+        self.intervalo = intervalo
+        self._sesiones = {} # id de sesión -> _Sesion
+        self._ultimo_barrido = 0.0
+        self._cambio = threading.Condition()
+        self.metricas = collections.Counter()
+
+    def empezar(self, id_sesion):
+        """La sesión empieza a ejecutar el script: mientras tanto no se expulsa (si se está expulsando, espera)."""
+        with self._cambio:
+            while (sesion := self._sesiones.get(id_sesion)) is not None and sesion.expulsando:
+                self._cambio.wait()
+            if sesion is None:
+                sesion = self._sesiones[id_sesion] = _Sesion()
+            sesion.en_curso, sesion.actividad = True, time.monotonic()
+
+    def terminar(self, id_sesion, bytes_estado):
+        """La sesión terminó de ejecutar el script con un estado de `bytes_estado` bytes."""
+        with self._cambio:
+            if (sesion := self._sesiones.get(id_sesion)) is not None:
+                sesion.en_curso, sesion.actividad, sesion.bytes = False, time.monotonic(), bytes_estado
+
+    def bytes_de(self, id_sesion):
+        with self._cambio:
+            return sesion.bytes if (sesion := self._sesiones.get(id_sesion)) else 0
+
+    def barrer(self, excepto=None):
+        """[(id de sesión, estado)] que hay que expulsar ahora; cada una queda bloqueada hasta `expulsada`.
+
+        Las inactivas (y las ya cerradas, que se dejan de contabilizar) se buscan
+        como mucho cada `intervalo` segundos; el presupuesto se comprueba siempre.
+        """
+        ahora = time.monotonic()
+        elegidas = []
+        with self._cambio:
+            libres = sorted((s.actividad, i) for i, s in self._sesiones.items()
+                            if not s.en_curso and not s.expulsando and i != excepto)
+            if ahora - self._ultimo_barrido >= self.intervalo:
+                self._ultimo_barrido = ahora
+                elegidas = [i for actividad, i in libres if ahora - actividad >= self.inactiva_tras]
+                self.metricas["expulsadas_inactivas"] += len(elegidas)
+            total = sum(s.bytes for i, s in self._sesiones.items() if i not in elegidas)
+            for _, id_sesion in libres:
+                if total <= self.presupuesto:
+                    break
+                if id_sesion not in elegidas:
+                    elegidas.append(id_sesion)
+                    total -= self._sesiones[id_sesion].bytes
+                    self.metricas["expulsadas_presupuesto"] += 1
+            for id_sesion in elegidas:
+                self._sesiones[id_sesion].expulsando = True
+        expulsar = []
+        for id_sesion in elegidas:
+            if (estado := self.localizar(id_sesion)) is None:
+                self.expulsada(id_sesion) # El servidor ya la cerró
+            else:
+                expulsar.append((id_sesion, estado))
+        return expulsar
+
+    def expulsada(self, id_sesion, liberada=True):
+        """Fin de la expulsión: la sesión deja de contabilizarse o, si no se liberó, vuelve a estar disponible."""
+        with self._cambio:
+            if liberada:
+                self._sesiones.pop(id_sesion, None)
+            elif (sesion := self._sesiones.get(id_sesion)) is not None:
+                sesion.expulsando = False
+            self._cambio.notify_all()
+
+    def resumen(self):
+        """Sesiones contabilizadas, bytes totales, de la mayor y media, y contadores de expulsiones."""
+        with self._cambio:
+            tamanos = [s.bytes for s in self._sesiones.values()]
+        return dict(self.metricas, sesiones=len(tamanos), bytes_sesiones=sum(tamanos),
+                    bytes_sesion_max=max(tamanos, default=0), bytes_sesion_media=sum(tamanos) // len(tamanos) if tamanos else 0,
+                    presupuesto=self.presupuesto)
@@ -0,0 +1,169 @@
+"""Modelo local del impacto de una decisión, calibrado con evaluaciones pasadas.
+
+Predice en milisegundos el vector de impacto (financiera, reputacion,
+laboral) de la opción elegida, para que los indicadores y el fin de partida
+se actualicen sin esperar a Gemini. Es un modelo lineal por dimensión sobre
+las raíces de las palabras de la opción (más el nivel):
+- parte de una tabla de reglas semilla (despedir, ocultar, compensar...);
+- cada evaluación válida de Gemini se guarda en SQLite y ajusta los pesos
+  con un paso de descenso de gradiente regularizado hacia esas reglas;
+- al arrancar se reentrena con las últimas evaluaciones guardadas, en orden,
+  así que dos procesos con la misma base predicen lo mismo.
+"""
+import collections
+import contextlib
+import math
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import prompts
+
+TASA_APRENDIZAJE = 0.05
+REGULARIZACION = 0.01     # Atracción de cada peso hacia su valor semilla
+EPOCAS_ARRANQUE = 3
+MAX_EVALUACIONES = 5000   # Evaluaciones recientes con las que se reentrena al arrancar
+LONGITUD_RAIZ = 6
+IMPACTO_MAXIMO = 3        # Las predicciones se redondean y acotan a [-3, 3]
+
+# Raíz -> impacto a priori. Solo orienta al modelo hasta que hay datos.
+REGLAS_SEMILLA = {
+    "despid": {"financiera": 1, "reputacion": -1, "laboral": -2}, # despido
+    "desped": {"financiera": 1, "reputacion": -1, "laboral": -2}, # despedir
+    "recort": {"financiera": 1, "laboral": -1},
+    "reduci": {"financiera": 1, "laboral": -1},
+    "transp": {"reputacion": 1},
+    "comuni": {"reputacion": 1},
+    "discul": {"reputacion": 1},
+    "oculta": {"reputacion": -2},
+    "negar":  {"reputacion": -1},
+    "ignora": {"reputacion": -1, "laboral": -1},
+    "engana": {"reputacion": -2},
+    "manipu": {"reputacion": -2},
+    "soborn": {"financiera": -1, "reputacion": -2},
+    "compen": {"financiera": -1, "reputacion": 1},
+    "indemn": {"financiera": -1, "reputacion": 1},
+    "invert": {"financiera": -1},
+    "retira": {"financiera": -1, "reputacion": 1},
+    "audito": {"financiera": -1, "reputacion": 1},
+    "capaci": {"financiera": -1, "laboral": 1},
+    "formac": {"laboral": 1},
+    "bienes": {"laboral": 1},
+    "salari": {"financiera": -1, "laboral": 1},
+    "bonifi": {"financiera": -1, "laboral": 1},
+    "escuch": {"laboral": 1},
+    "demand": {"financiera": -1, "reputacion": -1},
+}
+
+_PALABRAS_VACIAS = frozenset("""
+    para como pero porque sobre entre hasta desde cual cuales esta este estos estas todo toda todos todas
+    mediante antes despues donde cuando mientras tanto otra otro otros otras sino tambien ademas
+""".split())
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS evaluaciones (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    nivel TEXT NOT NULL,
+    opcion TEXT NOT NULL,
+    financiera INTEGER NOT NULL,
+    reputacion INTEGER NOT NULL,
+    laboral INTEGER NOT NULL,
+    creada REAL NOT NULL
+);
+"""
+
+
+def raices(texto):
+    """Raíces normalizadas (sin tildes, minúsculas, truncadas) de las palabras con contenido."""
+    texto = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+    texto = re.sub(r"^\s*[a-d]\)\s*", "", texto) # Prefijo "A) " de la opción
+    return sorted({palabra[:LONGITUD_RAIZ] for palabra in re.findall(r"[a-z]{4,}", texto)
+                   if palabra not in _PALABRAS_VACIAS})
+
+
+def _semilla(caracteristica, clave):
+    return REGLAS_SEMILLA.get(caracteristica, {}).get(clave, 0) if not caracteristica.startswith("nivel:") else 0
+
+
+def _caracteristicas(opcion, nivel):
+    """{característica: valor}: las raíces pesan 1/sqrt(n) para que las opciones largas no saturen."""
+    lista = raices(opcion)
+    peso = 1 / math.sqrt(len(lista)) if lista else 0.0
+    return {f"nivel:{nivel}": 1.0, **{raiz: peso for raiz in lista}}
+
+
+class ModeloImpacto:
+    def __init__(self, ruta_disco=None):
+        self.ruta_disco = ruta_disco
+        # Peso de las raíces semilla con el valor de su regla: aporta lo mismo que la regla hasta que los datos la corrigen
+        self._pesos = {clave: {raiz: float(regla.get(clave, 0)) for raiz, regla in REGLAS_SEMILLA.items()}
+                       for clave in prompts.CLAVES_ESTADO}
+        self._lock = threading.Lock()
+        self._metricas = collections.Counter()
+        if ruta_disco:
+            with self._conectar() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_ESQUEMA)
+                filas = conn.execute("SELECT nivel, opcion, financiera, reputacion, laboral FROM evaluaciones "
+                                     "ORDER BY id DESC LIMIT ?", (MAX_EVALUACIONES,)).fetchall()
+            for _ in range(EPOCAS_ARRANQUE):
+                for nivel, opcion, *impacto in reversed(filas):
+                    self._ajustar(_caracteristicas(opcion, nivel), dict(zip(prompts.CLAVES_ESTADO, impacto)))
+            self._metricas["evaluaciones_cargadas"] = len(filas)
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta_disco, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _crudo(self, caracteristicas):
+        return {clave: sum(self._pesos[clave].get(c, _semilla(c, clave)) * valor for c, valor in caracteristicas.items())
+                for clave in prompts.CLAVES_ESTADO}
+
+    def _ajustar(self, caracteristicas, impacto):
+        for clave, prediccion in self._crudo(caracteristicas).items():
+            error = impacto[clave] - prediccion
+            pesos = self._pesos[clave]
+            for c, valor in caracteristicas.items():
+                peso = pesos.get(c, _semilla(c, clave))
+                pesos[c] = peso + TASA_APRENDIZAJE * (error * valor - REGULARIZACION * (peso - _semilla(c, clave)))
+
+    def predecir(self, opcion, nivel):
+        """Impacto entero más probable de elegir `opcion`, como el que devolvería la evaluación."""
+        with self._lock:
+            crudo = self._crudo(_caracteristicas(opcion, nivel))
+            self._metricas["predicciones"] += 1
+        return {clave: max(-IMPACTO_MAXIMO, min(IMPACTO_MAXIMO, round(valor))) for clave, valor in crudo.items()}
+
+    def registrar(self, opcion, nivel, impacto, prediccion=None):
+        """Guarda una evaluación de Gemini y ajusta el modelo con ella.
+
+        Con la `prediccion` local que se hizo para esa opción, anota además si
+        coincidió y su error absoluto medio (para vigilar la calibración).
+        """
+        impacto = {clave: int(impacto.get(clave, 0)) for clave in prompts.CLAVES_ESTADO}
+        with self._lock:
+            self._ajustar(_caracteristicas(opcion, nivel), impacto)
+            self._metricas["evaluaciones"] += 1
+            if prediccion is not None:
+                self._metricas["comparadas"] += 1
+                self._metricas["coincidencias"] += prediccion == impacto
+                self._metricas["error_absoluto"] += sum(abs(prediccion[k] - impacto[k]) for k in prompts.CLAVES_ESTADO)
+        if self.ruta_disco:
+            with self._conectar() as conn:
+                conn.execute("INSERT INTO evaluaciones (nivel, opcion, financiera, reputacion, laboral, creada) "
+                             "VALUES (?, ?, ?, ?, ?, ?)", (nivel, opcion, *impacto.values(), time.time()))
+
+    def metricas(self):
+        with self._lock:
+            datos = dict(self._metricas)
+        if comparadas := datos.get("comparadas"):
+            datos["tasa_coincidencia"] = datos.get("coincidencias", 0) / comparadas
+            datos["error_medio"] = datos.pop("error_absoluto", 0) / (comparadas * len(prompts.CLAVES_ESTADO))
+        return datos
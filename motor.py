@@ -0,0 +1,260 @@
+"""Motor de simulación sin interfaz: reglas de la partida y partidas completas.
+
+Las reglas (aplicar el impacto, bancarrota, límite de preguntas, puntaje) viven
+aquí para que app.py y simulador.py las compartan. `jugar_partida` juega una
+simulación entera sin navegador contra un backend: Gemini u otro proveedor de
+proveedores.py (`BackendGemini`) o un sustituto local sin cuota (`BackendSimulado`).
+
+Los backends anotan cada llamada como un registro `Llamada` en la lista
+`registro` que se les pasa, para medir latencia y tokens por turno.
+"""
+import json
+import random
+import time
+import zlib
+from typing import NamedTuple
+
+import gemini_client
+import prompts
+import proveedores
+import telemetria
+
+MAX_PREGUNTAS = 10
+NIVELES_DIFICULTAD = ["Principiante", "Intermedio", "Avanzado"]
+BANCARROTA_THRESHOLD = -10 # Situación financiera a partir de la cual termina la simulación
+DEFAULT_TIMEOUT = 120 # Seconds for API requests
+EVALUATION_TIMEOUT = 150 # La evaluación genera más texto
+
+
+# --- Reglas de la partida ---
+
+def aplicar_impacto(estado, impacto):
+    """Nuevo estado tras sumar `impacto`, o None si el impacto no es un diccionario."""
+    if not isinstance(impacto, dict):
+        return None
+    return {k: estado.get(k, 0) + impacto.get(k, 0) for k in prompts.CLAVES_ESTADO}
+
+
+def en_bancarrota(estado):
+    return estado.get('financiera', 0) <= BANCARROTA_THRESHOLD
+
+
+def razon_fin(estado, numero_pregunta):
+    """Motivo por el que termina la partida tras responder `numero_pregunta`, o None si sigue."""
+    if numero_pregunta >= MAX_PREGUNTAS:
+        return f"Se completaron las {MAX_PREGUNTAS} preguntas."
+    if en_bancarrota(estado):
+        return f"¡Bancarrota! La situación financiera cayó a {estado.get('financiera', 0)} (Umbral: {BANCARROTA_THRESHOLD})."
+    return None
+
+
+def puntaje(estado):
+    return sum(estado.get(k, 0) for k in prompts.CLAVES_ESTADO)
+
+
+def contexto_inicial(escenario):
+    return escenario.get('trasfondo', "Contexto inicial no disponible.")
+
+
+def estado_inicial(escenario):
+    return escenario.get('estado_inicial', prompts.estado_neutro()).copy()
+
+
+# --- Backends ---
+
+class Llamada(NamedTuple):
+    tipo: str               # "escenarios", "pregunta", "evaluacion" o "turno"
+    segundos: float
+    tokens_entrada: int
+    tokens_salida: int
+    valida: bool            # La respuesta superó la validación
+    error: str = None       # Tipo de excepción si la llamada falló
+    tokens_cacheados: int = 0  # Parte de tokens_entrada servida desde la caché de prefijos del modelo
+
+
+class BackendGemini:
+    """Llamadas a Gemini sin Streamlit: validación y un reintento, como en app.py.
+
+    Con `proveedor` (ver proveedores.py), las llamadas van a ese proveedor en lugar
+    de a Gemini, p. ej. a un servidor local compatible con OpenAI.
+    """
+
+    def __init__(self, session, api_key, modelo=gemini_client.MODELO_POR_DEFECTO,
+                 endpoint=gemini_client.API_ENDPOINT_BASE, proveedor=None):
+        self.proveedor = proveedor or proveedores.ProveedorGemini(endpoint, api_key, session=session)
+        self.modelo = modelo
+
+    def _llamar(self, tipo, prompt, esquema, validar, timeout, registro):
+        """Una petición: (parsed_response, validada); (None, None) si falló la API o no es JSON."""
+        inicio = time.monotonic()
+        medicion, parsed_response, error = telemetria.Medicion(), None, None
+        try:
+            texto = self.proveedor.generar(self.modelo, gemini_client.payload_texto(prompt, esquema), timeout, medicion=medicion)
+            parsed_response = prompts.cargar_json(texto)
+        except Exception as e:
+            error = type(e).__name__
+        validada = validar(parsed_response) if parsed_response is not None else None
+        if registro is not None:
+            registro.append(Llamada(tipo, time.monotonic() - inicio, medicion.tokens_entrada,
+                                    medicion.tokens_salida, validada is not None, error, medicion.tokens_cacheados))
+        return parsed_response, validada
+
+    def _solicitar(self, tipo, prompt, esquema, validar, timeout=DEFAULT_TIMEOUT, registro=None, reintentar=True):
+        """Registro validado o None. Solo se repite si llegó JSON que no validó."""
+        parsed_response, validada = self._llamar(tipo, prompt, esquema, validar, timeout, registro)
+        if validada is not None or parsed_response is None or not reintentar:
+            return validada
+        return self._llamar(tipo, prompts.prompt_correccion(prompt, "no cumple el esquema pedido"),
+                            esquema, validar, timeout, registro)[1]
+
+    def escenarios(self, nivel, registro=None):
+        return self._solicitar("escenarios", prompts.prompt_escenarios(nivel), prompts.ESQUEMA_ESCENARIOS,
+                               lambda parsed: prompts.validar_lote_escenarios(parsed, nivel), registro=registro)
+
+    def pregunta(self, contexto, historial, estado, nivel, numero_pregunta, registro=None):
+        return self._solicitar("pregunta", prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta),
+                               prompts.ESQUEMA_PREGUNTA, prompts.validar_pregunta, registro=registro)
+
+    def turno(self, contexto, pregunta, opcion_elegida, estado, historial, nivel, numero_pregunta, registro=None):
+        """(Evaluacion o None, Pregunta siguiente o None), con el mismo recorrido que jugar_turno_gemini."""
+        if numero_pregunta < MAX_PREGUNTAS:
+            turno = self._solicitar(
+                "turno", prompts.prompt_turno(contexto, pregunta, opcion_elegida, estado, historial, nivel, numero_pregunta),
+                prompts.ESQUEMA_TURNO, prompts.validar_turno, EVALUATION_TIMEOUT, registro, reintentar=False)
+            if turno:
+                return turno
+        evaluacion = self._solicitar(
+            "evaluacion", prompts.prompt_evaluacion(contexto, pregunta, opcion_elegida, estado, nivel, numero_pregunta),
+            prompts.ESQUEMA_EVALUACION, prompts.validar_evaluacion, EVALUATION_TIMEOUT, registro)
+        return evaluacion, None
+
+
+class BackendSimulado:
+    """Sustituto local de Gemini: respuestas válidas, sin red ni cuota.
+
+    Las respuestas dependen solo del prompt (hash estable), así que dos
+    ejecuciones con las mismas decisiones dan el mismo resultado. Los tokens
+    se estiman a partir de la longitud del prompt y de la respuesta.
+    """
+
+    def __init__(self, latencia=0.0):
+        self.latencia = latencia
+
+    def _responder(self, tipo, prompt, respuesta, registro):
+        if self.latencia:
+            time.sleep(self.latencia)
+        if registro is not None:
+            registro.append(Llamada(tipo, self.latencia, (len(prompt) + len(getattr(prompt, "sistema", None) or "")) // 4,
+                                    len(json.dumps(respuesta, ensure_ascii=False)) // 4, True))
+
+    @staticmethod
+    def _rng(prompt):
+        return random.Random(zlib.crc32(prompt.encode("utf-8")))
+
+    @staticmethod
+    def _pregunta(rng, numero_pregunta):
+        return prompts.Pregunta(f"Dilema simulado {numero_pregunta} ({rng.randrange(1000)}): ¿cómo respondes?",
+                                [f"{letra}) Opción simulada {letra}" for letra in "ABCD"])
+
+    def escenarios(self, nivel, registro=None):
+        prompt = prompts.prompt_escenarios(nivel)
+        rng = self._rng(prompt)
+        escenarios = [{"id": f"{nivel[0].lower()}{i}", "titulo": f"Crisis simulada {nivel} {i}",
+                       "trasfondo": f"Trasfondo simulado {i} del nivel {nivel}.",
+                       "estado_inicial": {k: rng.randint(-2, 2) for k in prompts.CLAVES_ESTADO}}
+                      for i in range(1, 6)]
+        self._responder("escenarios", prompt, escenarios, registro)
+        return escenarios
+
+    def pregunta(self, contexto, historial, estado, nivel, numero_pregunta, registro=None):
+        prompt = prompts.prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta)
+        pregunta = self._pregunta(self._rng(prompt), numero_pregunta)
+        self._responder("pregunta", prompt, pregunta._asdict(), registro)
+        return pregunta
+
+    def turno(self, contexto, pregunta, opcion_elegida, estado, historial, nivel, numero_pregunta, registro=None):
+        tipo = "turno" if numero_pregunta < MAX_PREGUNTAS else "evaluacion"
+        prompt = prompts.prompt_turno(contexto, pregunta, opcion_elegida, estado, historial, nivel, numero_pregunta)
+        rng = self._rng(prompt)
+        evaluacion = prompts.Evaluacion(
+            "Análisis simulado.", "Consecuencias simuladas.", f"Contexto tras la decisión {numero_pregunta}.",
+            {k: rng.randint(-3, 3) for k in prompts.CLAVES_ESTADO})
+        siguiente = self._pregunta(rng, numero_pregunta + 1) if tipo == "turno" else None
+        self._responder(tipo, prompt, [evaluacion._asdict(), siguiente and siguiente._asdict()], registro)
+        return evaluacion, siguiente
+
+
+# --- Políticas de decisión ---
+# Reciben (numero_pregunta, pregunta, opciones, estado, rng) y devuelven la opción elegida.
+
+def politica_aleatoria(numero_pregunta, pregunta, opciones, estado, rng):
+    return rng.choice(opciones)
+
+
+def politica_guion(indices):
+    """Elige siempre la opción `indices[n-1]` en la pregunta n (el último índice se repite)."""
+    def politica(numero_pregunta, pregunta, opciones, estado, rng):
+        return opciones[indices[min(numero_pregunta, len(indices)) - 1] % len(opciones)]
+    return politica
+
+
+# --- Partida completa ---
+
+def _turno_jsonl(numero_pregunta, llamadas, **campos):
+    return dict(campos, numero=numero_pregunta, llamadas=len(llamadas),
+                segundos=round(sum(l.segundos for l in llamadas), 4),
+                tokens_entrada=sum(l.tokens_entrada for l in llamadas),
+                tokens_salida=sum(l.tokens_salida for l in llamadas),
+                tokens_cacheados=sum(l.tokens_cacheados for l in llamadas),
+                llamadas_invalidas=sum(not l.valida for l in llamadas),
+                errores=[l.error for l in llamadas if l.error])
+
+
+def jugar_partida(escenario, nivel, backend, politica, rng=None):
+    """Juega una simulación completa con las mismas reglas que la página de Simulación.
+
+    Devuelve un diccionario con el resultado (razón de fin, estado final,
+    puntaje) y la lista `turnos` con latencia, tokens y errores de cada turno;
+    el turno 0 es la generación de la primera pregunta.
+    """
+    rng = rng or random.Random()
+    inicio = time.monotonic()
+    estado = estado_inicial(escenario)
+    contexto = contexto_inicial(escenario)
+    historial, turnos = [], []
+
+    llamadas = []
+    siguiente = backend.pregunta(contexto, historial, estado, nivel, 1, registro=llamadas)
+    turnos.append(_turno_jsonl(0, llamadas))
+    numero_pregunta, fin = 1, None
+    if not siguiente:
+        fin = "Error al generar la pregunta 1."
+
+    while not fin:
+        pregunta, opciones = siguiente
+        opcion = politica(numero_pregunta, pregunta, opciones, estado, rng)
+        historial.append({"pregunta": pregunta, "respuesta": opcion, "numero": numero_pregunta})
+
+        llamadas = []
+        evaluacion, siguiente = backend.turno(contexto, pregunta, opcion, estado, historial, nivel, numero_pregunta,
+                                              registro=llamadas)
+        evaluacion = evaluacion or prompts.evaluacion_fallida(contexto, "error API")
+        estado = aplicar_impacto(estado, evaluacion.impacto) or estado
+        contexto = evaluacion.nuevo_contexto or contexto
+
+        fin = razon_fin(estado, numero_pregunta)
+        if not fin and not siguiente:
+            siguiente = backend.pregunta(contexto, historial, estado, nivel, numero_pregunta + 1, registro=llamadas)
+            if not siguiente:
+                fin = f"Error al generar la pregunta {numero_pregunta + 1}."
+        turnos.append(_turno_jsonl(numero_pregunta, llamadas, opcion=opcion, impacto=evaluacion.impacto,
+                                   estado=dict(estado)))
+        if not fin:
+            numero_pregunta += 1
+
+    return {
+        "escenario": escenario.get('id'), "titulo": escenario.get('titulo'), "nivel": nivel,
+        "preguntas": len(historial), "razon_fin": fin, "bancarrota": en_bancarrota(estado) and len(historial) < MAX_PREGUNTAS,
+        "estado_final": estado, "puntaje": puntaje(estado), "segundos": round(time.monotonic() - inicio, 4),
+        "turnos": turnos,
+    }
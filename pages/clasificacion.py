@@ -0,0 +1,59 @@
+import os
+
+import streamlit as st
+
+import motor
+import prompts
+import resultados
+
+st.set_page_config(layout="wide", page_title="Clasificación - Simulador de Crisis")
+
+st.title("🏆 Clasificación y Estadísticas de la Clase")
+
+RESULTADOS_DB = os.environ.get("CRISIS_RESULTADOS_DB", resultados.RUTA)
+if not RESULTADOS_DB:
+    st.info("El almacén de resultados está desactivado (CRISIS_RESULTADOS_DB vacío).")
+    st.stop()
+
+@st.cache_resource
+def obtener_resultados():
+    return resultados.AlmacenResultados(RESULTADOS_DB)
+
+almacen = obtener_resultados()
+
+col_nivel, col_escenario = st.columns(2)
+nivel = col_nivel.selectbox("Nivel de dificultad", motor.NIVELES_DIFICULTAD)
+# Todos los datos salen de los agregados ya calculados: la página no recorre las partidas jugadas
+jugados = {escenario: f"{titulo or escenario} ({partidas} partidas)" for escenario, titulo, partidas in almacen.escenarios(nivel)}
+escenario = col_escenario.selectbox("Escenario", [resultados.TODOS, *jugados],
+                                    format_func=lambda e: "Todos los escenarios" if e == resultados.TODOS else jugados[e])
+st.button("🔄 Actualizar")
+
+if (resumen := almacen.resumen(nivel, escenario)) is None:
+    st.info(f"Todavía no ha terminado ninguna partida en el nivel {nivel}.")
+    st.stop()
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Partidas terminadas", resumen.partidas)
+col2.metric("Puntaje medio", f"{resumen.puntaje_medio:.1f}")
+col3.metric("Tasa de bancarrota", f"{resumen.tasa_bancarrota:.0%}")
+col4.metric("Mejor / peor puntaje", f"{resumen.mejor} / {resumen.peor}")
+
+st.subheader("Clasificación")
+st.dataframe([{"Puesto": i, "Jugador": puesto.alias or "Anónimo", "Puntaje": puesto.puntaje, "Escenario": puesto.titulo,
+               "Preguntas": puesto.preguntas}
+              for i, puesto in enumerate(almacen.clasificacion(nivel, escenario), 1)], hide_index=True)
+
+col_histograma, col_impacto = st.columns(2)
+with col_histograma:
+    st.subheader("Distribución de puntajes")
+    st.bar_chart([{"Puntaje": cubeta, "Partidas": partidas} for cubeta, partidas in almacen.histograma(nivel, escenario)],
+                 x="Puntaje", y="Partidas")
+    st.caption(f"Cada barra agrupa {resultados.ANCHO_CUBETA} puntos a partir del valor indicado.")
+with col_impacto:
+    st.subheader("Impacto medio por pregunta")
+    impactos = almacen.impacto_medio(nivel, escenario)
+    etiquetas = {"financiera": "Financiera", "reputacion": "Reputación", "laboral": "Laboral"}
+    st.line_chart([{"Pregunta": numero, **{etiquetas.get(clave, clave): media for clave, media in medias.items()}}
+                   for numero, _, medias in impactos], x="Pregunta")
+    st.caption("Decisiones por pregunta: " + ", ".join(f"P{numero}: {decisiones}" for numero, decisiones, _ in impactos))
@@ -0,0 +1,69 @@
+import os
+
+import streamlit as st
+
+import telemetria
+
+st.set_page_config(layout="wide", page_title="Métricas - Simulador de Crisis")
+
+st.title("Métricas de las Llamadas a Gemini")
+
+# Protección opcional: si hay contraseña configurada (secreto o entorno), se pide antes de mostrar nada
+try:
+    CLAVE_ADMIN = st.secrets["ADMIN_PASSWORD"]
+except (KeyError, FileNotFoundError):
+    CLAVE_ADMIN = os.environ.get("CRISIS_ADMIN_PASSWORD")
+if CLAVE_ADMIN and st.text_input("Contraseña de administración", type="password") != CLAVE_ADMIN:
+    st.info("🔒 Introduce la contraseña para ver las métricas.")
+    st.stop()
+
+st.button("🔄 Actualizar")
+
+def _segundos(valor):
+    """Límite superior del intervalo del histograma, como texto."""
+    if valor is None:
+        return "-"
+    return f"> {telemetria.LIMITES_SEGUNDOS[-1]} s" if valor == float("inf") else f"≤ {valor} s"
+
+resumen = telemetria.REGISTRO.resumen()
+if not resumen:
+    st.info("Todavía no se ha hecho ninguna llamada a Gemini en este proceso.")
+else:
+    filas = []
+    for (tipo, modelo), agregado in sorted(resumen.items()):
+        n = agregado.contadores["llamadas"]
+        filas.append({
+            "Tipo": tipo, "Modelo": modelo, "Llamadas": n,
+            "p50": _segundos(agregado.segundos.percentil(50)),
+            "p95": _segundos(agregado.segundos.percentil(95)),
+            "Media (s)": round(agregado.segundos.suma / n, 2) if n else None,
+            "Primer byte p50": _segundos(agregado.ttfb.percentil(50)),
+            "Tokens entrada": agregado.contadores["tokens_entrada"],
+            "Tokens salida": agregado.contadores["tokens_salida"],
+            "Tokens cacheados": agregado.contadores["tokens_cacheados"],
+            "Reintentos": agregado.contadores["reintentos"],
+            "Espera cuota (s)": round(agregado.contadores["espera_cuota_segundos"], 2),
+            "Errores": sum(agregado.errores.values()),
+            "Fallos parseo": agregado.fallos["parseo"],
+            "Fallos validación": agregado.fallos["validacion"],
+        })
+    st.dataframe(filas, hide_index=True)
+
+    errores = {f"{tipo} / {modelo}": dict(agregado.errores) for (tipo, modelo), agregado in resumen.items() if agregado.errores}
+    if errores:
+        st.subheader("Errores por clase")
+        st.json(errores)
+
+if fuentes := telemetria.REGISTRO.fuentes():
+    st.subheader("Cachés y cuota")
+    columnas = st.columns(len(fuentes))
+    for columna, (nombre, metricas) in zip(columnas, sorted(fuentes.items())):
+        with columna:
+            st.markdown(f"**{nombre}**")
+            st.json(metricas)
+
+with st.expander("Formato Prometheus"):
+    texto = telemetria.REGISTRO.exportar_prometheus()
+    st.code(texto, language="text")
+    st.download_button("Descargar", texto, file_name="metricas.prom", mime="text/plain")
+    st.caption("La aplicación también lo sirve en `http://127.0.0.1:<CRISIS_METRICAS_PUERTO>/metrics` (9464 por defecto).")
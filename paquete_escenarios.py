@@ -0,0 +1,155 @@
+"""Paquetes de escenarios precompilados para jugar sin llamadas a la API.
+
+Un paquete guarda escenarios y, para cada uno, el árbol de preguntas,
+opciones y evaluaciones expandido hasta cierta profundidad (ver
+compilar_paquete.py). Es un único fichero binario pensado para abrirse con
+mmap: las tablas de nodos y aristas son registros de tamaño fijo, así que un
+turno se sirve por índice sin leer el resto; los textos van deduplicados y
+comprimidos con zlib en bloques, y solo se descomprime el bloque que contiene
+el texto pedido.
+
+Estructura (little-endian):
+    cabecera  MAGIA + (desplazamiento, cantidad) de cada tabla y de los metadatos
+    nodos     pregunta, número de pregunta, 4 opciones, 4 aristas (-1 = sin expandir)
+    aristas   análisis, consecuencias, nuevo contexto, impacto (3 x int8), nodo siguiente (-1 = ninguno)
+    cadenas   (bloque, inicio, longitud) de cada texto dentro de su bloque descomprimido
+    bloques   (desplazamiento, longitud) de cada bloque comprimido
+    meta      JSON comprimido: escenarios por nivel con su nodo raíz, y datos de la compilación
+"""
+import functools
+import json
+import mmap
+import struct
+import zlib
+
+import prompts
+
+MAGIA = b"CRISPAK1"
+TAMANO_BLOQUE = 32 * 1024   # Bytes de texto sin comprimir por bloque
+NIVEL_ZLIB = 9
+
+_CABECERA = struct.Struct("<8s10Q")
+_NODO = struct.Struct("<IB3x4I4i")
+_ARISTA = struct.Struct("<3I3bxi")
+_CADENA = struct.Struct("<3I")
+_BLOQUE = struct.Struct("<QI")
+SIN_ARISTA = -1
+
+
+class EscritorPaquete:
+    """Acumula nodos, aristas y textos en memoria y los escribe en el formato del paquete."""
+
+    def __init__(self):
+        self._cadenas = {}  # texto -> índice (deduplicación)
+        self._nodos = []    # [pregunta, numero, opciones, aristas]
+        self._aristas = []
+
+    def cadena(self, texto):
+        if (indice := self._cadenas.get(texto)) is None:
+            indice = self._cadenas[texto] = len(self._cadenas)
+        return indice
+
+    def nodo(self, numero_pregunta, pregunta):
+        """Añade un nodo con la `prompts.Pregunta` que se muestra; devuelve su índice."""
+        self._nodos.append([self.cadena(pregunta.pregunta), numero_pregunta,
+                            [self.cadena(opcion) for opcion in pregunta.opciones], [SIN_ARISTA] * 4])
+        return len(self._nodos) - 1
+
+    def arista(self, nodo, indice_opcion, evaluacion, siguiente=SIN_ARISTA):
+        """Resultado de elegir la opción `indice_opcion` en `nodo`: su Evaluacion y el nodo siguiente."""
+        self._aristas.append((self.cadena(evaluacion.analisis), self.cadena(evaluacion.consecuencias_texto),
+                              self.cadena(evaluacion.nuevo_contexto),
+                              *(max(-128, min(127, evaluacion.impacto[k])) for k in prompts.CLAVES_ESTADO), siguiente))
+        self._nodos[nodo][3][indice_opcion] = len(self._aristas) - 1
+
+    def escribir(self, ruta, meta):
+        """Escribe el paquete en `ruta` y devuelve su tamaño en bytes."""
+        cadenas, bloques, bloque = [], [], bytearray()
+        for texto in self._cadenas: # Orden de inserción = orden de los índices
+            datos = texto.encode("utf-8")
+            if bloque and len(bloque) + len(datos) > TAMANO_BLOQUE:
+                bloques.append(zlib.compress(bytes(bloque), NIVEL_ZLIB))
+                bloque = bytearray()
+            cadenas.append((len(bloques), len(bloque), len(datos)))
+            bloque += datos
+        if bloque:
+            bloques.append(zlib.compress(bytes(bloque), NIVEL_ZLIB))
+
+        tablas = [b"".join(_NODO.pack(pregunta, numero, *opciones, *aristas)
+                           for pregunta, numero, opciones, aristas in self._nodos),
+                  b"".join(_ARISTA.pack(*arista) for arista in self._aristas),
+                  b"".join(_CADENA.pack(*cadena) for cadena in cadenas)]
+        desplazamiento = _CABECERA.size + sum(len(t) for t in tablas) + len(bloques) * _BLOQUE.size
+        indice_bloques = bytearray()
+        for comprimido in bloques:
+            indice_bloques += _BLOQUE.pack(desplazamiento, len(comprimido))
+            desplazamiento += len(comprimido)
+        meta_comprimida = zlib.compress(json.dumps(meta, ensure_ascii=False).encode("utf-8"), NIVEL_ZLIB)
+
+        posiciones, posicion = [], _CABECERA.size
+        for tabla, cantidad in zip(tablas + [indice_bloques], (len(self._nodos), len(self._aristas), len(cadenas), len(bloques))):
+            posiciones += [posicion, cantidad]
+            posicion += len(tabla)
+        with open(ruta, "wb") as f:
+            f.write(_CABECERA.pack(MAGIA, *posiciones, desplazamiento, len(meta_comprimida)))
+            for tabla in tablas + [indice_bloques]:
+                f.write(tabla)
+            for comprimido in bloques:
+                f.write(comprimido)
+            f.write(meta_comprimida)
+            return f.tell()
+
+
+class PaqueteEscenarios:
+    """Lectura de un paquete por mmap; seguro para varios hilos (solo lectura)."""
+
+    def __init__(self, ruta, bloques_en_memoria=64):
+        self.ruta = ruta
+        with open(ruta, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magia, *posiciones = _CABECERA.unpack_from(self._mmap, 0)
+        if magia != MAGIA:
+            raise ValueError(f"{ruta} no es un paquete de escenarios")
+        (self._off_nodos, self.n_nodos, self._off_aristas, self.n_aristas, self._off_cadenas, _,
+         self._off_bloques, _, off_meta, len_meta) = posiciones
+        self.meta = json.loads(zlib.decompress(self._mmap[off_meta:off_meta + len_meta]))
+        self._bloque = functools.lru_cache(maxsize=bloques_en_memoria)(self._descomprimir)
+
+    def _descomprimir(self, indice):
+        desplazamiento, longitud = _BLOQUE.unpack_from(self._mmap, self._off_bloques + indice * _BLOQUE.size)
+        return zlib.decompress(self._mmap[desplazamiento:desplazamiento + longitud])
+
+    def _texto(self, indice):
+        bloque, inicio, longitud = _CADENA.unpack_from(self._mmap, self._off_cadenas + indice * _CADENA.size)
+        return self._bloque(bloque)[inicio:inicio + longitud].decode("utf-8")
+
+    def _nodo(self, nodo):
+        return _NODO.unpack_from(self._mmap, self._off_nodos + nodo * _NODO.size)
+
+    def pregunta(self, nodo):
+        """(número de pregunta, prompts.Pregunta) del nodo."""
+        pregunta, numero, *resto = self._nodo(nodo)
+        return numero, prompts.Pregunta(self._texto(pregunta), [self._texto(i) for i in resto[:4]])
+
+    def turno(self, nodo, indice_opcion):
+        """(Evaluacion, nodo siguiente o None) de elegir esa opción, o None si la rama no está precompilada."""
+        arista = self._nodo(nodo)[6 + indice_opcion]
+        if arista == SIN_ARISTA:
+            return None
+        analisis, consecuencias, contexto, *impacto, siguiente = _ARISTA.unpack_from(
+            self._mmap, self._off_aristas + arista * _ARISTA.size)
+        evaluacion = prompts.Evaluacion(self._texto(analisis), self._texto(consecuencias), self._texto(contexto),
+                                        dict(zip(prompts.CLAVES_ESTADO, impacto)))
+        return evaluacion, None if siguiente == SIN_ARISTA else siguiente
+
+    def escenarios(self, nivel):
+        """Escenarios del nivel listos para la página de inicio: con su pregunta 1 y su nodo raíz."""
+        escenarios = []
+        for escenario in self.meta["escenarios"].get(nivel, []):
+            _, primera = self.pregunta(escenario["nodo"])
+            escenarios.append(dict({k: v for k, v in escenario.items() if k != "nodo"},
+                                   primera_pregunta=primera._asdict(), paquete_nodo=escenario["nodo"]))
+        return escenarios
+
+    def cerrar(self):
+        self._mmap.close()
@@ -0,0 +1,108 @@
+"""Presupuestos de latencia y peticiones duplicadas ("hedged requests").
+
+Cada llamada interactiva tiene un plazo. Si el primer intento no ha respondido
+cuando se alcanza el p90 de latencia observado, se lanza un duplicado y gana
+la primera respuesta válida. Si se agota el plazo sin respuesta válida se
+lanza `PlazoVencido` para que el llamador use una respuesta de reserva en
+lugar de dejar al jugador esperando.
+
+Una llamada HTTP bloqueante no se puede interrumpir desde otro hilo: el
+intento perdedor se cancela si aún no empezó y, si ya está en vuelo, termina
+en segundo plano y su resultado se descarta.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+VENTANA_MUESTRAS = 200      # Latencias recientes que se conservan por tipo de llamada
+MIN_MUESTRAS = 10           # Por debajo de esto no se confía en el percentil observado
+RETRASO_MINIMO = 1.0        # Nunca duplicar antes de este tiempo (segundos)
+FRACCION_SIN_DATOS = 1 / 3  # Retraso del duplicado, como fracción del plazo, sin datos suficientes
+
+
+class PlazoVencido(TimeoutError):
+    """Se agotó el presupuesto de latencia sin ninguna respuesta válida."""
+
+
+class HistorialLatencias:
+    """Ventana deslizante de latencias (segundos) con consulta de percentiles."""
+
+    def __init__(self, ventana=VENTANA_MUESTRAS):
+        self._muestras = collections.deque(maxlen=ventana)
+        self._lock = threading.Lock()
+
+    def registrar(self, segundos):
+        with self._lock:
+            self._muestras.append(segundos)
+
+    def percentil(self, q, min_muestras=MIN_MUESTRAS):
+        """Percentil `q` (0-100) de las muestras, o None si hay menos de `min_muestras`."""
+        with self._lock:
+            muestras = sorted(self._muestras)
+        if len(muestras) < max(1, min_muestras):
+            return None
+        indice = min(len(muestras) - 1, int(round(q / 100 * (len(muestras) - 1))))
+        return muestras[indice]
+
+    def __len__(self):
+        return len(self._muestras)
+
+
+def retraso_cobertura(historial, presupuesto):
+    """Cuándo lanzar el duplicado: el p90 observado, acotado dentro del plazo."""
+    p90 = historial.percentil(90)
+    if p90 is None:
+        p90 = presupuesto * FRACCION_SIN_DATOS
+    return min(max(p90, RETRASO_MINIMO), presupuesto * 0.8)
+
+
+def _cronometrado(intento):
+    inicio = time.monotonic()
+    resultado = intento()
+    return resultado, time.monotonic() - inicio
+
+
+def ejecutar_con_cobertura(intento, presupuesto, retraso, pool, es_valido=lambda resultado: resultado is not None):
+    """Ejecuta `intento()` en `pool` con un duplicado tras `retraso` segundos.
+
+    Devuelve (resultado, segundos) del primer intento válido, donde `segundos`
+    es la latencia de ese intento. Si el primer intento falla antes del
+    retraso, el duplicado sale de inmediato (actúa como reintento). Si ambos
+    terminan sin resultado válido, devuelve el último resultado inválido o
+    relanza el último error. Lanza `PlazoVencido` al agotarse el presupuesto.
+    """
+    inicio = time.monotonic()
+    limite = inicio + presupuesto
+    pendientes = {pool.submit(_cronometrado, intento)}
+    duplicado = False
+    ultimo_resultado = ultimo_error = None
+
+    while pendientes or not duplicado:
+        ahora = time.monotonic()
+        if ahora >= limite:
+            break
+        if not duplicado and (not pendientes or ahora >= inicio + retraso):
+            pendientes.add(pool.submit(_cronometrado, intento))
+            duplicado = True
+        espera = limite - ahora if duplicado else min(limite, inicio + retraso) - ahora
+        hechos, pendientes = wait(pendientes, timeout=max(0.0, espera), return_when=FIRST_COMPLETED)
+        for futuro in hechos:
+            try:
+                resultado, segundos = futuro.result()
+            except Exception as e:
+                ultimo_error = e
+                continue
+            if es_valido(resultado):
+                for otro in pendientes:
+                    otro.cancel()
+                return resultado, segundos
+            ultimo_resultado = resultado
+
+    for futuro in pendientes:
+        futuro.cancel()
+    if pendientes or (ultimo_resultado is None and ultimo_error is None):
+        raise PlazoVencido(f"Sin respuesta válida en {presupuesto} s")
+    if ultimo_resultado is not None:
+        return ultimo_resultado, time.monotonic() - inicio
+    raise ultimo_error
@@ -0,0 +1,397 @@
+"""Prompts de Gemini y validación de sus respuestas, sin dependencias de Streamlit.
+
+app.py los envuelve con spinners y mensajes de error; los hilos de fondo los
+usan directamente porque allí no se puede dibujar en la página.
+"""
+import json
+import random
+from typing import NamedTuple
+
+CLAVES_ESTADO = ['financiera', 'reputacion', 'laboral']
+
+
+# --- Registros validados ---
+# Son tuplas con nombre: el código que desempaqueta (pregunta, opciones) o
+# (analisis, consecuencias, contexto, impacto) sigue funcionando igual.
+
+class Pregunta(NamedTuple):
+    pregunta: str
+    opciones: list
+
+
+class Evaluacion(NamedTuple):
+    analisis: str
+    consecuencias_texto: str
+    nuevo_contexto: str
+    impacto: dict
+
+
+# --- Esquemas de salida estructurada (responseSchema de Gemini) ---
+# propertyOrdering fija el orden de generación: el análisis llega primero en streaming.
+
+_ESQUEMA_IMPACTO = {
+    "type": "OBJECT",
+    "properties": {k: {"type": "INTEGER"} for k in CLAVES_ESTADO},
+    "required": CLAVES_ESTADO,
+    "propertyOrdering": CLAVES_ESTADO,
+}
+
+_ESQUEMA_OPCIONES = {"type": "ARRAY", "items": {"type": "STRING"}, "minItems": 4, "maxItems": 4}
+
+ESQUEMA_ESCENARIOS = {
+    "type": "ARRAY",
+    "minItems": 5,
+    "maxItems": 5,
+    "items": {
+        "type": "OBJECT",
+        "properties": {
+            "id": {"type": "STRING"},
+            "titulo": {"type": "STRING"},
+            "trasfondo": {"type": "STRING"},
+            "estado_inicial": _ESQUEMA_IMPACTO,
+        },
+        "required": ["id", "titulo", "trasfondo", "estado_inicial"],
+        "propertyOrdering": ["id", "titulo", "trasfondo", "estado_inicial"],
+    },
+}
+
+ESQUEMA_PREGUNTA = {
+    "type": "OBJECT",
+    "properties": {"pregunta": {"type": "STRING"}, "opciones": _ESQUEMA_OPCIONES},
+    "required": ["pregunta", "opciones"],
+    "propertyOrdering": ["pregunta", "opciones"],
+}
+
+_CAMPOS_EVALUACION = ["analisis", "consecuencias_texto", "impacto", "nuevo_contexto"]
+
+ESQUEMA_EVALUACION = {
+    "type": "OBJECT",
+    "properties": {
+        "analisis": {"type": "STRING"},
+        "consecuencias_texto": {"type": "STRING"},
+        "impacto": _ESQUEMA_IMPACTO,
+        "nuevo_contexto": {"type": "STRING"},
+    },
+    "required": _CAMPOS_EVALUACION,
+    "propertyOrdering": _CAMPOS_EVALUACION,
+}
+
+ESQUEMA_TURNO = {
+    "type": "OBJECT",
+    "properties": {
+        **ESQUEMA_EVALUACION["properties"],
+        "siguiente_pregunta": {"type": "STRING"},
+        "siguientes_opciones": _ESQUEMA_OPCIONES,
+    },
+    "required": _CAMPOS_EVALUACION + ["siguiente_pregunta", "siguientes_opciones"],
+    "propertyOrdering": _CAMPOS_EVALUACION + ["siguiente_pregunta", "siguientes_opciones"],
+}
+
+
+_ESQUEMAS_POR_TIPO = {
+    "escenarios": ESQUEMA_ESCENARIOS,
+    "pregunta": ESQUEMA_PREGUNTA,
+    "evaluacion": ESQUEMA_EVALUACION,
+    "turno": ESQUEMA_TURNO,
+}
+
+
+def esquema_escenarios(cantidad):
+    """ESQUEMA_ESCENARIOS para un lote de `cantidad` (p. ej. al sustituir solo los repetidos)."""
+    return dict(ESQUEMA_ESCENARIOS, minItems=cantidad, maxItems=cantidad)
+
+
+def tipo_de_llamada(esquema):
+    """Tipo de llamada ('escenarios', 'pregunta', 'evaluacion', 'turno') según su esquema; 'texto' si no es ninguno."""
+    if isinstance(esquema, dict) and esquema.get("items") == ESQUEMA_ESCENARIOS["items"]:
+        return "escenarios" # Cualquier tamaño de lote
+    return next((tipo for tipo, conocido in _ESQUEMAS_POR_TIPO.items() if esquema == conocido), "texto")
+
+
+def _es_texto(valor):
+    return isinstance(valor, str) and bool(valor.strip())
+
+
+def estado_neutro():
+    return {"financiera": 0, "reputacion": 0, "laboral": 0}
+
+
+def cargar_json(response_text):
+    """Parsea el JSON de la respuesta quitando las vallas ```json ... ```.
+
+    Lanza `json.JSONDecodeError` si el contenido no es JSON válido.
+    """
+    # Gemini a veces envuelve el JSON en ```json ... ```
+    text_to_parse = response_text.strip()
+    if text_to_parse.startswith("```json"):
+        text_to_parse = text_to_parse[7:-3].strip() # Quita ```json y ```
+    elif text_to_parse.startswith("```"):
+         text_to_parse = text_to_parse[3:-3].strip() # Quita ```
+    return json.loads(text_to_parse)
+
+
+class Prompt(str):
+    """Datos de la partida para una llamada, con las instrucciones fijas de su tipo aparte en `sistema`.
+
+    gemini_client.payload_texto envía `sistema` como systemInstruction, delante
+    de los datos: todas las llamadas de un tipo, de cualquier sesión, empiezan
+    por el mismo prefijo, y la caché de prefijos del modelo (la implícita de
+    Gemini o la de un servidor vLLM/llama.cpp) no lo vuelve a procesar.
+    """
+    sistema = None
+    temperatura = None
+
+    def __new__(cls, texto, sistema=None):
+        prompt = super().__new__(cls, texto)
+        prompt.sistema = sistema
+        return prompt
+
+
+class PromptDeterminista(Prompt):
+    """Prompt que no depende de la partida (solo del escenario y el nivel).
+
+    Se pide con temperature 0: la respuesta es la misma para todos los
+    jugadores y la caché de respuestas puede servirla (ver cache_respuestas).
+    """
+    temperatura = 0
+
+
+def prompt_correccion(prompt, problema):
+    """Prompt para la repetición automática tras una respuesta inválida (con las mismas instrucciones fijas)."""
+    return Prompt(prompt + f"""
+    ATENCIÓN: tu respuesta anterior no era válida ({problema}). Responde de nuevo cumpliendo EXACTAMENTE el formato JSON pedido.
+    """, getattr(prompt, "sistema", None))
+
+
+# --- Escenarios ---
+
+def _evitar(textos, que):
+    """Nota para no repetir `textos` ya usados (vacía si no hay ninguno)."""
+    if not textos:
+        return ""
+    lista = "\n".join(f"    - {texto}" for texto in textos)
+    return f"""
+    NO repitas ni parafrasees {que} ya existentes; propón algo claramente distinto:
+{lista}
+    """
+
+
+def prompt_escenarios(nivel, cantidad=5, evitar=()):
+    """Prompt para `cantidad` escenarios; `evitar` son títulos ya usados (al reponer solo los repetidos)."""
+    return f"""
+    Eres un experto en ética empresarial y diseño de simulaciones interactivas.
+    Genera EXACTAMENTE {cantidad} escenarios únicos y distintos de crisis empresariales en español para un nivel de dificultad '{nivel}'.
+    Cada escenario debe incluir:
+    - 'id': Un identificador único y corto (ej: 'p1', 'p2' para principiante; 'i1', 'i2' para intermedio; 'a1', 'a2' para avanzado). Usa el prefijo correcto para el nivel ({nivel[0].lower()}).
+    - 'titulo': Un título corto, atractivo y descriptivo en español (máx 10 palabras).
+    - 'trasfondo': Una descripción detallada (100-150 palabras) de la empresa ficticia, el contexto del mercado, el inicio de la crisis y el rol específico que asume el jugador en la simulación. Debe estar en español.
+    - 'estado_inicial': Un diccionario fijo: {{"financiera": 0, "reputacion": 0, "laboral": 0}}.
+
+    Asegúrate de que los escenarios sean apropiados para la dificultad indicada (Principiante: dilemas directos; Intermedio: ambigüedad, pros/contras; Avanzado: sistémico, multi-agente, largo plazo).
+
+    Presenta la respuesta final EXCLUSIVAMENTE como una lista JSON válida de estos {cantidad} diccionarios. No incluyas ningún otro texto antes o después de la lista JSON.
+    """ + _evitar(evitar, "estos escenarios")
+
+
+def validar_escenarios(parsed_response, nivel, cantidad=5):
+    """Normaliza la lista de escenarios.
+
+    Devuelve None si la respuesta no es una lista de `cantidad` elementos; si lo es,
+    devuelve (escenarios_validos, indices_omitidos).
+    """
+    if not (parsed_response and isinstance(parsed_response, list) and len(parsed_response) == cantidad):
+        return None
+    validated_scenarios = []
+    omitidos = []
+    for i, sc in enumerate(parsed_response):
+        if isinstance(sc, dict) and all(k in sc for k in ['id', 'titulo', 'trasfondo', 'estado_inicial']) and \
+           _es_texto(sc['titulo']) and _es_texto(sc['trasfondo']):
+            # Asegurar IDs únicos si Gemini falla
+            if not isinstance(sc['id'], str) or not sc['id']:
+                    sc['id'] = f"{nivel[0].lower()}{i+1}_{random.randint(1000,9999)}"
+            # Asegurar que el ID empiece con la letra correcta
+            if not sc['id'].startswith(nivel[0].lower()):
+                sc['id'] = f"{nivel[0].lower()}{sc['id'].lstrip('pia')}" # Intenta corregir prefijo
+
+            if not isinstance(sc['estado_inicial'], dict) or not all(k in sc['estado_inicial'] for k in CLAVES_ESTADO):
+                    sc['estado_inicial'] = estado_neutro() # Corregir si es necesario
+            validated_scenarios.append(sc)
+        else:
+            omitidos.append(i)
+    return validated_scenarios, omitidos
+
+
+def validar_lote_escenarios(parsed_response, nivel, cantidad=5):
+    """Los `cantidad` escenarios si todos son válidos; None en otro caso."""
+    resultado = validar_escenarios(parsed_response, nivel, cantidad)
+    if resultado and len(resultado[0]) == cantidad:
+        return resultado[0]
+    return None
+
+
+# --- Preguntas ---
+
+SISTEMA_PREGUNTA = """
+    Actúa como el director experto de una simulación interactiva de crisis empresarial en español.
+    Con los datos de la partida que se te dan, genera la SIGUIENTE pregunta crítica (concisa, relevante, dilema claro) y EXACTAMENTE 4 opciones de respuesta (distintas, plausibles, prefijo A/B/C/D).
+
+    Presenta la respuesta final EXCLUSIVAMENTE como un objeto JSON válido con claves 'pregunta' (string) y 'opciones' (lista de 4 strings). No incluyas texto adicional.
+    """
+
+
+def prompt_pregunta(contexto, historial, estado, nivel, numero_pregunta, evitar=()):
+    """`evitar`: preguntas ya planteadas en la partida, al repetir una que salió casi igual.
+
+    La pregunta 1 (sin historial) es un PromptDeterminista.
+    """
+    historial_str = json.dumps(historial[-2:], ensure_ascii=False) # Últimas 2 decisiones
+    nota = _evitar(evitar, "estas preguntas")
+
+    prompt = f"""
+    Nivel: {nivel}. Pregunta: {numero_pregunta}/10. Estado: Fin={estado['financiera']}, Rep={estado['reputacion']}, Lab={estado['laboral']}.
+    Contexto: {contexto}
+    Historial reciente: {historial_str}
+    """ + nota
+    clase = PromptDeterminista if numero_pregunta == 1 and not historial and not evitar else Prompt
+    return clase(prompt, SISTEMA_PREGUNTA)
+
+
+def validar_pregunta(parsed_response):
+    """Devuelve un registro `Pregunta` o None si el formato no es el esperado."""
+    if parsed_response and isinstance(parsed_response, dict) and \
+       _es_texto(parsed_response.get('pregunta')) and \
+       isinstance(parsed_response.get('opciones'), list) and len(parsed_response['opciones']) == 4 and \
+       all(_es_texto(opcion) for opcion in parsed_response['opciones']):
+        # Validar prefijos A) B) C) D) si es necesario
+        return Pregunta(parsed_response['pregunta'], parsed_response['opciones'])
+    return None
+
+
+# --- Evaluación de decisiones ---
+
+_TAREAS_EVALUACION = """
+    1.  'analisis': Análisis conciso (2-3 frases) de la decisión (implicaciones éticas/estratégicas).
+    2.  'consecuencias_texto': Descripción breve (1-2 frases) de efectos inmediatos probables.
+    3.  'impacto': Diccionario JSON con impacto numérico MÁS PROBABLE en 'financiera', 'reputacion', 'laboral' (enteros, rango -3 a +3 típico). E.g., {"financiera": -1, "reputacion": 0, "laboral": -1}.
+    4.  'nuevo_contexto': Nuevo párrafo de contexto (50-100 palabras) describiendo la situación DESPUÉS de la decisión y consecuencias."""
+
+SISTEMA_EVALUACION = """
+    Eres un analista experto evaluando una decisión en una simulación en español.
+    Con los datos de la decisión que se te dan, realiza estas tareas y presenta el resultado EXCLUSIVAMENTE como un único objeto JSON válido con claves 'analisis', 'consecuencias_texto', 'impacto', 'nuevo_contexto':""" \
+    + _TAREAS_EVALUACION + """
+
+    No incluyas texto adicional fuera del objeto JSON.
+    """
+
+
+def _datos_decision(contexto, pregunta, opcion_elegida, estado_actual):
+    return f"""
+    Contexto ANTES: {contexto}
+    Pregunta: {pregunta}
+    Decisión: {opcion_elegida}
+    Estado ANTES: Fin={estado_actual['financiera']}, Rep={estado_actual['reputacion']}, Lab={estado_actual['laboral']}.
+    """
+
+
+def prompt_evaluacion(contexto, pregunta, opcion_elegida, estado_actual, nivel, numero_pregunta):
+    return Prompt(f"""
+    Nivel: {nivel}. Pregunta respondida: {numero_pregunta}/10.""" + _datos_decision(contexto, pregunta, opcion_elegida, estado_actual),
+                  SISTEMA_EVALUACION)
+
+
+def validar_evaluacion(parsed_response):
+    """Devuelve un registro `Evaluacion` o None."""
+    if parsed_response and isinstance(parsed_response, dict) and \
+       all(k in parsed_response for k in _CAMPOS_EVALUACION) and \
+       all(isinstance(parsed_response[k], str) for k in ['analisis', 'consecuencias_texto', 'nuevo_contexto']) and \
+       isinstance(parsed_response['impacto'], dict) and \
+       all(k in parsed_response['impacto'] for k in CLAVES_ESTADO):
+        # Validar tipos de impacto
+        impacto = parsed_response['impacto']
+        try:
+            impacto_validado = {k: int(impacto.get(k, 0)) for k in CLAVES_ESTADO}
+        except (TypeError, ValueError):
+            return None
+        return Evaluacion(parsed_response['analisis'], parsed_response['consecuencias_texto'], parsed_response['nuevo_contexto'], impacto_validado)
+    return None
+
+
+def es_sustituta(evaluacion):
+    """¿Es una evaluación de reserva o fallida (no de Gemini)? Su impacto neutro no es una valoración real."""
+    return evaluacion.analisis == _ANALISIS_RESERVA or evaluacion.analisis.startswith("Análisis no disponible")
+
+
+def evaluacion_fallida(contexto, motivo):
+    """Resultado neutro cuando la evaluación no se pudo obtener (motivo: 'error API', 'error formato')."""
+    return Evaluacion(f"Análisis no disponible ({motivo}).", f"Consecuencias no disponibles ({motivo}).", f"{contexto}\n\n(Error al procesar la última decisión).", estado_neutro())
+
+
+# --- Turno fusionado: evaluación + siguiente pregunta en una sola llamada ---
+
+SISTEMA_TURNO = """
+    Eres el director y analista experto de una simulación interactiva de crisis empresarial en español.
+    Con los datos de la decisión que se te dan, realiza estas tareas y presenta el resultado EXCLUSIVAMENTE como un único objeto JSON válido con claves 'analisis', 'consecuencias_texto', 'impacto', 'nuevo_contexto', 'siguiente_pregunta', 'siguientes_opciones':""" \
+    + _TAREAS_EVALUACION + """
+    5.  'siguiente_pregunta': La SIGUIENTE pregunta crítica (concisa, relevante, dilema claro) que surge del 'nuevo_contexto'.
+    6.  'siguientes_opciones': Lista de EXACTAMENTE 4 opciones de respuesta a esa pregunta (distintas, plausibles, prefijo A/B/C/D).
+
+    No incluyas texto adicional fuera del objeto JSON.
+    """
+
+
+def prompt_turno(contexto, pregunta, opcion_elegida, estado_actual, historial, nivel, numero_pregunta):
+    # Últimas 2 decisiones, sin la que se evalúa: ya va en Pregunta y Decisión
+    historial_str = json.dumps([d for d in historial[-2:] if d.get('numero') != numero_pregunta], ensure_ascii=False)
+
+    return Prompt(f"""
+    Nivel: {nivel}. Pregunta respondida: {numero_pregunta}/10; la siguiente es la {numero_pregunta + 1}/10.
+    Historial reciente: {historial_str}""" + _datos_decision(contexto, pregunta, opcion_elegida, estado_actual),
+                  SISTEMA_TURNO)
+
+
+def validar_turno(parsed_response):
+    """Valida el turno fusionado completo de una vez.
+
+    Devuelve (Evaluacion, Pregunta), o None si falta o sobra cualquier parte.
+    """
+    evaluacion = validar_evaluacion(parsed_response)
+    if not evaluacion:
+        return None
+    siguiente = validar_pregunta({'pregunta': parsed_response.get('siguiente_pregunta'),
+                                  'opciones': parsed_response.get('siguientes_opciones')})
+    if not siguiente:
+        return None
+    return evaluacion, siguiente
+
+
+# --- Respuestas de reserva (cuando vence el plazo de latencia) ---
+# Válidas según los esquemas de arriba, para que el turno continúe sin la API.
+
+def reserva_pregunta(numero_pregunta):
+    return {
+        'pregunta': f"La crisis exige una decisión rápida (pregunta {numero_pregunta}). ¿Cuál es tu prioridad inmediata?",
+        'opciones': [
+            "A) Proteger la estabilidad financiera de la empresa",
+            "B) Comunicar con transparencia a clientes y opinión pública",
+            "C) Priorizar el bienestar y la confianza de los empleados",
+            "D) Ganar tiempo y reunir más información antes de actuar",
+        ],
+    }
+
+
+_ANALISIS_RESERVA = "El análisis detallado no llegó a tiempo; tu decisión queda registrada sin efecto inmediato en los indicadores."
+
+
+def reserva_evaluacion(contexto):
+    return {
+        'analisis': _ANALISIS_RESERVA,
+        'consecuencias_texto': "Los efectos de esta decisión se verán más adelante.",
+        'impacto': estado_neutro(),
+        'nuevo_contexto': contexto,
+    }
+
+
+def reserva_turno(contexto, numero_pregunta):
+    siguiente = reserva_pregunta(numero_pregunta + 1)
+    return {**reserva_evaluacion(contexto),
+            'siguiente_pregunta': siguiente['pregunta'], 'siguientes_opciones': siguiente['opciones']}
@@ -0,0 +1,172 @@
+"""Proveedores de modelos: la misma interfaz para Gemini y para servidores compatibles con OpenAI.
+
+Las peticiones se construyen siempre en el formato de Gemini
+(gemini_client.payload_texto): la caché de respuestas, la cuota y la
+telemetría se apoyan en él. Cada proveedor traduce ese payload a su API y
+ofrece:
+
+- generar(modelo, payload, timeout, admitir, medicion) -> texto generado
+- stream(modelo, payload, timeout, admitir, medicion) -> fragmentos de texto
+
+Cada proveedor tiene su propio pool de conexiones (`conexiones` por host): los
+servidores de inferencia locales (vLLM, llama.cpp, TGI...) agrupan en la GPU
+las peticiones simultáneas que les llegan por él.
+
+Los modelos se nombran "proveedor/modelo" (p. ej. "aula/llama-3.1-8b"); sin
+el prefijo de un proveedor configurado, el modelo es de Gemini. Así las rutas
+por tipo de llamada de enrutado.py eligen también el proveedor.
+"""
+import abc
+import json
+
+import gemini_client
+import prompts
+
+GEMINI = "gemini"
+CONEXIONES = gemini_client.POOL_MAXSIZE
+
+
+def _texto(contenido):
+    return "".join(parte.get("text", "") for parte in contenido.get("parts", []))
+
+
+def esquema_json(esquema):
+    """responseSchema de Gemini como JSON Schema estándar: tipos en minúsculas y sin propertyOrdering."""
+    if isinstance(esquema, dict):
+        return {clave: valor.lower() if clave == "type" and isinstance(valor, str) else esquema_json(valor)
+                for clave, valor in esquema.items() if clave != "propertyOrdering"}
+    if isinstance(esquema, list):
+        return [esquema_json(valor) for valor in esquema]
+    return esquema
+
+
+class Proveedor(abc.ABC):
+    """Base de los adaptadores, con su pool de conexiones; un adaptador incompleto no se puede instanciar."""
+
+    def __init__(self, endpoint, api_key="", conexiones=CONEXIONES, session=None):
+        self.endpoint = endpoint.rstrip("/")
+        self.api_key = api_key
+        self.conexiones = conexiones
+        self.session = session or gemini_client.crear_sesion(conexiones)
+
+    @abc.abstractmethod
+    def generar(self, modelo, payload, timeout, admitir=None, medicion=None):
+        """Texto generado; los errores HTTP persistentes se lanzan tras los reintentos."""
+
+    @abc.abstractmethod
+    def stream(self, modelo, payload, timeout, admitir=None, medicion=None):
+        """Generador de fragmentos de texto según llegan; cerrarlo aborta la descarga."""
+
+
+class ProveedorGemini(Proveedor):
+    """API de Gemini: clave en la URL y texto en `candidates[0].content.parts[0]` (ver gemini_client)."""
+
+    def __init__(self, endpoint=gemini_client.API_ENDPOINT_BASE, api_key="", conexiones=CONEXIONES, session=None):
+        super().__init__(endpoint, api_key, conexiones, session)
+
+    def url(self, modelo, metodo="generateContent"):
+        consulta = "alt=sse&" if metodo == "streamGenerateContent" else ""
+        return f"{self.endpoint}/{modelo}:{metodo}?{consulta}key={self.api_key}"
+
+    def generar(self, modelo, payload, timeout, admitir=None, medicion=None):
+        return gemini_client.generar_texto(self.session, self.url(modelo), payload, timeout, admitir, medicion)
+
+    def stream(self, modelo, payload, timeout, admitir=None, medicion=None):
+        return gemini_client.stream_texto(self.session, self.url(modelo, "streamGenerateContent"), payload,
+                                          timeout, admitir, medicion)
+
+
+def _uso_gemini(usage):
+    """`usage` de OpenAI con los nombres de usageMetadata, para telemetria.Medicion.uso.
+
+    Los tokens del prompt servidos desde la caché de prefijos (vLLM con prefix caching) vienen en prompt_tokens_details.
+    """
+    return {"promptTokenCount": usage.get("prompt_tokens", 0), "candidatesTokenCount": usage.get("completion_tokens", 0),
+            "totalTokenCount": usage.get("total_tokens", 0),
+            "cachedContentTokenCount": (usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0)}
+
+
+class ProveedorOpenAI(Proveedor):
+    """Servidor compatible con OpenAI (`/chat/completions`): vLLM, llama.cpp, Ollama, TGI...
+
+    `endpoint` es la base de la API, p. ej. "http://10.0.0.5:8000/v1". El
+    esquema de la respuesta se pide como `response_format` json_schema.
+    """
+
+    def __init__(self, endpoint, api_key="", conexiones=CONEXIONES, session=None):
+        super().__init__(endpoint, api_key, conexiones, session)
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+
+    def cuerpo(self, modelo, payload, stream=False):
+        """Petición de chat/completions equivalente a un payload de generateContent."""
+        mensajes = [{"role": "system", "content": _texto(sistema)}] if (sistema := payload.get("systemInstruction")) else []
+        mensajes += [{"role": "assistant" if contenido.get("role") == "model" else "user", "content": _texto(contenido)}
+                     for contenido in payload.get("contents", [])]
+        cuerpo = {"model": modelo, "messages": mensajes}
+        config = payload.get("generationConfig") or {}
+        for origen, destino in (("temperature", "temperature"), ("topP", "top_p"), ("maxOutputTokens", "max_tokens")):
+            if origen in config:
+                cuerpo[destino] = config[origen]
+        if (esquema := config.get("responseSchema")) is not None:
+            cuerpo["response_format"] = {"type": "json_schema",
+                                         "json_schema": {"name": prompts.tipo_de_llamada(esquema), "schema": esquema_json(esquema)}}
+        if stream:
+            cuerpo.update(stream=True, stream_options={"include_usage": True})
+        return cuerpo
+
+    def generar(self, modelo, payload, timeout, admitir=None, medicion=None):
+        response_json = gemini_client.post_json(self.session, f"{self.endpoint}/chat/completions", self.cuerpo(modelo, payload),
+                                                timeout, admitir=admitir, medicion=medicion).json()
+        if medicion and (uso := response_json.get("usage")):
+            medicion.uso(_uso_gemini(uso))
+        try:
+            texto = response_json["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            texto = None
+        if not texto:
+            raise gemini_client.RespuestaInesperada(response_json)
+        return texto
+
+    def stream(self, modelo, payload, timeout, admitir=None, medicion=None):
+        """Fragmentos de `delta.content` según llegan; como gemini_client.stream_texto, cerrar el generador aborta."""
+        response = gemini_client.post_json(self.session, f"{self.endpoint}/chat/completions", self.cuerpo(modelo, payload, True),
+                                           timeout, stream=True, admitir=admitir, medicion=medicion)
+        response.encoding = "utf-8"
+        try:
+            for linea in response.iter_lines(decode_unicode=True):
+                if not linea or not linea.startswith("data:"):
+                    continue
+                if (datos := linea[5:].strip()) == "[DONE]":
+                    break
+                evento = json.loads(datos)
+                if medicion and (uso := evento.get("usage")):
+                    medicion.uso(_uso_gemini(uso))
+                for eleccion in evento.get("choices") or []:
+                    if texto := (eleccion.get("delta") or {}).get("content"):
+                        if medicion:
+                            medicion.primer_byte()
+                        yield texto
+        finally:
+            response.close()
+
+
+TIPOS = {"gemini": ProveedorGemini, "openai": ProveedorOpenAI}
+
+
+def crear(config):
+    """Proveedor a partir de su configuración, p. ej. {"tipo": "openai", "endpoint": "http://...:8000/v1", "conexiones": 32}.
+
+    Claves opcionales: "clave" (API key) y "conexiones" (pool por host).
+    """
+    if (clase := TIPOS.get(config.get("tipo", "openai"))) is None:
+        raise ValueError(f"Tipo de proveedor desconocido: {config.get('tipo')!r}")
+    return clase(config["endpoint"], config.get("clave", ""), config.get("conexiones", CONEXIONES))
+
+
+def separar(modelo, nombres):
+    """(proveedor, modelo) de "proveedor/modelo"; sin el prefijo de uno de `nombres`, el modelo es de Gemini."""
+    nombre, barra, resto = modelo.partition("/")
+    if barra and nombre in nombres:
+        return nombre, resto
+    return GEMINI, modelo
@@ -0,0 +1,199 @@
+"""Resultados de las partidas terminadas, con agregados por escenario y por nivel.
+
+Cada partida terminada se añade una sola vez (por su id) a un fichero SQLite
+y, en la misma transacción, se actualizan sus agregados: partidas, suma de
+puntajes, bancarrotas, mejor y peor puntaje, histograma de puntajes por
+cubetas e impacto acumulado por número de pregunta. Se mantienen para el
+escenario y para el nivel entero (escenario TODOS).
+
+La página de clasificación solo lee esas filas de agregados y, para la
+clasificación, los primeros puestos de un índice por puntaje: sus consultas
+cuestan lo mismo con cien partidas jugadas que con un millón.
+"""
+import collections
+import contextlib
+import sqlite3
+import time
+from typing import NamedTuple, Optional
+
+import prompts
+
+RUTA = "resultados.sqlite3"
+TODOS = "*"            # Escenario de los agregados del nivel entero
+ANCHO_CUBETA = 5       # Puntos por cubeta del histograma de puntajes
+PUESTOS = 10           # Partidas de la clasificación
+
+_IMPACTO = ", ".join(f"{clave} INTEGER NOT NULL DEFAULT 0" for clave in prompts.CLAVES_ESTADO)
+_ESQUEMA = f"""
+CREATE TABLE IF NOT EXISTS partidas (
+    id TEXT PRIMARY KEY,
+    nivel TEXT NOT NULL,
+    escenario TEXT NOT NULL,
+    titulo TEXT,
+    puntaje INTEGER NOT NULL,
+    bancarrota INTEGER NOT NULL,
+    preguntas INTEGER NOT NULL,
+    alias TEXT,
+    terminada REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_partidas_nivel ON partidas (nivel, puntaje DESC, terminada);
+CREATE INDEX IF NOT EXISTS idx_partidas_escenario ON partidas (nivel, escenario, puntaje DESC, terminada);
+CREATE TABLE IF NOT EXISTS agregados (
+    nivel TEXT NOT NULL,
+    escenario TEXT NOT NULL,
+    titulo TEXT,
+    partidas INTEGER NOT NULL,
+    suma_puntaje INTEGER NOT NULL,
+    bancarrotas INTEGER NOT NULL,
+    mejor INTEGER NOT NULL,
+    peor INTEGER NOT NULL,
+    PRIMARY KEY (nivel, escenario)
+);
+CREATE TABLE IF NOT EXISTS histograma (
+    nivel TEXT NOT NULL,
+    escenario TEXT NOT NULL,
+    cubeta INTEGER NOT NULL,
+    partidas INTEGER NOT NULL,
+    PRIMARY KEY (nivel, escenario, cubeta)
+);
+CREATE TABLE IF NOT EXISTS impacto_pregunta (
+    nivel TEXT NOT NULL,
+    escenario TEXT NOT NULL,
+    numero INTEGER NOT NULL,
+    decisiones INTEGER NOT NULL,
+    {_IMPACTO},
+    PRIMARY KEY (nivel, escenario, numero)
+);
+"""
+
+
+class Partida(NamedTuple):
+    id: str
+    nivel: str
+    escenario: str
+    titulo: Optional[str]
+    puntaje: int
+    bancarrota: bool
+    impactos: list            # [(número de pregunta, {clave: impacto})]
+    alias: Optional[str] = None
+
+
+class Resumen(NamedTuple):
+    partidas: int
+    puntaje_medio: float
+    tasa_bancarrota: float
+    mejor: int
+    peor: int
+
+
+class Puesto(NamedTuple):
+    alias: Optional[str]
+    puntaje: int
+    titulo: Optional[str]
+    preguntas: int
+    terminada: float
+
+
+def cubeta(puntaje):
+    """Límite inferior de la cubeta del histograma que contiene `puntaje`."""
+    return puntaje // ANCHO_CUBETA * ANCHO_CUBETA
+
+
+class AlmacenResultados:
+    """Partidas terminadas y sus agregados en SQLite; seguro para varios hilos y procesos."""
+
+    def __init__(self, ruta=RUTA):
+        self.ruta = ruta
+        self.metricas = collections.Counter()
+        with self._conectar() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_ESQUEMA)
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def registrar(self, partida):
+        """Añade la partida y actualiza sus agregados; False si ese id ya estaba registrado."""
+        columnas = ", ".join(prompts.CLAVES_ESTADO)
+        incrementos = ", ".join(f"{clave} = {clave} + excluded.{clave}" for clave in prompts.CLAVES_ESTADO)
+        with self._conectar() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO partidas (id, nivel, escenario, titulo, puntaje, bancarrota, preguntas, alias, terminada) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (partida.id, partida.nivel, partida.escenario, partida.titulo, partida.puntaje, int(partida.bancarrota),
+                 len(partida.impactos), partida.alias, time.time()))
+            if cursor.rowcount == 0:
+                self.metricas["repetidas"] += 1
+                return False
+            for escenario, titulo in ((partida.escenario, partida.titulo), (TODOS, None)):
+                conn.execute(
+                    "INSERT INTO agregados (nivel, escenario, titulo, partidas, suma_puntaje, bancarrotas, mejor, peor) "
+                    "VALUES (?, ?, ?, 1, ?, ?, ?, ?) ON CONFLICT (nivel, escenario) DO UPDATE SET "
+                    "titulo = coalesce(excluded.titulo, titulo), partidas = partidas + 1, "
+                    "suma_puntaje = suma_puntaje + excluded.suma_puntaje, bancarrotas = bancarrotas + excluded.bancarrotas, "
+                    "mejor = max(mejor, excluded.mejor), peor = min(peor, excluded.peor)",
+                    (partida.nivel, escenario, titulo, partida.puntaje, int(partida.bancarrota), partida.puntaje, partida.puntaje))
+                conn.execute(
+                    "INSERT INTO histograma (nivel, escenario, cubeta, partidas) VALUES (?, ?, ?, 1) "
+                    "ON CONFLICT (nivel, escenario, cubeta) DO UPDATE SET partidas = partidas + 1",
+                    (partida.nivel, escenario, cubeta(partida.puntaje)))
+                conn.executemany(
+                    f"INSERT INTO impacto_pregunta (nivel, escenario, numero, decisiones, {columnas}) "
+                    f"VALUES (?, ?, ?, 1, {', '.join('?' * len(prompts.CLAVES_ESTADO))}) "
+                    f"ON CONFLICT (nivel, escenario, numero) DO UPDATE SET decisiones = decisiones + 1, {incrementos}",
+                    [(partida.nivel, escenario, numero, *(impacto.get(clave, 0) for clave in prompts.CLAVES_ESTADO))
+                     for numero, impacto in partida.impactos])
+        self.metricas["registradas"] += 1
+        return True
+
+    def renombrar(self, partida_id, alias):
+        """Nombre con el que la partida aparece en la clasificación (None: anónima)."""
+        with self._conectar() as conn:
+            conn.execute("UPDATE partidas SET alias = ? WHERE id = ?", (alias or None, partida_id))
+
+    def resumen(self, nivel, escenario=TODOS):
+        """Resumen de las partidas del escenario (o del nivel), o None si aún no hay ninguna."""
+        with self._conectar() as conn:
+            fila = conn.execute("SELECT partidas, suma_puntaje, bancarrotas, mejor, peor FROM agregados "
+                                "WHERE nivel = ? AND escenario = ?", (nivel, escenario)).fetchone()
+        if not fila:
+            return None
+        partidas, suma, bancarrotas, mejor, peor = fila
+        return Resumen(partidas, suma / partidas, bancarrotas / partidas, mejor, peor)
+
+    def histograma(self, nivel, escenario=TODOS):
+        """[(límite inferior de la cubeta, partidas)] ordenado por puntaje."""
+        with self._conectar() as conn:
+            return conn.execute("SELECT cubeta, partidas FROM histograma WHERE nivel = ? AND escenario = ? ORDER BY cubeta",
+                                (nivel, escenario)).fetchall()
+
+    def impacto_medio(self, nivel, escenario=TODOS):
+        """[(número de pregunta, decisiones, {clave: impacto medio})] ordenado por número."""
+        with self._conectar() as conn:
+            filas = conn.execute(f"SELECT numero, decisiones, {', '.join(prompts.CLAVES_ESTADO)} FROM impacto_pregunta "
+                                 "WHERE nivel = ? AND escenario = ? ORDER BY numero", (nivel, escenario)).fetchall()
+        return [(numero, decisiones, {clave: suma / decisiones for clave, suma in zip(prompts.CLAVES_ESTADO, sumas)})
+                for numero, decisiones, *sumas in filas]
+
+    def clasificacion(self, nivel, escenario=TODOS, puestos=PUESTOS):
+        """Las `puestos` mejores partidas del escenario (o del nivel), [Puesto]; las más antiguas desempatan."""
+        consulta = "SELECT alias, puntaje, titulo, preguntas, terminada FROM partidas WHERE nivel = ?"
+        parametros = [nivel]
+        if escenario != TODOS:
+            consulta += " AND escenario = ?"
+            parametros.append(escenario)
+        with self._conectar() as conn:
+            filas = conn.execute(consulta + " ORDER BY puntaje DESC, terminada LIMIT ?", (*parametros, puestos)).fetchall()
+        return [Puesto(*fila) for fila in filas]
+
+    def escenarios(self, nivel):
+        """[(id, título, partidas)] de los escenarios jugados en el nivel, los más jugados primero."""
+        with self._conectar() as conn:
+            return conn.execute("SELECT escenario, titulo, partidas FROM agregados WHERE nivel = ? AND escenario != ? "
+                                "ORDER BY partidas DESC, escenario", (nivel, TODOS)).fetchall()
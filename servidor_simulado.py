@@ -0,0 +1,358 @@
+"""Servidor local que imita la API de Gemini, para medir sin clave ni cuota.
+
+Atiende `generateContent` y `streamGenerateContent?alt=sse` con respuestas
+grabadas (o sintéticas si no hay grabaciones para ese tipo de llamada), con
+latencia aleatoria según una distribución configurable, errores HTTP
+transitorios y JSON malformado inyectados a la tasa pedida.
+
+El tipo de llamada (escenarios, pregunta, evaluacion, turno) se deduce del
+responseSchema de la petición o, si no lo trae, del texto del prompt.
+
+Las mismas respuestas se sirven en formato OpenAI en `/v1/chat/completions`
+(con y sin streaming), para probar proveedores.ProveedorOpenAI sin un
+servidor de inferencia.
+
+La caché de prefijos del modelo también se imita: una systemInstruction (o
+mensaje de sistema) ya vista se anota como tokens cacheados en el uso, si
+llega a --minimo-cache tokens (0, como vLLM; Gemini pide un mínimo por modelo).
+
+Uso:
+    python servidor_simulado.py --puerto 8765 --latencia lognormal:0.8,0.5 --tasa-error 0.02
+    CRISIS_GEMINI_ENDPOINT=http://127.0.0.1:8765/v1beta/models GEMINI_API_KEY=x streamlit run app.py
+    CRISIS_PROVEEDORES='{"local": {"endpoint": "http://127.0.0.1:8765/v1"}}' \
+        CRISIS_RUTAS_MODELOS='{"pregunta": {"*": ["local/simulado"]}}' GEMINI_API_KEY=x streamlit run app.py
+
+Grabar respuestas reales (hace de proxy hacia la API y añade cada respuesta al fichero):
+    python servidor_simulado.py --grabar grabaciones.jsonl
+"""
+import argparse
+import collections
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import gemini_client
+import motor
+import prompts
+
+FRACCION_TTFB = 0.3      # En streaming, parte de la latencia antes del primer fragmento
+TAMANO_FRAGMENTO = 40    # Caracteres por evento SSE
+STATUS_ERROR = (429, 500, 503)
+
+def distribucion(especificacion):
+    """Función rng -> segundos a partir de 'fija:s', 'uniforme:a,b', 'normal:media,sd' o 'lognormal:mediana,sigma'."""
+    nombre, _, parametros = especificacion.partition(":")
+    valores = [float(v) for v in parametros.split(",") if v]
+    if nombre == "fija" and len(valores) == 1:
+        return lambda rng: valores[0]
+    if nombre == "uniforme" and len(valores) == 2:
+        return lambda rng: rng.uniform(*valores)
+    if nombre == "normal" and len(valores) == 2:
+        return lambda rng: max(0.0, rng.gauss(*valores))
+    if nombre == "lognormal" and len(valores) == 2:
+        return lambda rng: rng.lognormvariate(math.log(valores[0]), valores[1])
+    raise ValueError(f"Distribución de latencia no válida: {especificacion!r}")
+
+
+def tipo_de_llamada(payload):
+    tipo = prompts.tipo_de_llamada((payload.get("generationConfig") or {}).get("responseSchema"))
+    if tipo != "texto":
+        return tipo
+    prompt = _prompt(payload)
+    if "siguiente_pregunta" in prompt:
+        return "turno"
+    if "'analisis'" in prompt:
+        return "evaluacion"
+    if "escenarios" in prompt:
+        return "escenarios"
+    return "pregunta"
+
+
+def _prompt(payload):
+    """Texto completo de la petición: systemInstruction y contents, en el orden en que los procesa el modelo."""
+    contenidos = [payload.get("systemInstruction") or {}, *payload.get("contents", [])]
+    return "".join(parte.get("text", "") for contenido in contenidos for parte in contenido.get("parts", []))
+
+
+# Sílabas para inventar palabras: los textos sintéticos no deben parecerse entre sí (ver similitud.py)
+_SILABAS = [c + v for c in "bcdfglmnprstv" for v in "aeiou"]
+
+
+def _frase(rng, palabras):
+    return " ".join("".join(rng.choices(_SILABAS, k=rng.randint(2, 4))) for _ in range(palabras))
+
+
+def _sintetica(tipo, prompt, rng):
+    """Respuesta válida para el tipo de llamada, generada al vuelo."""
+    if tipo == "escenarios":
+        nivel = next((n for n in motor.NIVELES_DIFICULTAD if f"'{n}'" in prompt), motor.NIVELES_DIFICULTAD[0])
+        cantidad = int(m.group(1)) if (m := re.search(r"EXACTAMENTE (\d+) escenarios", prompt)) else 5
+        return [{"id": f"{nivel[0].lower()}{i}", "titulo": f"Crisis simulada {_frase(rng, 3)}",
+                 "trasfondo": f"Una empresa ficticia afronta una crisis simulada: {_frase(rng, 40)}.",
+                 "estado_inicial": prompts.estado_neutro()} for i in range(1, cantidad + 1)]
+    numero = int(m.group(1)) if (m := re.search(r"Pregunta(?: respondida)?: (\d+)/", prompt)) else 1
+    pregunta = {"pregunta": f"Dilema simulado {numero}: ¿{_frase(rng, 8)}?",
+                "opciones": [f"{letra}) Opción simulada {letra}" for letra in "ABCD"]}
+    if tipo == "pregunta":
+        return pregunta
+    respuesta = {"analisis": "Análisis simulado de la decisión.", "consecuencias_texto": "Consecuencias simuladas.",
+                 "impacto": {k: rng.randint(-3, 3) for k in prompts.CLAVES_ESTADO},
+                 "nuevo_contexto": f"Contexto simulado tras la decisión {numero}. " * 5}
+    if tipo == "turno":
+        respuesta.update(siguiente_pregunta=f"Dilema simulado {numero + 1}: ¿{_frase(rng, 8)}?",
+                         siguientes_opciones=pregunta["opciones"])
+    return respuesta
+
+
+def _respuesta_api(texto, prompt, cacheados=0):
+    uso = {"promptTokenCount": len(prompt) // 4, "candidatesTokenCount": len(texto) // 4,
+           "totalTokenCount": (len(prompt) + len(texto)) // 4}
+    if cacheados:
+        uso["cachedContentTokenCount"] = cacheados
+    return {"candidates": [{"content": {"parts": [{"text": texto}], "role": "model"}, "finishReason": "STOP"}],
+            "usageMetadata": uso}
+
+
+def payload_de_chat(cuerpo):
+    """(payload de generateContent equivalente, tipo de llamada o None) de una petición de chat/completions."""
+    mensajes = cuerpo.get("messages", [])
+    payload = {"contents": [{"parts": [{"text": mensaje.get("content") or ""}]}
+                            for mensaje in mensajes if mensaje.get("role") != "system"]}
+    if sistema := "".join(mensaje.get("content") or "" for mensaje in mensajes if mensaje.get("role") == "system"):
+        payload["systemInstruction"] = {"parts": [{"text": sistema}]}
+    tipo = ((cuerpo.get("response_format") or {}).get("json_schema") or {}).get("name")
+    return payload, tipo if tipo in ("escenarios", "pregunta", "evaluacion", "turno") else None
+
+
+def _uso_chat(respuesta):
+    uso = respuesta.get("usageMetadata", {})
+    return {"prompt_tokens": uso.get("promptTokenCount", 0), "completion_tokens": uso.get("candidatesTokenCount", 0),
+            "total_tokens": uso.get("totalTokenCount", 0),
+            "prompt_tokens_details": {"cached_tokens": uso.get("cachedContentTokenCount", 0)}}
+
+
+def _respuesta_chat(respuesta, modelo):
+    """Respuesta de generateContent en el formato de chat/completions."""
+    return {"object": "chat.completion", "model": modelo,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": gemini_client.extraer_texto(respuesta)}}],
+            "usage": _uso_chat(respuesta)}
+
+
+def _malformado(texto, rng):
+    if rng.random() < 0.5:
+        return texto[:max(1, len(texto) // 2)] # JSON truncado
+    return "Lo siento, no puedo generar ese contenido en formato JSON." # Prosa en lugar de JSON
+
+
+class ServidorSimulado:
+    """Servidor HTTP en un hilo de fondo; `iniciar()` devuelve la URL base para API_ENDPOINT_BASE."""
+
+    def __init__(self, puerto=0, latencia="fija:0.05", latencia_por_tipo=None, tasa_error=0.0,
+                 tasa_malformado=0.0, grabaciones=None, grabar=None, upstream=None, semilla=None, minimo_cache=0):
+        self.puerto = puerto
+        self.latencia = distribucion(latencia)
+        self.latencia_por_tipo = {tipo: distribucion(d) for tipo, d in (latencia_por_tipo or {}).items()}
+        self.tasa_error = tasa_error
+        self.tasa_malformado = tasa_malformado
+        self.grabar = grabar
+        self.upstream = upstream
+        self.grabadas = collections.defaultdict(list)
+        if grabaciones:
+            with open(grabaciones, encoding="utf-8") as f:
+                for linea in f:
+                    if linea.strip():
+                        registro = json.loads(linea)
+                        self.grabadas[registro["tipo"]].append(registro["respuesta"])
+        self.contadores = collections.Counter()
+        self.minimo_cache = minimo_cache
+        self._prefijos = set()
+        self._rng = random.Random(semilla)
+        self._lock = threading.Lock()
+        self._servidor = None
+
+    def _aleatorio(self):
+        with self._lock:
+            return random.Random(self._rng.getrandbits(64))
+
+    def _cacheados(self, payload):
+        """Tokens de la systemInstruction si ya se procesó antes (y llega al mínimo); si no, 0."""
+        sistema = "".join(parte.get("text", "") for parte in (payload.get("systemInstruction") or {}).get("parts", []))
+        if len(sistema) // 4 < max(self.minimo_cache, 1):
+            return 0
+        with self._lock:
+            vista = sistema in self._prefijos
+            self._prefijos.add(sistema)
+        return len(sistema) // 4 if vista else 0
+
+    def responder(self, payload, rng, tipo=None):
+        """(status, cuerpo JSON o None, segundos de latencia) para una petición."""
+        tipo = tipo or tipo_de_llamada(payload)
+        prompt = _prompt(payload)
+        segundos = self.latencia_por_tipo.get(tipo, self.latencia)(rng)
+        with self._lock:
+            self.contadores[tipo] += 1
+        if rng.random() < self.tasa_error:
+            with self._lock:
+                self.contadores["errores"] += 1
+            return rng.choice(STATUS_ERROR), None, segundos
+        if self.grabadas.get(tipo):
+            respuesta = rng.choice(self.grabadas[tipo])
+            texto = gemini_client.extraer_texto(respuesta)
+        else:
+            texto = "```json\n" + json.dumps(_sintetica(tipo, prompt, rng), ensure_ascii=False) + "\n```"
+            respuesta = _respuesta_api(texto, prompt, self._cacheados(payload))
+        if rng.random() < self.tasa_malformado:
+            with self._lock:
+                self.contadores["malformadas"] += 1
+            respuesta = _respuesta_api(_malformado(texto, rng), prompt, self._cacheados(payload))
+        return 200, respuesta, segundos
+
+    def _grabar(self, metodo, query, payload):
+        """Reenvía la petición a `upstream` (siempre sin streaming) y guarda la respuesta."""
+        url = f"{self.upstream}/{metodo.split(':')[0]}:generateContent?{query.replace('alt=sse&', '')}"
+        response = requests.post(url, json=payload, timeout=motor.EVALUATION_TIMEOUT)
+        if response.ok:
+            with self._lock, open(self.grabar, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"tipo": tipo_de_llamada(payload), "respuesta": response.json()}, ensure_ascii=False) + "\n")
+        return response.status_code, response.json() if response.ok else None, 0.0
+
+    def iniciar(self):
+        servidor = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                ruta, _, query = self.path.partition("?")
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                metodo = ruta.rsplit("/", 1)[-1]
+                if ruta.endswith("/chat/completions"):
+                    self._chat(payload)
+                    return
+                if servidor.grabar:
+                    status, respuesta, segundos = servidor._grabar(metodo, query, payload)
+                else:
+                    status, respuesta, segundos = servidor.responder(payload, servidor._aleatorio())
+                if status != 200:
+                    time.sleep(segundos)
+                    self._enviar(status, {"error": {"code": status, "message": "Error simulado"}},
+                                 {"Retry-After": "1"} if status == 429 else {})
+                elif metodo.endswith(":streamGenerateContent"):
+                    self._enviar_stream(respuesta, segundos)
+                else:
+                    time.sleep(segundos)
+                    self._enviar(200, respuesta)
+
+            def _chat(self, cuerpo):
+                payload, tipo = payload_de_chat(cuerpo)
+                status, respuesta, segundos = servidor.responder(payload, servidor._aleatorio(), tipo)
+                if status != 200:
+                    time.sleep(segundos)
+                    self._enviar(status, {"error": {"code": status, "message": "Error simulado"}},
+                                 {"Retry-After": "1"} if status == 429 else {})
+                elif cuerpo.get("stream"):
+                    self._enviar_stream(respuesta, segundos, cuerpo.get("model"))
+                else:
+                    time.sleep(segundos)
+                    self._enviar(200, _respuesta_chat(respuesta, cuerpo.get("model")))
+
+            def _enviar(self, status, cuerpo, cabeceras=None):
+                datos = json.dumps(cuerpo, ensure_ascii=False).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(datos)))
+                for clave, valor in (cabeceras or {}).items():
+                    self.send_header(clave, valor)
+                self.end_headers()
+                self.wfile.write(datos)
+
+            def _evento(self, datos):
+                datos = f"data: {datos}\r\n\r\n".encode("utf-8")
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(datos), datos))
+                self.wfile.flush()
+
+            def _enviar_stream(self, respuesta, segundos, modelo_chat=None):
+                """Eventos SSE de streamGenerateContent o, con `modelo_chat`, de chat/completions."""
+                texto = gemini_client.extraer_texto(respuesta)
+                fragmentos = [texto[i:i + TAMANO_FRAGMENTO] for i in range(0, len(texto), TAMANO_FRAGMENTO)] or [""]
+                time.sleep(segundos * FRACCION_TTFB)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                pausa = segundos * (1 - FRACCION_TTFB) / len(fragmentos)
+                try:
+                    for i, fragmento in enumerate(fragmentos):
+                        ultimo = i == len(fragmentos) - 1
+                        if modelo_chat:
+                            eventos = [{"object": "chat.completion.chunk", "model": modelo_chat,
+                                        "choices": [{"index": 0, "delta": {"content": fragmento}}]}]
+                            if ultimo:
+                                eventos.append({"object": "chat.completion.chunk", "model": modelo_chat,
+                                                "choices": [], "usage": _uso_chat(respuesta)})
+                        else:
+                            eventos = [{"candidates": [{"content": {"parts": [{"text": fragmento}], "role": "model"}}]}]
+                            if ultimo:
+                                eventos[0]["usageMetadata"] = respuesta.get("usageMetadata", {})
+                        for evento in eventos:
+                            self._evento(json.dumps(evento, ensure_ascii=False))
+                        time.sleep(pausa)
+                    if modelo_chat:
+                        self._evento("[DONE]")
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass # El cliente abortó el stream (p. ej. JSON malformado detectado a mitad)
+
+        self._servidor = ThreadingHTTPServer(("127.0.0.1", self.puerto), Manejador)
+        self._servidor.daemon_threads = True
+        threading.Thread(target=self._servidor.serve_forever, name="servidor-simulado", daemon=True).start()
+        return f"http://127.0.0.1:{self._servidor.server_address[1]}/v1beta/models"
+
+    def detener(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+
+
+def latencias_por_tipo(valores):
+    """['turno=lognormal:2,0.4', ...] -> {'turno': 'lognormal:2,0.4'}"""
+    return dict(valor.split("=", 1) for valor in valores or [])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Imitación local de la API de Gemini para pruebas de rendimiento.")
+    parser.add_argument("--puerto", type=int, default=8765)
+    parser.add_argument("--latencia", default="fija:0.05", help="fija:s | uniforme:a,b | normal:media,sd | lognormal:mediana,sigma")
+    parser.add_argument("--latencia-tipo", action="append", metavar="TIPO=DIST",
+                        help="Latencia de un tipo de llamada (escenarios, pregunta, evaluacion, turno); repetible")
+    parser.add_argument("--tasa-error", type=float, default=0.0, help="Fracción de peticiones que responden 429/500/503")
+    parser.add_argument("--tasa-malformado", type=float, default=0.0, help="Fracción de respuestas con JSON malformado")
+    parser.add_argument("--grabaciones", help="JSONL de respuestas grabadas para reproducir")
+    parser.add_argument("--grabar", help="Modo proxy: añade a este JSONL cada respuesta de --upstream")
+    parser.add_argument("--upstream", default=gemini_client.ENDPOINT_GEMINI)
+    parser.add_argument("--semilla", type=int, default=None)
+    parser.add_argument("--minimo-cache", type=int, default=0, help="Tokens mínimos de una systemInstruction para cachearla")
+    args = parser.parse_args(argv)
+
+    servidor = ServidorSimulado(args.puerto, args.latencia, latencias_por_tipo(args.latencia_tipo), args.tasa_error,
+                                args.tasa_malformado, args.grabaciones, args.grabar, args.upstream, args.semilla,
+                                args.minimo_cache)
+    print(f"Servidor simulado en {servidor.iniciar()}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,405 @@
+"""Almacén externo del estado de las partidas, para reanudar y escalar en réplicas.
+
+Cada sesión del navegador lleva un token en la URL (?sesion=...). Los campos
+de la partida que hay en `st.session_state` se guardan por separado, como JSON
+compacto (comprimido con zlib si es largo), en:
+- un fichero SQLite local (por defecto; vale para varias réplicas en un mismo
+  disco), o
+- un servidor compatible con Redis (redis://host:puerto/db): un hash por
+  sesión que caduca solo tras el TTL de inactividad.
+
+Tras cada ejecución del script solo se escriben los campos que cambiaron
+(comparando huellas), así un turno escribe unos cientos de bytes aunque la
+partida guarde escenarios e historial. Comparar también es barato: los
+valores inmutables (textos, números, escenarios internados) que siguen
+siendo el mismo objeto no se vuelven a serializar, y solo se comprime lo que
+cambió. Al recargar la página, o si el balanceador manda la sesión a otra
+réplica, la partida se recupera del almacén.
+
+El token identifica la partida, no la pestaña: una pestaña duplicada llega
+con el mismo token. app.py le da uno nuevo (una copia de la partida) si la
+otra pestaña sigue conectada al mismo proceso; entre réplicas no se puede
+saber, y las dos pestañas escribirían en la misma partida.
+
+`python sesiones.py --puerto 6380` arranca un sustituto local de Redis, en
+memoria, con solo los comandos que usa este módulo.
+"""
+import argparse
+import collections
+import contextlib
+import hashlib
+import json
+import secrets
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import urllib.parse
+import zlib
+from typing import NamedTuple
+
+TTL = 7 * 24 * 3600      # Segundos sin actividad hasta que se olvida una partida
+COMPRIMIR_DESDE = 512    # Bytes de JSON a partir de los que el valor se comprime
+PREFIJO_REDIS = "crisis:sesion:"
+TIMEOUT_REDIS = 5
+INMUTABLES = (str, int, float, bool, type(None))
+
+# Estado de la partida que sobrevive a una recarga. No incluye futuros ni
+# hilos (especulación, trabajos): se vuelven a crear si hacen falta.
+CAMPOS = (
+    'pagina_actual', 'nivel_dificultad', 'cache_escenarios', 'escenario_seleccionado_id', 'datos_escenario',
+    'estado_simulacion', 'estado_anterior', 'numero_pregunta', 'contexto_actual', 'historial_decisiones',
+    'ultimo_analisis', 'ultimas_consecuencias', 'juego_terminado', 'razon_fin', 'puntaje_final',
+    'pregunta_actual', 'opciones_actuales', 'turno_pendiente', 'nota_impacto', 'nodo_paquete', 'gasto_especulativo',
+    'id_partida', 'impactos_partida',
+)
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS sesiones (
+    token TEXT PRIMARY KEY,
+    actualizada REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS campos (
+    token TEXT NOT NULL,
+    campo TEXT NOT NULL,
+    valor BLOB NOT NULL,
+    PRIMARY KEY (token, campo)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS idx_sesiones_actualizada ON sesiones (actualizada);
+"""
+
+
+def nuevo_token():
+    return secrets.token_urlsafe(16)
+
+
+_SIN_VALOR = object()
+
+
+class Huella(NamedTuple):
+    digest: bytes
+    valor: object = _SIN_VALOR  # El valor, si es inmutable: mientras sea el mismo objeto, no ha cambiado
+
+
+def _json(valor):
+    return json.dumps(valor, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _empaquetar(datos):
+    return b"z" + zlib.compress(datos) if len(datos) >= COMPRIMIR_DESDE else b"j" + datos
+
+
+def _desempaquetar(datos):
+    return zlib.decompress(datos[1:]) if datos[:1] == b"z" else datos[1:]
+
+
+def serializar(valor):
+    return _empaquetar(_json(valor))
+
+
+def deserializar(datos):
+    return json.loads(_desempaquetar(datos))
+
+
+def huella(datos):
+    """Digest del JSON sin comprimir de un campo."""
+    return hashlib.blake2b(datos, digest_size=16).digest()
+
+
+def diferencias(estado, huellas, inmutables=INMUTABLES):
+    """(cambios {campo: bytes}, borrados [campo], huellas nuevas) de los CAMPOS de `estado` frente a `huellas`.
+
+    Un valor de tipo `inmutables` que sigue siendo el objeto de su huella se da
+    por igual sin serializarlo; los demás se pasan a JSON y solo se comprimen
+    los que cambiaron.
+    """
+    cambios, nuevas = {}, {}
+    for campo in CAMPOS:
+        if campo not in estado:
+            continue
+        valor, anterior = estado[campo], huellas.get(campo)
+        if anterior is not None and anterior.valor is valor:
+            nuevas[campo] = anterior
+            continue
+        datos = _json(valor)
+        nuevas[campo] = Huella(huella(datos), valor if isinstance(valor, inmutables) else _SIN_VALOR)
+        if anterior is None or anterior.digest != nuevas[campo].digest:
+            cambios[campo] = _empaquetar(datos)
+    return cambios, [campo for campo in huellas if campo not in nuevas], nuevas
+
+
+def restaurar(guardado, inmutables=INMUTABLES):
+    """({campo: valor}, huellas) de lo leído del almacén; los campos ilegibles se descartan."""
+    valores, huellas = {}, {}
+    for campo, datos in guardado.items():
+        if campo not in CAMPOS:
+            continue
+        try:
+            datos = _desempaquetar(datos)
+            valores[campo] = valor = json.loads(datos)
+        except (ValueError, zlib.error):
+            continue
+        huellas[campo] = Huella(huella(datos), valor if isinstance(valor, inmutables) else _SIN_VALOR)
+    return valores, huellas
+
+
+class AlmacenSQLite:
+    """Sesiones en un fichero SQLite (WAL), seguro para varios hilos y procesos."""
+
+    def __init__(self, ruta, ttl=TTL):
+        self.ruta = ruta
+        self.ttl = ttl
+        self.metricas = collections.Counter()
+        with self._conectar() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(_ESQUEMA)
+        self.purgar()
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def leer(self, token):
+        """{campo: bytes} de la sesión, o {} si no existe o caducó."""
+        with self._conectar() as conn:
+            if not conn.execute("SELECT 1 FROM sesiones WHERE token = ? AND actualizada >= ?",
+                                (token, time.time() - self.ttl)).fetchone():
+                return {}
+            filas = conn.execute("SELECT campo, valor FROM campos WHERE token = ?", (token,)).fetchall()
+        self.metricas["lecturas"] += 1
+        return dict(filas)
+
+    def escribir(self, token, cambios, borrados=()):
+        """Guarda solo los campos cambiados y borra los eliminados, en una transacción."""
+        with self._conectar() as conn:
+            conn.execute("INSERT OR REPLACE INTO sesiones (token, actualizada) VALUES (?, ?)", (token, time.time()))
+            conn.executemany("INSERT OR REPLACE INTO campos (token, campo, valor) VALUES (?, ?, ?)",
+                             [(token, campo, datos) for campo, datos in cambios.items()])
+            conn.executemany("DELETE FROM campos WHERE token = ? AND campo = ?", [(token, campo) for campo in borrados])
+        self.metricas["escrituras"] += 1
+        self.metricas["campos_escritos"] += len(cambios)
+        self.metricas["bytes_escritos"] += sum(len(datos) for datos in cambios.values())
+
+    def purgar(self):
+        """Elimina las sesiones inactivas más allá del TTL; devuelve cuántas."""
+        limite = time.time() - self.ttl
+        with self._conectar() as conn:
+            conn.execute("DELETE FROM campos WHERE token IN (SELECT token FROM sesiones WHERE actualizada < ?)", (limite,))
+            return conn.execute("DELETE FROM sesiones WHERE actualizada < ?", (limite,)).rowcount
+
+
+# --- Protocolo de Redis (RESP2) ---
+# Cliente mínimo para no añadir dependencias: basta con los comandos de hash.
+
+class ErrorRedis(Exception):
+    pass
+
+
+def _comando(*partes):
+    salida = [b"*%d\r\n" % len(partes)]
+    for parte in partes:
+        if not isinstance(parte, bytes):
+            parte = str(parte).encode("utf-8")
+        salida.append(b"$%d\r\n%s\r\n" % (len(parte), parte))
+    return b"".join(salida)
+
+
+def _leer_respuesta(lector):
+    linea = lector.readline()
+    if not linea:
+        raise ConnectionError("Conexión cerrada por el servidor")
+    tipo, resto = linea[:1], linea[1:-2]
+    if tipo == b"+":
+        return resto.decode("utf-8")
+    if tipo == b"-":
+        raise ErrorRedis(resto.decode("utf-8"))
+    if tipo == b":":
+        return int(resto)
+    if tipo == b"$":
+        return None if int(resto) < 0 else lector.read(int(resto) + 2)[:-2]
+    if tipo == b"*":
+        return None if int(resto) < 0 else [_leer_respuesta(lector) for _ in range(int(resto))]
+    raise ErrorRedis(f"Respuesta RESP no válida: {linea!r}")
+
+
+class ClienteRedis:
+    """Una conexión por proceso, serializada con un lock; se reconecta una vez si se cae."""
+
+    def __init__(self, host, puerto, db=0, password=None, timeout=TIMEOUT_REDIS):
+        self.direccion = (host, puerto)
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._socket = self._lector = None
+
+    def _conectar(self):
+        self._socket = socket.create_connection(self.direccion, timeout=self.timeout)
+        self._lector = self._socket.makefile("rb")
+        if self.password:
+            self._enviar([("AUTH", self.password)])
+        if self.db:
+            self._enviar([("SELECT", self.db)])
+
+    def _cerrar(self):
+        if self._socket:
+            self._socket.close()
+        self._socket = self._lector = None
+
+    def _enviar(self, comandos):
+        self._socket.sendall(b"".join(_comando(*c) for c in comandos))
+        return [_leer_respuesta(self._lector) for _ in comandos]
+
+    def ejecutar(self, *comandos):
+        """Envía los comandos en una sola ida y vuelta (pipeline) y devuelve sus respuestas."""
+        with self._lock:
+            for intento in range(2):
+                try:
+                    if self._socket is None:
+                        self._conectar()
+                    return self._enviar(comandos)
+                except (OSError, ConnectionError):
+                    self._cerrar()
+                    if intento:
+                        raise
+
+
+class AlmacenRedis:
+    """Sesiones como hashes de un servidor compatible con Redis, con caducidad por inactividad."""
+
+    def __init__(self, url, ttl=TTL):
+        partes = urllib.parse.urlparse(url)
+        self.cliente = ClienteRedis(partes.hostname or "127.0.0.1", partes.port or 6379,
+                                    int(partes.path.strip("/") or 0), partes.password)
+        self.ttl = ttl
+        self.metricas = collections.Counter()
+
+    def leer(self, token):
+        clave = PREFIJO_REDIS + token
+        valores, _ = self.cliente.ejecutar(("HGETALL", clave), ("EXPIRE", clave, self.ttl))
+        self.metricas["lecturas"] += 1
+        return {valores[i].decode("utf-8"): valores[i + 1] for i in range(0, len(valores or []), 2)}
+
+    def escribir(self, token, cambios, borrados=()):
+        clave = PREFIJO_REDIS + token
+        comandos = []
+        if cambios:
+            comandos.append(("HSET", clave, *(x for campo, datos in cambios.items() for x in (campo, datos))))
+        if borrados:
+            comandos.append(("HDEL", clave, *borrados))
+        self.cliente.ejecutar(*comandos, ("EXPIRE", clave, self.ttl))
+        self.metricas["escrituras"] += 1
+        self.metricas["campos_escritos"] += len(cambios)
+        self.metricas["bytes_escritos"] += sum(len(datos) for datos in cambios.values())
+
+    def purgar(self):
+        return 0 # El servidor caduca las claves solo
+
+
+def crear_almacen(destino, ttl=TTL):
+    """AlmacenRedis para 'redis://...' y AlmacenSQLite para una ruta de fichero."""
+    if destino.startswith(("redis://", "rediss://")):
+        return AlmacenRedis(destino, ttl)
+    return AlmacenSQLite(destino, ttl)
+
+
+# --- Sustituto local de Redis ---
+
+class ServidorRedisLocal:
+    """Hashes en memoria con caducidad: PING, HSET, HGETALL, HDEL, DEL, EXPIRE y SELECT."""
+
+    def __init__(self, puerto=6380):
+        self.puerto = puerto
+        self._hashes = {}     # clave -> {campo: bytes}
+        self._caducidad = {}  # clave -> instante monotónico
+        self._lock = threading.Lock()
+        self._servidor = None
+
+    def _hash(self, clave):
+        if (limite := self._caducidad.get(clave)) is not None and time.monotonic() >= limite:
+            self._hashes.pop(clave, None)
+            self._caducidad.pop(clave, None)
+        return self._hashes.get(clave)
+
+    def procesar(self, comando, *args):
+        comando = comando.decode("utf-8").upper()
+        with self._lock:
+            if comando in ("PING", "SELECT", "AUTH"):
+                return "PONG" if comando == "PING" else "OK"
+            if comando == "HSET":
+                valores = self._hash(args[0])
+                if valores is None:
+                    valores = self._hashes[args[0]] = {}
+                nuevos = sum(campo not in valores for campo in args[1::2])
+                valores.update(zip(args[1::2], args[2::2]))
+                return nuevos
+            if comando == "HGETALL":
+                return [x for campo, valor in (self._hash(args[0]) or {}).items() for x in (campo, valor)]
+            if comando == "HDEL":
+                valores = self._hash(args[0]) or {}
+                return sum(valores.pop(campo, None) is not None for campo in args[1:])
+            if comando == "DEL":
+                return sum(self._hashes.pop(clave, None) is not None for clave in args)
+            if comando == "EXPIRE":
+                if self._hash(args[0]) is None:
+                    return 0
+                self._caducidad[args[0]] = time.monotonic() + int(args[1])
+                return 1
+        return ErrorRedis(f"ERR comando no admitido '{comando}'")
+
+    @staticmethod
+    def _codificar(respuesta):
+        if isinstance(respuesta, ErrorRedis):
+            return b"-%s\r\n" % str(respuesta).encode("utf-8")
+        if isinstance(respuesta, str):
+            return b"+%s\r\n" % respuesta.encode("utf-8")
+        if isinstance(respuesta, int):
+            return b":%d\r\n" % respuesta
+        if isinstance(respuesta, list):
+            return b"*%d\r\n" % len(respuesta) + b"".join(b"$%d\r\n%s\r\n" % (len(x), x) for x in respuesta)
+        return b"$-1\r\n"
+
+    def iniciar(self):
+        servidor = self
+
+        class Manejador(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        comando = _leer_respuesta(self.rfile)
+                    except (ConnectionError, ErrorRedis):
+                        return
+                    self.wfile.write(servidor._codificar(servidor.procesar(*comando)))
+
+        self._servidor = socketserver.ThreadingTCPServer(("127.0.0.1", self.puerto), Manejador)
+        self._servidor.daemon_threads = True
+        threading.Thread(target=self._servidor.serve_forever, name="redis-local", daemon=True).start()
+        return f"redis://127.0.0.1:{self._servidor.server_address[1]}/0"
+
+    def detener(self):
+        if self._servidor:
+            self._servidor.shutdown()
+            self._servidor.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sustituto local de Redis (en memoria) para el almacén de sesiones.")
+    parser.add_argument("--puerto", type=int, default=6380)
+    args = parser.parse_args(argv)
+
+    servidor = ServidorRedisLocal(args.puerto)
+    print(f"Redis local en {servidor.iniciar()}", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        servidor.detener()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Índice de casi-duplicados para los escenarios y preguntas generados.
+
+Cada texto se normaliza (minúsculas, sin tildes ni signos) y se reduce a su
+conjunto de n-gramas de caracteres; su firma MinHash estima la similitud de
+Jaccard entre dos textos sin compararlos enteros. Las firmas se reparten en
+bandas (LSH): solo los textos que coinciden en alguna banda se comparan, así
+que una consulta cuesta lo mismo con cien textos que con decenas de miles.
+
+El índice se organiza en espacios independientes ("escenarios", las
+preguntas de una partida...). Los persistentes se guardan en SQLite y se
+recargan al arrancar; los demás viven en memoria y se olvidan al terminar la
+partida o tras un tiempo sin usarse.
+"""
+import array
+import collections
+import contextlib
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+import zlib
+from typing import NamedTuple
+
+LONGITUD_NGRAMA = 5       # Caracteres por n-grama
+BANDAS = 20               # Con 3 filas por banda, los pares con similitud >= 0.5 son candidatos en el 93% de los casos
+FILAS = 3
+UMBRAL = 0.5              # Similitud estimada a partir de la cual dos textos son casi iguales
+TTL = 30 * 24 * 3600      # Antigüedad máxima de una firma persistida
+OLVIDAR_TRAS = 2 * 3600   # Segundos sin uso tras los que se olvida un espacio en memoria
+
+_PRIMO = (1 << 61) - 1
+_SEMILLA = 20240601       # Fija: las firmas guardadas deben seguir siendo comparables tras reiniciar
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS firmas (
+    espacio TEXT NOT NULL,
+    clave TEXT NOT NULL,
+    firma BLOB NOT NULL,
+    creada REAL NOT NULL,
+    PRIMARY KEY (espacio, clave)
+);
+"""
+
+
+class Coincidencia(NamedTuple):
+    clave: str
+    similitud: float
+
+
+def normalizar(texto):
+    texto = unicodedata.normalize("NFKD", texto.lower()).encode("ascii", "ignore").decode("ascii")
+    return " ".join(re.findall(r"[a-z0-9]+", texto))
+
+
+def ngramas(texto, n=LONGITUD_NGRAMA):
+    texto = normalizar(texto)
+    if len(texto) <= n:
+        return {texto}
+    return {texto[i:i + n] for i in range(len(texto) - n + 1)}
+
+
+class _Espacio:
+    def __init__(self, persistente):
+        self.persistente = persistente
+        self.firmas = {}                              # clave -> firma
+        self.cubetas = collections.defaultdict(set)   # (banda, valores de la banda) -> claves
+        self.uso = time.monotonic()
+
+
+class IndiceSimilitud:
+    """Firmas MinHash con LSH por bandas, por espacio; seguro para varios hilos."""
+
+    def __init__(self, ruta_disco=None, umbral=UMBRAL, bandas=BANDAS, filas=FILAS, ttl=TTL, olvidar_tras=OLVIDAR_TRAS):
+        self.ruta_disco = ruta_disco
+        self.umbral = umbral
+        self.bandas = bandas
+        self.filas = filas
+        self.ttl = ttl
+        self.olvidar_tras = olvidar_tras
+        rng = random.Random(_SEMILLA)
+        self._coeficientes = [(rng.randrange(1, _PRIMO), rng.randrange(_PRIMO)) for _ in range(bandas * filas)]
+        self._espacios = {}
+        self._lock = threading.Lock()
+        self.metricas = collections.Counter()
+        if ruta_disco:
+            with self._conectar() as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.executescript(_ESQUEMA)
+                conn.execute("DELETE FROM firmas WHERE creada < ?", (time.time() - ttl,))
+                filas_guardadas = conn.execute("SELECT espacio, clave, firma FROM firmas ORDER BY creada").fetchall()
+            for espacio, clave, datos in filas_guardadas:
+                firma = array.array("Q")
+                firma.frombytes(datos)
+                if len(firma) == bandas * filas: # Firmas de otra configuración: no son comparables
+                    self._insertar(self._espacio(espacio, True), clave, firma)
+            self.metricas["firmas_cargadas"] = len(filas_guardadas)
+
+    @contextlib.contextmanager
+    def _conectar(self):
+        conn = sqlite3.connect(self.ruta_disco, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def firma(self, texto):
+        """Firma MinHash del texto: el mínimo de cada función hash sobre sus n-gramas."""
+        hashes = [zlib.crc32(ngrama.encode("ascii")) for ngrama in ngramas(texto)]
+        return array.array("Q", (min((a * h + b) % _PRIMO for h in hashes) for a, b in self._coeficientes))
+
+    def _bandas(self, firma):
+        return [(banda, firma[banda * self.filas:(banda + 1) * self.filas].tobytes()) for banda in range(self.bandas)]
+
+    def _espacio(self, nombre, persistente=False):
+        if (espacio := self._espacios.get(nombre)) is None:
+            espacio = self._espacios[nombre] = _Espacio(persistente)
+        espacio.uso = time.monotonic()
+        return espacio
+
+    def _insertar(self, espacio, clave, firma):
+        espacio.firmas[clave] = firma
+        for cubeta in self._bandas(firma):
+            espacio.cubetas[cubeta].add(clave)
+
+    def _mas_parecido(self, espacio, firma, umbral):
+        candidatos = set()
+        for cubeta in self._bandas(firma):
+            candidatos |= espacio.cubetas.get(cubeta, set())
+        self.metricas["consultas"] += 1
+        self.metricas["candidatos"] += len(candidatos)
+        mejor = None
+        for clave in candidatos:
+            similitud = sum(x == y for x, y in zip(firma, espacio.firmas[clave])) / len(firma)
+            if similitud >= umbral and (mejor is None or similitud > mejor.similitud):
+                mejor = Coincidencia(clave, similitud)
+        return mejor
+
+    def _olvidar_inactivos(self):
+        limite = time.monotonic() - self.olvidar_tras
+        for nombre in [n for n, e in self._espacios.items() if not e.persistente and e.uso < limite]:
+            del self._espacios[nombre]
+            self.metricas["espacios_olvidados"] += 1
+
+    def buscar(self, espacio, texto, umbral=None):
+        """El texto más parecido del espacio por encima del umbral (Coincidencia), o None."""
+        firma = self.firma(texto)
+        with self._lock:
+            if (actual := self._espacios.get(espacio)) is None:
+                return None
+            return self._mas_parecido(actual, firma, self.umbral if umbral is None else umbral)
+
+    def _agregar(self, espacio, clave, texto, persistir, umbral):
+        clave, firma = str(clave), self.firma(texto)
+        persistir = persistir and bool(self.ruta_disco)
+        with self._lock:
+            self._olvidar_inactivos()
+            actual = self._espacio(espacio, persistir)
+            if umbral is not None and (coincidencia := self._mas_parecido(actual, firma, umbral)):
+                self.metricas["repetidos"] += 1
+                return coincidencia
+            self._insertar(actual, clave, firma)
+            self.metricas["incluidos"] += 1
+        if persistir:
+            with self._conectar() as conn:
+                conn.execute("INSERT OR REPLACE INTO firmas (espacio, clave, firma, creada) VALUES (?, ?, ?, ?)",
+                             (espacio, clave, firma.tobytes(), time.time()))
+        return None
+
+    def incluir(self, espacio, clave, texto, persistir=False):
+        """Añade el texto sin comprobar nada; una clave ya incluida no se recalcula."""
+        with self._lock:
+            if (actual := self._espacios.get(espacio)) is not None and str(clave) in actual.firmas:
+                actual.uso = time.monotonic()
+                return
+        self._agregar(espacio, clave, texto, persistir, None)
+
+    def incluir_si_nuevo(self, espacio, clave, texto, umbral=None, persistir=False):
+        """Añade el texto salvo que sea casi igual a otro del espacio: devuelve esa Coincidencia, o None si se añadió.
+
+        Comprobar e incluir es atómico: de dos textos casi iguales enviados a la vez, solo entra uno.
+        """
+        return self._agregar(espacio, clave, texto, persistir, self.umbral if umbral is None else umbral)
+
+    def olvidar(self, espacio):
+        """Descarta un espacio en memoria (p. ej. las preguntas de una partida terminada)."""
+        with self._lock:
+            self._espacios.pop(espacio, None)
+
+    def tamanos(self):
+        with self._lock:
+            return {"espacios": len(self._espacios), "firmas": sum(len(e.firmas) for e in self._espacios.values())}
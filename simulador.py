@@ -0,0 +1,173 @@
+"""Simulaciones por lotes sin navegador, para pruebas de carga y de equilibrio.
+
+Juega N partidas completas con el motor de motor.py, repartidas en un pool de
+hilos o de procesos, contra Gemini, contra un servidor compatible con OpenAI
+(p. ej. un vLLM o llama.cpp de la red local) o contra el backend simulado local, y
+escribe una línea JSONL por turno, una por partida y un resumen final con las
+distribuciones de latencia, tokens y resultados.
+
+Ejemplos:
+    python simulador.py --partidas 200 --backend simulado --hilos 16 --salida lote.jsonl
+    GEMINI_API_KEY=... python simulador.py --partidas 20 --backend gemini --politica guion:0,1,2,3
+    python simulador.py --partidas 200 --backend openai --endpoint http://10.0.0.5:8000/v1 --modelo llama-3.1-8b --hilos 32
+"""
+import argparse
+import collections
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import gemini_client
+import motor
+import proveedores
+
+INTENTOS_ESCENARIOS = 3
+
+_backends = {} # pid -> backend: uno (con su sesión HTTP) por proceso, nunca heredado por fork
+
+
+def crear_backend(config):
+    if config["backend"] == "simulado":
+        return motor.BackendSimulado(latencia=config["latencia"])
+    if config["backend"] == "openai":
+        proveedor = proveedores.ProveedorOpenAI(config["endpoint"], config["api_key"] or "", conexiones=config["hilos"])
+        return motor.BackendGemini(None, None, config["modelo"], proveedor=proveedor)
+    session = gemini_client.crear_sesion(pool_maxsize=config["hilos"])
+    return motor.BackendGemini(session, config["api_key"], config["modelo"], config["endpoint"])
+
+
+def crear_politica(especificacion):
+    """'aleatoria' o 'guion:i,j,k' (índices de opción por pregunta; el último se repite)."""
+    if especificacion == "aleatoria":
+        return motor.politica_aleatoria
+    if especificacion.startswith("guion:"):
+        return motor.politica_guion([int(i) for i in especificacion[len("guion:"):].split(",")])
+    raise ValueError(f"Política desconocida: {especificacion!r}")
+
+
+def _backend(config):
+    if (backend := _backends.get(os.getpid())) is None:
+        backend = _backends[os.getpid()] = crear_backend(config)
+    return backend
+
+
+def _jugar(config, escenario, nivel, semilla):
+    """Tarea del pool: una partida. Los hilos comparten el backend; cada proceso crea el suyo."""
+    return motor.jugar_partida(escenario, nivel, _backend(config), crear_politica(config["politica"]),
+                               random.Random(semilla))
+
+
+def percentiles(valores, cuantiles=(50, 90, 95, 99)):
+    """{'p50': ..., 'max': ...} de una lista de valores ({} si está vacía)."""
+    if not valores:
+        return {}
+    valores = sorted(valores)
+    return {f"p{q}": round(valores[min(len(valores) - 1, int(round(q / 100 * (len(valores) - 1))))], 4)
+            for q in cuantiles} | {"max": round(valores[-1], 4)}
+
+
+def resumir(partidas, segundos):
+    """Distribuciones agregadas de un lote: resultados, latencias por turno y tokens."""
+    turnos = [t for p in partidas for t in p["turnos"]]
+    por_escenario = collections.defaultdict(list)
+    for p in partidas:
+        por_escenario[p["escenario"]].append(p)
+    return {
+        "tipo": "resumen", "partidas": len(partidas), "segundos": round(segundos, 2),
+        "partidas_por_segundo": round(len(partidas) / segundos, 2) if segundos else None,
+        "llamadas": sum(t["llamadas"] for t in turnos),
+        "llamadas_invalidas": sum(t["llamadas_invalidas"] for t in turnos),
+        "errores": dict(collections.Counter(e for t in turnos for e in t["errores"])),
+        "tokens_entrada": sum(t["tokens_entrada"] for t in turnos),
+        "tokens_salida": sum(t["tokens_salida"] for t in turnos),
+        "tokens_cacheados": sum(t["tokens_cacheados"] for t in turnos),
+        "latencia_turno": percentiles([t["segundos"] for t in turnos]),
+        "puntaje": percentiles([p["puntaje"] for p in partidas]),
+        "histograma_puntaje": dict(sorted(collections.Counter(p["puntaje"] for p in partidas).items())),
+        "bancarrotas": sum(p["bancarrota"] for p in partidas),
+        "razones_fin": dict(collections.Counter(p["razon_fin"] for p in partidas)),
+        "por_escenario": {
+            escenario: {"titulo": grupo[0]["titulo"], "partidas": len(grupo),
+                        "puntaje_medio": round(sum(p["puntaje"] for p in grupo) / len(grupo), 2),
+                        "bancarrotas": sum(p["bancarrota"] for p in grupo)}
+            for escenario, grupo in por_escenario.items()
+        },
+    }
+
+
+def _escribir(salida, registro):
+    salida.write(json.dumps(registro, ensure_ascii=False) + "\n")
+
+
+def ejecutar(config, salida):
+    """Genera los escenarios de cada nivel, juega el lote en el pool y escribe el JSONL."""
+    backend = _backend(config)
+    escenarios = {}
+    for nivel in config["niveles"]:
+        for _ in range(INTENTOS_ESCENARIOS):
+            if escenarios.get(nivel):
+                break
+            escenarios[nivel] = backend.escenarios(nivel)
+        if not escenarios[nivel]:
+            raise SystemExit(f"No se pudieron generar escenarios para el nivel {nivel}.")
+
+    rng = random.Random(config["semilla"])
+    tareas = []
+    for i in range(config["partidas"]):
+        nivel = config["niveles"][i % len(config["niveles"])]
+        lote = escenarios[nivel]
+        tareas.append((lote[(i // len(config["niveles"])) % len(lote)], nivel, rng.getrandbits(32)))
+
+    pool_cls = ProcessPoolExecutor if config["procesos"] else ThreadPoolExecutor
+    trabajadores = config["procesos"] or config["hilos"]
+    partidas = []
+    inicio = time.monotonic()
+    with pool_cls(max_workers=trabajadores) as pool:
+        futuros = [pool.submit(_jugar, config, escenario, nivel, semilla) for escenario, nivel, semilla in tareas]
+        for indice, futuro in enumerate(as_completed(futuros)):
+            partida = futuro.result()
+            for turno in partida["turnos"]:
+                _escribir(salida, dict(turno, tipo="turno", partida=indice, escenario=partida["escenario"]))
+            _escribir(salida, dict({k: v for k, v in partida.items() if k != "turnos"}, tipo="partida", partida=indice))
+            partidas.append(partida)
+    resumen = resumir(partidas, time.monotonic() - inicio)
+    _escribir(salida, resumen)
+    return resumen
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Juega simulaciones completas sin interfaz y mide latencia, tokens y resultados.")
+    parser.add_argument("--partidas", type=int, default=10)
+    parser.add_argument("--backend", choices=["simulado", "gemini", "openai"], default="simulado")
+    parser.add_argument("--politica", default="aleatoria", help="'aleatoria' o 'guion:0,1,2,3' (índice de opción por pregunta)")
+    parser.add_argument("--niveles", default=",".join(motor.NIVELES_DIFICULTAD), help="Niveles separados por comas")
+    parser.add_argument("--hilos", type=int, default=8, help="Partidas simultáneas en un pool de hilos")
+    parser.add_argument("--procesos", type=int, default=0, help="Usar un pool de procesos de este tamaño en lugar de hilos")
+    parser.add_argument("--semilla", type=int, default=None)
+    parser.add_argument("--latencia", type=float, default=0.0, help="Latencia fija por llamada del backend simulado (s)")
+    parser.add_argument("--modelo", default=gemini_client.MODELO_POR_DEFECTO)
+    parser.add_argument("--endpoint", default=gemini_client.API_ENDPOINT_BASE,
+                        help="Base de la API; con --backend openai, p. ej. http://10.0.0.5:8000/v1")
+    parser.add_argument("--salida", help="Fichero JSONL (por defecto, la salida estándar)")
+    args = parser.parse_args(argv)
+
+    crear_politica(args.politica) # Validar antes de lanzar el lote
+    config = dict(vars(args), niveles=[n.strip() for n in args.niveles.split(",") if n.strip()],
+                  api_key=os.environ.get("OPENAI_API_KEY" if args.backend == "openai" else "GEMINI_API_KEY"))
+    if args.backend == "gemini" and not config["api_key"]:
+        parser.error("El backend gemini necesita la variable de entorno GEMINI_API_KEY.")
+    if args.backend == "openai" and args.endpoint == gemini_client.API_ENDPOINT_BASE:
+        parser.error("El backend openai necesita --endpoint (la base de la API compatible con OpenAI).")
+
+    with (open(args.salida, "w", encoding="utf-8") if args.salida else contextlib.nullcontext(sys.stdout)) as salida:
+        resumen = ejecutar(config, salida)
+    print(f"{resumen['partidas']} partidas en {resumen['segundos']} s; latencia por turno {resumen['latencia_turno']}; "
+          f"puntaje {resumen['puntaje']}; bancarrotas {resumen['bancarrotas']}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""Telemetría de las llamadas a Gemini: latencia, tokens, reintentos y fallos.
+
+Cada llamada se mide con `REGISTRO.medir(tipo, modelo)` y se acumula por
+(tipo de llamada, modelo) en histogramas y contadores. Cada hilo escribe en
+su propio fragmento, sin locks en el camino caliente; al leer se suman los
+fragmentos (y los de hilos ya terminados se consolidan).
+
+Los agregados se exportan en formato de texto de Prometheus, por HTTP con
+`iniciar_servidor` y en la página de administración.
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LIMITES_SEGUNDOS = (0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+PREFIJO = "crisis_gemini"
+
+
+class Histograma:
+    def __init__(self, limites=LIMITES_SEGUNDOS):
+        self.limites = limites
+        self.cuentas = [0] * (len(limites) + 1) # La última es +Inf
+        self.suma = 0.0
+        self.n = 0
+
+    def observar(self, valor):
+        self.cuentas[bisect.bisect_left(self.limites, valor)] += 1
+        self.suma += valor
+        self.n += 1
+
+    def sumar(self, otro):
+        self.cuentas = [a + b for a, b in zip(self.cuentas, otro.cuentas)]
+        self.suma += otro.suma
+        self.n += otro.n
+
+    def percentil(self, q):
+        """Límite superior del intervalo que contiene el percentil `q` (inf si cae en el último), o None."""
+        if not self.n:
+            return None
+        objetivo, acumulado = q / 100 * self.n, 0
+        for limite, cuenta in zip(self.limites + (float("inf"),), self.cuentas):
+            acumulado += cuenta
+            if acumulado >= objetivo:
+                return limite
+        return float("inf")
+
+
+class Agregado:
+    """Métricas de un par (tipo de llamada, modelo)."""
+
+    def __init__(self):
+        self.segundos = Histograma()
+        self.ttfb = Histograma()
+        self.contadores = collections.Counter() # llamadas, reintentos, tokens_*, espera_cuota_segundos...
+        self.errores = collections.Counter()    # Por clase de excepción
+        self.fallos = collections.Counter()     # "parseo" / "validacion"
+
+    def sumar(self, otro):
+        self.segundos.sumar(otro.segundos)
+        self.ttfb.sumar(otro.ttfb)
+        # dict(...) copia de una vez: el hilo dueño puede estar añadiendo claves mientras tanto
+        self.contadores.update(dict(otro.contadores))
+        self.errores.update(dict(otro.errores))
+        self.fallos.update(dict(otro.fallos))
+
+
+class Medicion:
+    """Datos de una llamada en curso; gemini_client la va completando."""
+
+    def __init__(self):
+        self.inicio = time.monotonic()
+        self.ttfb = None
+        self.reintentos = 0
+        self.espera_cuota = 0.0
+        self.tokens_entrada = 0
+        self.tokens_salida = 0
+        self.tokens_cacheados = 0
+
+    def primer_byte(self, instante=None):
+        if self.ttfb is None:
+            self.ttfb = (instante or time.monotonic()) - self.inicio
+
+    def reintento(self):
+        self.reintentos += 1
+
+    def uso(self, usage_metadata):
+        self.tokens_entrada = usage_metadata.get("promptTokenCount", 0)
+        self.tokens_salida = usage_metadata.get("candidatesTokenCount", 0) + usage_metadata.get("thoughtsTokenCount", 0)
+        self.tokens_cacheados = usage_metadata.get("cachedContentTokenCount", 0)
+
+
+class Registro:
+    def __init__(self):
+        self._local = threading.local()
+        self._fragmentos = [] # (ref. débil al hilo, {(tipo, modelo): Agregado})
+        self._consolidado = {}
+        self._fuentes = {}
+        self._observadores = []
+        self._lock = threading.Lock() # Solo para la lista de fragmentos, no para cada observación
+
+    def _agregado(self, tipo, modelo):
+        fragmento = getattr(self._local, "fragmento", None)
+        if fragmento is None:
+            fragmento = self._local.fragmento = {}
+            with self._lock:
+                self._fragmentos.append((weakref.ref(threading.current_thread()), fragmento))
+        clave = (tipo, modelo)
+        if (agregado := fragmento.get(clave)) is None:
+            agregado = fragmento[clave] = Agregado()
+        return agregado
+
+    @contextlib.contextmanager
+    def medir(self, tipo, modelo):
+        """Mide una llamada: tiempo total, TTFB, tokens, reintentos y, si lanza, la clase de error."""
+        medicion = Medicion()
+        error = None
+        try:
+            yield medicion
+        except BaseException as e:
+            error = type(e).__name__
+            self._agregado(tipo, modelo).errores[error] += 1
+            raise
+        finally:
+            agregado = self._agregado(tipo, modelo)
+            segundos = time.monotonic() - medicion.inicio
+            agregado.segundos.observar(segundos)
+            if medicion.ttfb is not None:
+                agregado.ttfb.observar(medicion.ttfb)
+            agregado.contadores.update(llamadas=1, reintentos=medicion.reintentos,
+                                       tokens_entrada=medicion.tokens_entrada, tokens_salida=medicion.tokens_salida,
+                                       tokens_cacheados=medicion.tokens_cacheados,
+                                       espera_cuota_segundos=medicion.espera_cuota)
+            for observador in self._observadores:
+                observador(tipo, modelo, segundos, error)
+
+    def registrar_fallo(self, tipo, modelo, motivo):
+        """Respuesta recibida pero inservible: motivo "parseo" (no es JSON) o "validacion" (no cumple el formato)."""
+        self._agregado(tipo, modelo).fallos[motivo] += 1
+
+    def observar(self, funcion):
+        """Llama a `funcion(tipo, modelo, segundos, error)` tras cada medición; `error` es la clase o None."""
+        self._observadores.append(funcion)
+
+    def agregar_fuente(self, nombre, funcion):
+        """Registra `funcion() -> {métrica: número}` (p. ej. la caché) para exportarla junto al resto."""
+        self._fuentes[nombre] = funcion
+
+    def fuentes(self):
+        datos = {}
+        for nombre, funcion in list(self._fuentes.items()):
+            try:
+                datos[nombre] = funcion()
+            except Exception:
+                continue
+        return datos
+
+    def resumen(self):
+        """{(tipo, modelo): Agregado} sumando todos los hilos; consolida los de hilos terminados."""
+        total = collections.defaultdict(Agregado)
+        with self._lock:
+            vivos = []
+            for hilo, fragmento in self._fragmentos:
+                if hilo() is None or not hilo().is_alive():
+                    for clave, agregado in fragmento.items():
+                        self._consolidado.setdefault(clave, Agregado()).sumar(agregado)
+                else:
+                    vivos.append((hilo, fragmento))
+            self._fragmentos = vivos
+            for clave, agregado in self._consolidado.items():
+                total[clave].sumar(agregado)
+        for _, fragmento in vivos:
+            for clave, agregado in list(fragmento.items()):
+                total[clave].sumar(agregado)
+        return dict(total)
+
+    def exportar_prometheus(self):
+        """Texto en el formato de exposición de Prometheus (version 0.0.4)."""
+        lineas = []
+
+        def cabecera(nombre, tipo, ayuda):
+            lineas.extend([f"# HELP {PREFIJO}_{nombre} {ayuda}", f"# TYPE {PREFIJO}_{nombre} {tipo}"])
+
+        resumen = sorted(self.resumen().items())
+        for nombre, atributo, ayuda in (("llamada_segundos", "segundos", "Tiempo total de la llamada, con reintentos y espera de cuota."),
+                                        ("primer_byte_segundos", "ttfb", "Tiempo hasta el primer byte de la respuesta.")):
+            cabecera(nombre, "histogram", ayuda)
+            for (tipo, modelo), agregado in resumen:
+                histograma = getattr(agregado, atributo)
+                etiquetas = f'tipo="{tipo}",modelo="{modelo}"'
+                acumulado = 0
+                for limite, cuenta in zip(histograma.limites + ("+Inf",), histograma.cuentas):
+                    acumulado += cuenta
+                    lineas.append(f'{PREFIJO}_{nombre}_bucket{{{etiquetas},le="{limite}"}} {acumulado}')
+                lineas.append(f"{PREFIJO}_{nombre}_sum{{{etiquetas}}} {histograma.suma}")
+                lineas.append(f"{PREFIJO}_{nombre}_count{{{etiquetas}}} {histograma.n}")
+
+        for contador, ayuda in (("llamadas", "Llamadas realizadas."), ("reintentos", "Reintentos por 429/5xx/conexión."),
+                                ("tokens_entrada", "Tokens del prompt (usageMetadata)."),
+                                ("tokens_salida", "Tokens generados (usageMetadata)."),
+                                ("tokens_cacheados", "Tokens del prompt servidos desde la caché de prefijos del modelo."),
+                                ("espera_cuota_segundos", "Tiempo esperando cuota en el cubo de tokens.")):
+            cabecera(f"{contador}_total", "counter", ayuda)
+            for (tipo, modelo), agregado in resumen:
+                lineas.append(f'{PREFIJO}_{contador}_total{{tipo="{tipo}",modelo="{modelo}"}} {agregado.contadores[contador]}')
+        for nombre, atributo, etiqueta, ayuda in (("errores_total", "errores", "clase", "Llamadas fallidas por clase de excepción."),
+                                                  ("fallos_respuesta_total", "fallos", "motivo", "Respuestas no parseables o no válidas.")):
+            cabecera(nombre, "counter", ayuda)
+            for (tipo, modelo), agregado in resumen:
+                for valor, cuenta in sorted(getattr(agregado, atributo).items()):
+                    lineas.append(f'{PREFIJO}_{nombre}{{tipo="{tipo}",modelo="{modelo}",{etiqueta}="{valor}"}} {cuenta}')
+
+        cabecera("fuente", "gauge", "Métricas de otros componentes (caché, cuota...).")
+        for fuente, metricas in sorted(self.fuentes().items()):
+            for metrica, valor in sorted(_aplanar(metricas).items()):
+                lineas.append(f'{PREFIJO}_fuente{{fuente="{fuente}",metrica="{metrica}"}} {valor}')
+        return "\n".join(lineas) + "\n"
+
+
+def _aplanar(metricas, prefijo=""):
+    """{'a': {'b': 1}} -> {'a_b': 1}, descartando lo que no es numérico."""
+    plano = {}
+    for clave, valor in metricas.items():
+        if isinstance(valor, dict):
+            plano.update(_aplanar(valor, f"{prefijo}{clave}_"))
+        elif isinstance(valor, (int, float)):
+            plano[f"{prefijo}{clave}"] = valor
+    return plano
+
+
+def iniciar_servidor(puerto, registro, host="127.0.0.1"):
+    """Sirve `GET /metrics` en un hilo de fondo. Devuelve el servidor, o None si el puerto está ocupado."""
+
+    class Manejador(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            datos = registro.exportar_prometheus().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(datos)))
+            self.end_headers()
+            self.wfile.write(datos)
+
+    try:
+        servidor = ThreadingHTTPServer((host, puerto), Manejador)
+    except OSError:
+        return None # Otra réplica del proceso ya exporta en ese puerto
+    servidor.daemon_threads = True
+    threading.Thread(target=servidor.serve_forever, name="metricas-prometheus", daemon=True).start()
+    return servidor
+
+
+REGISTRO = Registro() # Único por proceso: app.py y las páginas lo comparten al importarlo
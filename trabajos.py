@@ -0,0 +1,114 @@
+"""Cola de trabajos en segundo plano para las llamadas a Gemini de la interfaz.
+
+El hilo del script de Streamlit no espera a Gemini: encola el trabajo
+(escenarios, pregunta o turno), guarda su clave y sondea hasta que termina,
+así la página sigue respondiendo y el hilo del servidor queda libre.
+
+- Cada sesión tiene sus trabajos por clave (p. ej. ("turno", 3)): un segundo
+  envío con la misma clave, como un doble clic en "Confirmar Decisión",
+  devuelve el trabajo ya en curso en lugar de repetir la llamada.
+- Cancelar saca el trabajo de la cola si aún no empezó; si ya está en curso,
+  su resultado se descarta al terminar.
+- Los trabajos que nadie recoge (sesiones cerradas) se olvidan tras
+  ANTIGUEDAD_MAXIMA segundos.
+"""
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TRABAJADORES = 8
+ANTIGUEDAD_MAXIMA = 600   # Segundos tras los que un trabajo no recogido se olvida
+
+
+class Trabajo:
+    """Asa de un trabajo encolado: se consulta sin bloquear."""
+
+    def __init__(self, clave, futuro):
+        self.clave = clave
+        self.futuro = futuro
+        self.creado = time.monotonic()
+        self.cancelado = False
+
+    def terminado(self):
+        return self.cancelado or self.futuro.done()
+
+    def resultado(self):
+        """Lo que devolvió la función, o None si falló, se canceló o aún no terminó."""
+        if self.cancelado or not self.futuro.done() or self.futuro.cancelled() or self.futuro.exception():
+            return None
+        return self.futuro.result()
+
+    def segundos(self):
+        return time.monotonic() - self.creado
+
+    def cancelar(self):
+        """Marca el trabajo como cancelado; devuelve True si ni siquiera llegó a empezar."""
+        self.cancelado = True
+        return self.futuro.cancel()
+
+
+class ColaTrabajos:
+    """Pool de hilos compartido por todas las sesiones, con trabajos indexados por (sesión, clave)."""
+
+    def __init__(self, trabajadores=TRABAJADORES, antiguedad_maxima=ANTIGUEDAD_MAXIMA):
+        self._pool = ThreadPoolExecutor(max_workers=trabajadores, thread_name_prefix="trabajos")
+        self.antiguedad_maxima = antiguedad_maxima
+        self._sesiones = collections.defaultdict(dict) # sesión -> {clave: Trabajo}
+        self._lock = threading.Lock()
+        self._metricas = collections.Counter()
+
+    def _contar_fin(self, futuro):
+        if not futuro.cancelled():
+            with self._lock:
+                self._metricas["fallidos" if futuro.exception() else "completados"] += 1
+
+    def _olvidar_antiguos(self):
+        limite = time.monotonic() - self.antiguedad_maxima
+        for sesion, trabajos in list(self._sesiones.items()):
+            for clave, trabajo in list(trabajos.items()):
+                if trabajo.creado < limite and trabajo.terminado():
+                    del trabajos[clave]
+                    self._metricas["olvidados"] += 1
+            if not trabajos:
+                del self._sesiones[sesion]
+
+    def enviar(self, sesion, clave, funcion, *args):
+        """Encola funcion(*args) para la sesión, salvo que ya haya un trabajo con esa clave: devuelve ese."""
+        with self._lock:
+            if (trabajo := self._sesiones[sesion].get(clave)) is not None:
+                self._metricas["duplicados"] += 1
+                return trabajo
+            self._olvidar_antiguos()
+            trabajo = self._sesiones[sesion][clave] = Trabajo(clave, self._pool.submit(funcion, *args))
+            self._metricas["enviados"] += 1
+        trabajo.futuro.add_done_callback(self._contar_fin)
+        return trabajo
+
+    def buscar(self, sesion, clave):
+        with self._lock:
+            return self._sesiones.get(sesion, {}).get(clave)
+
+    def descartar(self, sesion, clave):
+        """Olvida un trabajo ya recogido; el siguiente envío con esa clave será uno nuevo."""
+        with self._lock:
+            if (trabajos := self._sesiones.get(sesion)) is not None:
+                trabajos.pop(clave, None)
+
+    def cancelar(self, sesion, clave=None):
+        """Cancela un trabajo de la sesión o, sin clave, todos (al reiniciar o abandonar la partida)."""
+        with self._lock:
+            trabajos = self._sesiones.get(sesion, {})
+            cancelados = [trabajos.pop(clave)] if clave in trabajos else [] if clave is not None else list(trabajos.values())
+            if clave is None:
+                self._sesiones.pop(sesion, None)
+        for trabajo in cancelados:
+            if trabajo.terminado():
+                continue
+            with self._lock:
+                self._metricas["cancelados" if trabajo.cancelar() else "abandonados"] += 1
+
+    def metricas(self):
+        with self._lock:
+            activos = sum(not t.terminado() for trabajos in self._sesiones.values() for t in trabajos.values())
+            return dict(self._metricas, activos=activos, sesiones=len(self._sesiones))